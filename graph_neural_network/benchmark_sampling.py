@@ -0,0 +1,202 @@
+import argparse, time
+
+import graphlearn_torch as glt
+import torch
+
+# node counts relative to the number of papers, roughly those of IGBH tiny
+NODE_RATIOS = {'paper': 1.0, 'author': 3.57, 'institute': 0.087, 'fos': 1.9}
+# edges per source node of each relation, roughly those of IGBH tiny; the
+# reverse relations are added as in compress_graph.py
+EDGE_RATIOS = {
+  ('paper', 'cites', 'paper'): 4.5,
+  ('paper', 'written_by', 'author'): 4.7,
+  ('author', 'affiliated_to', 'institute'): 0.9,
+  ('paper', 'topic', 'fos'): 12.3,
+}
+
+def power_law_ids(num_nodes, num_ids, skew, generator):
+  r""" num_ids node ids whose frequencies follow a power law, which is the
+  steeper the larger skew; skew=1 draws ids uniformly.
+  """
+  ranks = (torch.rand(num_ids, generator=generator) ** skew * num_nodes).long()
+  return torch.randperm(num_nodes, generator=generator)[ranks]
+
+def synthetic_igbh(num_papers, feat_dim, num_classes, skew, feat_dtype, seed):
+  r""" A random heterogeneous graph with the node and edge types of IGBH and
+  power-law degree distributions, with random features and paper labels.
+  """
+  generator = torch.Generator().manual_seed(seed)
+  num_nodes = {ntype: max(int(ratio * num_papers), 1) for ntype, ratio in NODE_RATIOS.items()}
+  edge_dict = {}
+  for (src, rel, dst), ratio in EDGE_RATIOS.items():
+    num_edges = int(ratio * num_nodes[src])
+    edge_index = torch.stack([power_law_ids(num_nodes[src], num_edges, skew, generator),
+                              power_law_ids(num_nodes[dst], num_edges, skew, generator)])
+    if src == dst:
+      edge_dict[(src, rel, dst)] = torch.cat([edge_index, edge_index.flip(0)], dim=1)
+    else:
+      edge_dict[(src, rel, dst)] = edge_index
+      edge_dict[(dst, f'rev_{rel}', src)] = edge_index.flip(0)
+  feat_dict = {ntype: torch.randn(num, feat_dim, generator=generator).to(feat_dtype)
+               for ntype, num in num_nodes.items()}
+  label = torch.randint(num_classes, (num_nodes['paper'],), generator=generator)
+  return num_nodes, edge_dict, feat_dict, label
+
+def to_layout(edge_index, num_src, num_dst, layout):
+  r""" edge_index in the format init_graph takes for layout: (indices, indptr)
+  for CSC and (indptr, indices) for CSR, as written by compress_graph.py.
+  """
+  if layout == 'COO':
+    return edge_index
+  key, other, num = (edge_index[1], edge_index[0], num_dst) if layout == 'CSC' else (edge_index[0], edge_index[1], num_src)
+  order = torch.argsort(key)
+  indptr = torch.zeros(num + 1, dtype=torch.int64)
+  indptr[1:] = torch.cumsum(torch.bincount(key, minlength=num), 0)
+  return (other[order], indptr) if layout == 'CSC' else (indptr, other[order])
+
+def build_dataset(graph, layout, edge_dir, distributed):
+  num_nodes, edge_dict, feat_dict, label = graph
+  dataset = glt.data.Dataset(edge_dir=edge_dir)
+  dataset.init_node_features(node_feature_data=feat_dict, with_gpu=False)
+  dataset.init_graph(
+    edge_index={etype: to_layout(edge_index, num_nodes[etype[0]], num_nodes[etype[2]], layout)
+                for etype, edge_index in edge_dict.items()},
+    layout=layout,
+    graph_mode='CPU',
+  )
+  dataset.init_node_labels(node_label_data={'paper': label})
+  if not distributed:
+    return dataset
+  # a single partition holding the whole graph, sampled by the workers of the distributed loader
+  return glt.distributed.DistDataset(
+    num_partitions=1, partition_idx=0,
+    graph_partition=dataset.graph,
+    node_feature_partition=dataset.node_features,
+    whole_node_labels=dataset.node_labels,
+    node_pb={ntype: torch.zeros(num, dtype=torch.int64) for ntype, num in num_nodes.items()},
+    edge_pb={etype: torch.zeros(edge_index.size(1), dtype=torch.int64) for etype, edge_index in edge_dict.items()},
+    edge_dir=edge_dir,
+  )
+
+def batch_stats(batch, num_layers):
+  r""" Seeds, sampled edges and bytes of gathered features of a batch, and the
+  edges aggregated by the num_layers layers of RGNN without and with
+  trim_to_layer, which skips the edges of the last i hops in layer i.
+  """
+  num_edges = sum(edge_index.size(1) for edge_index in batch.edge_index_dict.values())
+  feat_bytes = sum(x.numel() * x.element_size() for x in batch.x_dict.values())
+  hop_edges = torch.zeros(num_layers, dtype=torch.int64)
+  for etype_hop_edges in batch.num_sampled_edges.values():
+    etype_hop_edges = torch.as_tensor(etype_hop_edges)[:num_layers]
+    hop_edges[:etype_hop_edges.numel()] += etype_hop_edges
+  trimmed_edges = sum(int(hop_edges[:num_layers - i].sum()) for i in range(num_layers))
+  return torch.tensor([batch['paper'].batch_size, num_edges, feat_bytes,
+                       num_layers * num_edges, trimmed_edges], dtype=torch.float64)
+
+def benchmark(loader, num_layers, num_batches, warmup_batches):
+  stats = torch.zeros(5, dtype=torch.float64)
+  for idx, batch in enumerate(loader):
+    if idx == warmup_batches:
+      start = time.perf_counter()
+    if idx >= warmup_batches:
+      stats += batch_stats(batch, num_layers)
+  elapsed = time.perf_counter() - start
+  seeds, edges, feat_bytes, layer_edges, trimmed_edges = stats.tolist()
+  return {
+    'seeds/s': seeds / elapsed,
+    'edges/s': edges / elapsed,
+    'feat MB/s': feat_bytes / elapsed / 1024**2,
+    'feat MB/batch': feat_bytes / num_batches / 1024**2,
+    'layer edges/batch': layer_edges / num_batches,
+    'trimmed/batch': trimmed_edges / num_batches,
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Benchmarks neighbor sampling and feature collection of "
+                                               "the RGNN loaders on a synthetic IGBH-like graph, on CPU.")
+  parser.add_argument('--num_papers', type=int, default=50000,
+      help='number of paper nodes, the other node types are scaled as in IGBH')
+  parser.add_argument('--feat_dim', type=int, default=1024)
+  parser.add_argument('--use_fp16', action="store_true",
+      help="store node features in fp16")
+  parser.add_argument('--num_classes', type=int, default=2983)
+  parser.add_argument('--skew', type=float, default=3.0,
+      help="skew of the power-law degree distributions, 1 for uniform degrees")
+  parser.add_argument('--loaders', type=str, nargs='+', default=['neighbor', 'dist'],
+      choices=['neighbor', 'dist'],
+      help="glt NeighborLoader of train_rgnn_multi_gpu.py, DistNeighborLoader of dist_train_rgnn.py")
+  parser.add_argument('--layouts', type=str, nargs='+', default=['COO', 'CSC', 'CSR'],
+      choices=['COO', 'CSC', 'CSR'])
+  parser.add_argument('--edge_dir', type=str, default='in',
+      help="sampling direction of the COO layout, CSC samples in-neighbors and CSR out-neighbors")
+  parser.add_argument('--fan_outs', type=str, nargs='+', default=['5,10', '10,15', '15,10,5'])
+  parser.add_argument('--num_workers', type=int, nargs='+', default=[1, 2, 4],
+      help="numbers of sampling processes of the distributed loader")
+  parser.add_argument('--worker_concurrency', type=int, default=4)
+  parser.add_argument('--channel_size', type=str, default='4GB')
+  parser.add_argument('--master_port', type=int, default=12345)
+  parser.add_argument('--batch_size', type=int, default=1024)
+  parser.add_argument('--num_batches', type=int, default=20)
+  parser.add_argument('--warmup_batches', type=int, default=3)
+  parser.add_argument('--random_seed', type=int, default=42)
+  args = parser.parse_args()
+
+  print(f'-- Generating a synthetic graph of {args.num_papers} papers ...')
+  graph = synthetic_igbh(args.num_papers, args.feat_dim, args.num_classes, args.skew,
+                         torch.float16 if args.use_fp16 else torch.float32, args.random_seed)
+  for etype, edge_index in graph[1].items():
+    print(f'-- {etype}: {edge_index.size(1)} edges')
+  seeds = torch.randint(args.num_papers, ((args.warmup_batches + args.num_batches) * args.batch_size,),
+                        generator=torch.Generator().manual_seed(args.random_seed))
+  if 'dist' in args.loaders:
+    glt.distributed.init_worker_group(world_size=1, rank=0, group_name='igbh-sampling-benchmark')
+
+  master_port = args.master_port
+  for layout in args.layouts:
+    edge_dir = {'CSC': 'in', 'CSR': 'out'}.get(layout, args.edge_dir)
+    for loader_name in args.loaders:
+      dataset = build_dataset(graph, layout, edge_dir, distributed=loader_name == 'dist')
+      for fan_out in args.fan_outs:
+        num_neighbors = [int(fanout) for fanout in fan_out.split(',')]
+        for num_workers in (args.num_workers if loader_name == 'dist' else [0]):
+          if loader_name == 'neighbor':
+            loader = glt.loader.NeighborLoader(
+              data=dataset,
+              num_neighbors=num_neighbors,
+              input_nodes=('paper', seeds),
+              batch_size=args.batch_size,
+              shuffle=False,
+              drop_last=False,
+              device=torch.device('cpu'),
+              seed=args.random_seed
+            )
+          else:
+            loader = glt.distributed.DistNeighborLoader(
+              data=dataset,
+              num_neighbors=num_neighbors,
+              input_nodes=('paper', seeds),
+              batch_size=args.batch_size,
+              shuffle=False,
+              drop_last=False,
+              edge_dir=edge_dir,
+              collect_features=True,
+              to_device=torch.device('cpu'),
+              random_seed=args.random_seed,
+              worker_options=glt.distributed.MpDistSamplingWorkerOptions(
+                num_workers=num_workers,
+                worker_devices=[torch.device('cpu')] * num_workers,
+                worker_concurrency=args.worker_concurrency,
+                master_addr='localhost',
+                master_port=master_port,
+                channel_size=args.channel_size,
+                pin_memory=False
+              )
+            )
+            # a new port per loader, the previous one may still be in TIME_WAIT
+            master_port += 1
+          results = benchmark(loader, len(num_neighbors), args.num_batches, args.warmup_batches)
+          if loader_name == 'dist':
+            loader.shutdown()
+          print(f'{loader_name:>8} | {layout} {edge_dir:>3} | fan-out {fan_out:>10} | workers {num_workers} | ' +
+                ' | '.join(f'{name} {value:.4g}' for name, value in results.items()))
@@ -0,0 +1,123 @@
+import argparse, os
+import os.path as osp
+
+import graphlearn_torch as glt
+import torch
+
+from dataset import IGBHeteroDataset, load_topology
+
+# node types small enough to be replicated on every partition
+SMALL_NTYPES = ['institute', 'fos', 'journal', 'conference']
+
+def node_degrees(src_path, dataset_size, layout, num_nodes):
+  r""" Degree of every node summed over the edge types, from the indptr files
+  written by compress_graph.py. Every IGBH relation has a reverse edge type, so
+  the CSC and CSR files give the same degrees.
+  """
+  degree = {ntype: torch.zeros(num, dtype=torch.int64) for ntype, num in num_nodes.items()}
+  layout_dir = osp.join(src_path, dataset_size, 'processed', layout)
+  for etype_dir in sorted(os.listdir(layout_dir)):
+    src_type, _, dst_type = etype_dir.split('__')
+    indptr = load_topology(osp.join(layout_dir, etype_dir))[0]
+    degree[dst_type if layout == 'CSC' else src_type] += indptr[1:] - indptr[:-1]
+  return degree
+
+def build_feature_cache(src_path: str,
+                        dst_path: str,
+                        partition_idx: int,
+                        dataset_size: str='tiny',
+                        cache_budget: float=8.0,
+                        replicate_small_ntypes: bool=True,
+                        layout: str='CSC',
+                        use_fp16: bool=False):
+  r""" Caches the features of the remote nodes with the highest degree in
+  partition_idx, up to cache_budget GB, and of all remote nodes of the small
+  node types if replicate_small_ntypes. The cache is written next to the
+  partitioned features and merged into the local features by
+  DistDataset.load, so cached nodes are looked up locally.
+  """
+  print(f'-- Loading igbh_{dataset_size} ...')
+  data = IGBHeteroDataset(src_path, dataset_size, in_memory=False, with_edges=False, use_fp16=use_fp16)
+  partitions_dir = osp.join(dst_path, f'{dataset_size}-partitions')
+  node_feat_dtype = torch.float16 if use_fp16 else torch.float32
+  num_nodes = {ntype: feat.shape[0] for ntype, feat in data.feat_dict.items()}
+  row_bytes = {ntype: feat.shape[1] * torch.empty(0, dtype=node_feat_dtype).element_size() for ntype, feat in data.feat_dict.items()}
+  remote = {ntype: torch.load(osp.join(partitions_dir, 'node_pb', f'{ntype}.pt')) != partition_idx
+            for ntype in num_nodes}
+
+  budget = int(cache_budget * 1024**3)
+  cache_ids = {}
+  if replicate_small_ntypes:
+    for ntype in SMALL_NTYPES:
+      if ntype in num_nodes:
+        cache_ids[ntype] = remote[ntype].nonzero().squeeze(1)
+        budget -= cache_ids[ntype].numel() * row_bytes[ntype]
+    if budget < 0:
+      print(f'-- Replicating {SMALL_NTYPES} exceeds the cache budget by {-budget / 1024**3:.2f} GB')
+
+  print(f'-- Selecting the hottest remote nodes of partition {partition_idx} ...')
+  degree = node_degrees(src_path, dataset_size, layout, num_nodes)
+  hot_ntypes = [ntype for ntype in num_nodes if ntype not in cache_ids]
+  candidates = []
+  for ntype in hot_ntypes:
+    k = min(max(budget, 0) // row_bytes[ntype], int(remote[ntype].sum()))
+    hot_degree, hot_ids = torch.topk(degree[ntype].masked_fill(~remote[ntype], -1), k)
+    candidates.append((hot_degree, hot_ids, torch.full_like(hot_ids, row_bytes[ntype])))
+  hot_degree, hot_ids, hot_bytes = (torch.cat(t) for t in zip(*candidates))
+  hot_ntype = torch.cat([torch.full((c[1].numel(),), i) for i, c in enumerate(candidates)])
+  order = torch.argsort(hot_degree, descending=True)
+  selected = order[(torch.cumsum(hot_bytes[order], 0) <= budget) & (hot_degree[order] > 0)]
+  for i, ntype in enumerate(hot_ntypes):
+    cache_ids[ntype] = hot_ids[selected[hot_ntype[selected] == i]]
+
+  print(f'-- Saving the feature cache of partition {partition_idx} ...')
+  for ntype, ids in cache_ids.items():
+    if ids.numel() == 0:
+      continue
+    # sorted ids read the memory-mapped features sequentially
+    ids = torch.sort(ids).values
+    glt.partition.base.save_feature_partition_cache(
+      partitions_dir, partition_idx,
+      glt.typing.FeaturePartitionData(feats=None, ids=None,
+                                      cache_feats=data.feat_dict[ntype][ids].to(node_feat_dtype),
+                                      cache_ids=ids),
+      group='node_feat', graph_type=ntype)
+    # share of the edges to remote nodes of ntype, i.e. of the remote fetches, served by the cache
+    coverage = degree[ntype][ids].sum().item() / max(degree[ntype][remote[ntype]].sum().item(), 1)
+    print(f'-- {ntype}: cached {ids.numel()} nodes, {ids.numel() * row_bytes[ntype] / 1024**3:.2f} GB, '
+          f'covering {coverage:.2%} of the remote fetches')
+
+
+if __name__ == '__main__':
+  root = osp.join(osp.dirname(osp.dirname(osp.dirname(osp.realpath(__file__)))), 'data', 'igbh')
+  glt.utils.ensure_dir(root)
+  parser = argparse.ArgumentParser(description="Arguments for building the feature cache of a partition.")
+  parser.add_argument('--src_path', type=str, default=root,
+      help='path containing the datasets')
+  parser.add_argument('--dst_path', type=str, default=root,
+      help='path containing the partitioned datasets')
+  parser.add_argument('--dataset_size', type=str, default='full',
+      choices=['tiny', 'small', 'medium', 'large', 'full'],
+      help='size of the datasets')
+  parser.add_argument("--partition_idx", type=int, default=0,
+      help="Index of a partition")
+  parser.add_argument("--cache_budget", type=float, default=8.0,
+      help="Memory budget of the feature cache in GB")
+  parser.add_argument('--replicate_small_ntypes', type=int, default=1,
+      choices=[0, 1], help='1:cache all institute, fos, journal and conference nodes')
+  parser.add_argument("--layout", type=str, default='CSC',
+      help="layout of the graph written by compress_graph.py: CSC, CSR")
+  parser.add_argument("--use_fp16", action="store_true",
+      help="cache node feature in fp16 format, as the partitioned feature")
+  args = parser.parse_args()
+
+  build_feature_cache(
+    args.src_path,
+    args.dst_path,
+    partition_idx=args.partition_idx,
+    dataset_size=args.dataset_size,
+    cache_budget=args.cache_budget,
+    replicate_small_ntypes=args.replicate_small_ntypes==1,
+    layout=args.layout,
+    use_fp16=args.use_fp16
+  )
@@ -1,10 +1,15 @@
-import argparse
+import argparse, os, pickle
+import multiprocessing as mp
 import os.path as osp
 
 import graphlearn_torch as glt
 import torch
 
-from dataset import IGBHeteroDataset
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataset import IGBHeteroDataset, float2half
+
+# source dataset of a worker process of partition_feature_parallel
+worker_data = None
 
 
 def partition_feature(src_path: str,
@@ -26,6 +31,73 @@ def partition_feature(src_path: str,
                                              node_feat = data.feat_dict,
                                              node_feat_dtype = node_feat_dtype)
 
+def init_worker(src_path, dataset_size, use_fp16):
+  global worker_data
+  # the source features are memory-mapped read-only, so the workers share them in the page cache
+  worker_data = IGBHeteroDataset(src_path, dataset_size, in_memory=False, with_edges=False, use_fp16=use_fp16)
+
+def build_feature_shard(partitions_dir, partition_idx, ntype, chunk_size, node_feat_dtype):
+  r""" Writes the features of the ntype nodes of partition_idx in the format of
+  glt.partition.base.build_partition_feature. The files are written under
+  temporary names and renamed once complete, so a shard with a feats.pkl is
+  complete and is skipped when a run is resumed. Returns the number of nodes
+  written, None if the shard was already built.
+  """
+  subdir = osp.join(partitions_dir, f'part{partition_idx}', 'node_feat', ntype)
+  if osp.exists(osp.join(subdir, 'feats.pkl')):
+    return None
+  glt.utils.ensure_dir(subdir)
+  node_pb = torch.load(osp.join(partitions_dir, 'node_pb', f'{ntype}.pt'))
+  ids = (node_pb == partition_idx).nonzero().squeeze(1)
+  feat = worker_data.feat_dict[ntype]
+  with open(osp.join(subdir, 'feats.pkl.partial'), 'wb') as feats_file, \
+       open(osp.join(subdir, 'ids.pkl.partial'), 'wb') as ids_file:
+    for chunk in ids.split(chunk_size):
+      pickle.dump(feat[chunk].to(node_feat_dtype), feats_file)
+      pickle.dump(chunk.clone(), ids_file)
+  # feats.pkl marks a complete shard, so it is renamed last
+  os.replace(osp.join(subdir, 'ids.pkl.partial'), osp.join(subdir, 'ids.pkl'))
+  os.replace(osp.join(subdir, 'feats.pkl.partial'), osp.join(subdir, 'feats.pkl'))
+  return ids.numel()
+
+def partition_feature_parallel(src_path: str,
+                               dst_path: str,
+                               chunk_size: int,
+                               dataset_size: str='tiny',
+                               use_fp16: bool=False,
+                               num_workers: int=8,
+                               partition_idxs=None):
+  r""" Builds the features of partition_idxs, all partitions by default, from
+  the node partition books written by partition.py --with_feature=0. Every
+  partition and node type is a task of a pool of num_workers processes, the
+  largest node types first. Shards completed by an interrupted run are kept.
+  """
+  partitions_dir = osp.join(dst_path, f'{dataset_size}-partitions')
+  with open(osp.join(partitions_dir, 'META'), 'rb') as infile:
+    num_partitions = pickle.load(infile)['num_parts']
+  if partition_idxs is None:
+    partition_idxs = range(num_partitions)
+  node_pb_dir = osp.join(partitions_dir, 'node_pb')
+  ntypes = sorted((f[:-len('.pt')] for f in os.listdir(node_pb_dir)),
+                  key=lambda ntype: -osp.getsize(osp.join(node_pb_dir, f'{ntype}.pt')))
+  node_feat_dtype = torch.float16 if use_fp16 else torch.float32
+  if use_fp16:
+    # converted once here, the workers only open the finished fp16 files
+    float2half(osp.join(src_path, dataset_size, 'processed'), dataset_size)
+
+  print(f'-- Building features of partitions {list(partition_idxs)} on {num_workers} workers ...')
+  with ProcessPoolExecutor(num_workers, mp_context=mp.get_context('spawn'), initializer=init_worker,
+                           initargs=(src_path, dataset_size, use_fp16)) as pool:
+    futures = {pool.submit(build_feature_shard, partitions_dir, pidx, ntype, chunk_size, node_feat_dtype): (pidx, ntype)
+               for ntype in ntypes for pidx in partition_idxs}
+    for future in as_completed(futures):
+      pidx, ntype = futures[future]
+      num_nodes = future.result()
+      if num_nodes is None:
+        print(f'-- Partition {pidx} {ntype}: already built')
+      else:
+        print(f'-- Partition {pidx} {ntype}: {num_nodes} nodes')
+
 
 if __name__ == '__main__':
   root = osp.join(osp.dirname(osp.dirname(osp.dirname(osp.realpath(__file__)))), 'data', 'igbh')
@@ -41,7 +113,10 @@ if __name__ == '__main__':
   parser.add_argument('--in_memory', type=int, default=0,
       choices=[0, 1], help='0:read only mmap_mode=r, 1:load into memory')
   parser.add_argument("--partition_idx", type=int, default=0,
-      help="Index of a partition")
+      help="Index of a partition, -1 for all partitions with --num_workers")
+  parser.add_argument("--num_workers", type=int, default=0,
+      help="Number of processes building the features of each partition and node type "
+           "concurrently, resuming interrupted runs. 0 builds --partition_idx in this process.")
   parser.add_argument("--chunk_size", type=int, default=10000,
       help="Chunk size for feature partitioning.")
   parser.add_argument("--use_fp16", action="store_true",
@@ -50,12 +125,23 @@ if __name__ == '__main__':
 
   args = parser.parse_args()
 
-  partition_feature(
-    args.src_path,
-    args.dst_path,
-    partition_idx=args.partition_idx,
-    chunk_size=args.chunk_size,
-    dataset_size=args.dataset_size,
-    in_memory=args.in_memory==1,
-    use_fp16=args.use_fp16
-  )
+  if args.num_workers > 0:
+    partition_feature_parallel(
+      args.src_path,
+      args.dst_path,
+      chunk_size=args.chunk_size,
+      dataset_size=args.dataset_size,
+      use_fp16=args.use_fp16,
+      num_workers=args.num_workers,
+      partition_idxs=None if args.partition_idx < 0 else [args.partition_idx]
+    )
+  else:
+    partition_feature(
+      args.src_path,
+      args.dst_path,
+      partition_idx=args.partition_idx,
+      chunk_size=args.chunk_size,
+      dataset_size=args.dataset_size,
+      in_memory=args.in_memory==1,
+      use_fp16=args.use_fp16
+    )
@@ -5,7 +5,7 @@ import os.path as osp
 
 import graphlearn_torch as glt
 
-from dataset import float2half
+from dataset import float2half, save_topology
 from download import download_dataset
 from torch_geometric.utils import add_self_loops, remove_self_loops
 from typing import Literal
@@ -87,10 +87,7 @@ class IGBHeteroDatasetCompress(object):
       graph = glt_dataset.get_graph(etype)
       indptr, indices, _ = graph.export_topology()
       path = os.path.join(self.dir, self.dataset_size, 'processed', self.layout, compress_edge_dict[etype])
-      if not os.path.exists(path):
-        os.makedirs(path)
-      torch.save(indptr, os.path.join(path, 'indptr.pt'))
-      torch.save(indices, os.path.join(path, 'indices.pt'))
+      save_topology(path, indptr, indices)
     path = os.path.join(self.dir, self.dataset_size, 'processed', self.layout)
     print(f"The {self.layout} graph has been persisted in path: {path}")
 
@@ -108,12 +105,16 @@ if __name__ == '__main__':
   parser.add_argument("--layout", type=str, default='CSC')
   parser.add_argument('--use_fp16', action="store_true",
     help="convert the node/edge feature into fp16 format")
+  parser.add_argument('--fp16_chunk_rows', type=int, default=65536,
+    help="number of feature rows converted to fp16 at a time")
+  parser.add_argument('--fp16_num_threads', type=int, default=8,
+    help="number of threads converting the feature to fp16")
   args = parser.parse_args()
   print(f"Start constructing the {args.layout} graph...")
   igbh_dataset = IGBHeteroDatasetCompress(args.path, args.dataset_size, args.layout)
   if args.use_fp16:
     base_path = osp.join(args.path, args.dataset_size, 'processed')
-    float2half(base_path, args.dataset_size)
+    float2half(base_path, args.dataset_size, args.fp16_chunk_rows, args.fp16_num_threads)
   
 
 
@@ -1,70 +1,138 @@
+import json
 import numpy as np
+import os
 import torch
 import os.path as osp
 
+from concurrent.futures import ThreadPoolExecutor
 from torch_geometric.utils import add_self_loops, remove_self_loops
 from download import download_dataset
 from typing import Literal
 
-def float2half(base_path, dataset_size):
-  paper_nodes_num = {'tiny':100000, 'small':1000000, 'medium':10000000, 'large':100000000, 'full':269346174}
-  author_nodes_num = {'tiny':357041, 'small':1926066, 'medium':15544654, 'large':116959896, 'full':277220883}
-  # paper node
-  paper_feat_path = osp.join(base_path, 'paper', 'node_feat.npy')
-  paper_fp16_feat_path = osp.join(base_path, 'paper', 'node_feat_fp16.pt')
-  if not osp.exists(paper_fp16_feat_path):
-    if dataset_size in ['large', 'full']:
-      num_paper_nodes = paper_nodes_num[dataset_size]
-      paper_node_features = torch.from_numpy(np.memmap(paper_feat_path, dtype='float32', mode='r', shape=(num_paper_nodes,1024)))
-    else:
-      paper_node_features = torch.from_numpy(np.load(paper_feat_path, mmap_mode='r'))
-    paper_node_features = paper_node_features.half()
-    torch.save(paper_node_features, paper_fp16_feat_path)
+paper_nodes_num = {'tiny':100000, 'small':1000000, 'medium':10000000, 'large':100000000, 'full':269346174}
+author_nodes_num = {'tiny':357041, 'small':1926066, 'medium':15544654, 'large':116959896, 'full':277220883}
 
-  # author node
-  author_feat_path = osp.join(base_path, 'author', 'node_feat.npy')
-  author_fp16_feat_path = osp.join(base_path, 'author', 'node_feat_fp16.pt')
-  if not osp.exists(author_fp16_feat_path):
-    if dataset_size in ['large', 'full']:
-      num_author_nodes = author_nodes_num[dataset_size]
-      author_node_features = torch.from_numpy(np.memmap(author_feat_path, dtype='float32', mode='r', shape=(num_author_nodes,1024)))
-    else:
-      author_node_features = torch.from_numpy(np.load(author_feat_path, mmap_mode='r'))
-    author_node_features = author_node_features.half()
-    torch.save(author_node_features, author_fp16_feat_path)
+def node_feat_memmap(base_path, dataset_size, node_type):
+  feat_path = osp.join(base_path, node_type, 'node_feat.npy')
+  # paper and author features of large and full are raw float32 files without a npy header
+  if dataset_size in ['large', 'full'] and node_type in ['paper', 'author']:
+    num_nodes = paper_nodes_num[dataset_size] if node_type == 'paper' else author_nodes_num[dataset_size]
+    return np.memmap(feat_path, dtype='float32', mode='r', shape=(num_nodes, 1024))
+  return np.load(feat_path, mmap_mode='r')
 
-  # institute node
-  institute_feat_path = osp.join(base_path, 'institute', 'node_feat.npy')
-  institute_fp16_feat_path = osp.join(base_path, 'institute', 'node_feat_fp16.pt')
-  if not osp.exists(institute_fp16_feat_path):
-    institute_node_features = torch.from_numpy(np.load(institute_feat_path, mmap_mode='r'))
-    institute_node_features = institute_node_features.half()
-    torch.save(institute_node_features, institute_fp16_feat_path)
+def legacy_fp16_node_feat(base_path, node_type):
+  r""" Path of the fp16 features written by earlier versions of float2half, if
+  there is no npy file to use instead.
+  """
+  legacy_path = osp.join(base_path, node_type, 'node_feat_fp16.pt')
+  if not osp.exists(osp.join(base_path, node_type, 'node_feat_fp16.npy')) and osp.exists(legacy_path):
+    return legacy_path
+  return None
 
-  # fos node
-  fos_feat_path = osp.join(base_path, 'fos', 'node_feat.npy')
-  fos_fp16_feat_path = osp.join(base_path, 'fos', 'node_feat_fp16.pt')
-  if not osp.exists(fos_fp16_feat_path):
-    fos_node_features = torch.from_numpy(np.load(fos_feat_path, mmap_mode='r'))
-    fos_node_features = fos_node_features.half()
-    torch.save(fos_node_features, fos_fp16_feat_path)
-    
+def load_fp16_node_feat(base_path, node_type):
+  legacy_path = legacy_fp16_node_feat(base_path, node_type)
+  if legacy_path is not None:
+    return torch.load(legacy_path)
+  return torch.from_numpy(np.load(osp.join(base_path, node_type, 'node_feat_fp16.npy'), mmap_mode='r'))
+
+def convert_to_half(node_features, fp16_feat_path, chunk_rows=1 << 16, num_threads=8):
+  r""" Converts float32 node_features to a float16 npy file, chunk_rows rows at a
+  time on num_threads threads. Converted chunks are recorded in a progress file
+  after being flushed, so an interrupted conversion resumes where it stopped. The
+  file is renamed to fp16_feat_path once complete.
+  """
+  partial_path = fp16_feat_path + '.partial'
+  progress_path = fp16_feat_path + '.progress'
+  num_chunks = (node_features.shape[0] + chunk_rows - 1) // chunk_rows
+  done = set()
+  if osp.exists(partial_path) and osp.exists(progress_path):
+    with open(progress_path) as f:
+      progress = json.load(f)
+    if progress['shape'] == list(node_features.shape) and progress['chunk_rows'] == chunk_rows:
+      done = set(progress['done'])
+  if done:
+    fp16_features = np.lib.format.open_memmap(partial_path, mode='r+')
+  else:
+    fp16_features = np.lib.format.open_memmap(partial_path, mode='w+', dtype=np.float16, shape=node_features.shape)
+
+  def convert(chunk_idx):
+    rows = slice(chunk_idx * chunk_rows, (chunk_idx + 1) * chunk_rows)
+    fp16_features[rows] = node_features[rows]
+    return chunk_idx
+
+  def save_progress():
+    fp16_features.flush()
+    with open(progress_path + '.tmp', 'w') as f:
+      json.dump({'shape': list(node_features.shape), 'chunk_rows': chunk_rows, 'done': sorted(done)}, f)
+    os.replace(progress_path + '.tmp', progress_path)
+
+  todo = [chunk_idx for chunk_idx in range(num_chunks) if chunk_idx not in done]
+  with ThreadPoolExecutor(num_threads) as pool:
+    for i, chunk_idx in enumerate(pool.map(convert, todo)):
+      done.add(chunk_idx)
+      if (i + 1) % (4 * num_threads) == 0:
+        save_progress()
+  fp16_features.flush()
+  del fp16_features
+  os.replace(partial_path, fp16_feat_path)
+  if osp.exists(progress_path):
+    os.remove(progress_path)
+
+def float2half(base_path, dataset_size, chunk_rows=1 << 16, num_threads=8):
+  node_types = ['paper', 'author', 'institute', 'fos']
   if dataset_size in ['large', 'full']:
-    # conference node
-    conference_feat_path = osp.join(base_path, 'conference', 'node_feat.npy')
-    conference_fp16_feat_path = osp.join(base_path, 'conference', 'node_feat_fp16.pt')
-    if not osp.exists(conference_fp16_feat_path):
-      conference_node_features = torch.from_numpy(np.load(conference_feat_path, mmap_mode='r'))
-      conference_node_features = conference_node_features.half()
-      torch.save(conference_node_features, conference_fp16_feat_path)
+    node_types += ['conference', 'journal']
+  for node_type in node_types:
+    fp16_feat_path = osp.join(base_path, node_type, 'node_feat_fp16.npy')
+    # the fp16 features of earlier versions are loaded as they are
+    if not osp.exists(fp16_feat_path) and legacy_fp16_node_feat(base_path, node_type) is None:
+      node_features = node_feat_memmap(base_path, dataset_size, node_type)
+      convert_to_half(node_features, fp16_feat_path, chunk_rows, num_threads)
+
+def save_topology(path, indptr, indices, chunk_size=1 << 26):
+  r""" Saves a CSC or CSR topology as npy files that load_topology memory-maps
+  without deserialization. indptr is stored as int64, indices as int32 when
+  all node ids fit, which halves their size.
+  """
+  os.makedirs(path, exist_ok=True)
+  np.save(osp.join(path, 'indptr.npy'), indptr.numpy().astype(np.int64, copy=False))
+  indices = indices.numpy()
+  narrow = indices.size == 0 or indices.max() <= np.iinfo(np.int32).max
+  out = np.lib.format.open_memmap(osp.join(path, 'indices.npy'), mode='w+',
+                                  dtype=np.int32 if narrow else np.int64, shape=indices.shape)
+  # converted in chunks, so that narrowing does not copy all indices at once
+  for start in range(0, indices.size, chunk_size):
+    out[start:start + chunk_size] = indices[start:start + chunk_size]
+  out.flush()
+
+def load_topology(path):
+  r""" (indptr, indices) written by compress_graph.py in path. The npy files of
+  save_topology are memory-mapped, so only the pages read are loaded; indices
+  may be int32. The pt files of earlier versions are loaded with torch.load.
+  """
+  if not osp.exists(osp.join(path, 'indptr.npy')) and osp.exists(osp.join(path, 'indptr.pt')):
+    return torch.load(osp.join(path, 'indptr.pt')), torch.load(osp.join(path, 'indices.pt'))
+  return (torch.from_numpy(np.load(osp.join(path, 'indptr.npy'), mmap_mode='r')),
+          torch.from_numpy(np.load(osp.join(path, 'indices.npy'), mmap_mode='r')))
 
-    # journal node
-    journal_feat_path = osp.join(base_path, 'journal', 'node_feat.npy')
-    journal_fp16_feat_path = osp.join(base_path, 'journal', 'node_feat_fp16.pt')
-    if not osp.exists(journal_fp16_feat_path):
-      journal_node_features = torch.from_numpy(np.load(journal_feat_path, mmap_mode='r'))
-      journal_node_features = journal_node_features.half()
-      torch.save(journal_node_features, journal_fp16_feat_path)
+def load_csc(data, etype, num_dst):
+  r""" CSC topology (indptr, indices) of etype of an IGBHeteroDataset, as
+  loaded with the CSC layout, written by compress_graph.py, or built from the
+  COO edge index.
+  """
+  if data.layout == 'CSC':
+    indices, indptr = data.edge_dict[etype]
+    return indptr, indices
+  path = osp.join(data.base_path, 'CSC', '__'.join(etype))
+  if osp.exists(osp.join(path, 'indptr.npy')) or osp.exists(osp.join(path, 'indptr.pt')):
+    return load_topology(path)
+  assert data.layout == 'COO', f"CSC files of {etype} not found, run compress_graph.py --layout='CSC'"
+  src, dst = data.edge_dict[etype][0], data.edge_dict[etype][1]
+  dst = torch.as_tensor(dst, dtype=torch.int64)
+  order = torch.argsort(dst)
+  indptr = torch.zeros(num_dst + 1, dtype=torch.int64)
+  indptr[1:] = torch.cumsum(torch.bincount(dst, minlength=num_dst), 0)
+  return indptr, torch.as_tensor(src, dtype=torch.int64)[order]
 
 class IGBHeteroDataset(object):
   def __init__(self,
@@ -87,8 +155,8 @@ class IGBHeteroDataset(object):
     self.etypes = None
     self.edge_dict = {}
     self.feat_dict = {}
-    self.paper_nodes_num = {'tiny':100000, 'small':1000000, 'medium':10000000, 'large':100000000, 'full':269346174}
-    self.author_nodes_num = {'tiny':357041, 'small':1926066, 'medium':15544654, 'large':116959896, 'full':277220883}
+    self.paper_nodes_num = paper_nodes_num
+    self.author_nodes_num = author_nodes_num
     # 'paper' nodes.
     self.label = None
     self.train_idx = None
@@ -170,8 +238,7 @@ class IGBHeteroDataset(object):
           edge_path = osp.join(self.base_path, self.layout, compress_edge_dict[etype])
           try:
             edge_path = osp.join(self.base_path, self.layout, compress_edge_dict[etype])
-            indptr = torch.load(osp.join(edge_path, 'indptr.pt'))
-            indices = torch.load(osp.join(edge_path, 'indices.pt'))
+            indptr, indices = load_topology(edge_path)
             if self.layout == 'CSC':
               self.edge_dict[etype] = (indices, indptr)
             else:
@@ -189,11 +256,10 @@ class IGBHeteroDataset(object):
     paper_feat_path = osp.join(self.base_path, 'paper', 'node_feat.npy')
     paper_lbl_path = osp.join(self.base_path, 'paper', label_file)
     num_paper_nodes = self.paper_nodes_num[self.dataset_size]
-    if self.in_memory:
-      if self.use_fp16:
-        paper_node_features = torch.load(osp.join(self.base_path, 'paper', 'node_feat_fp16.pt'))
-      else:
-        paper_node_features = torch.from_numpy(np.load(paper_feat_path))
+    if self.use_fp16:
+      paper_node_features = load_fp16_node_feat(self.base_path, 'paper')
+    elif self.in_memory:
+      paper_node_features = torch.from_numpy(np.load(paper_feat_path))
     else:
       if self.dataset_size in ['large', 'full']:
         paper_node_features = torch.from_numpy(np.memmap(paper_feat_path, dtype='float32', mode='r', shape=(num_paper_nodes,1024)))
@@ -208,11 +274,10 @@ class IGBHeteroDataset(object):
 
     num_author_nodes = self.author_nodes_num[self.dataset_size]
     author_feat_path = osp.join(self.base_path, 'author', 'node_feat.npy')
-    if self.in_memory:
-      if self.use_fp16:
-        author_node_features = torch.load(osp.join(self.base_path, 'author', 'node_feat_fp16.pt'))
-      else:  
-        author_node_features = torch.from_numpy(np.load(author_feat_path))
+    if self.use_fp16:
+      author_node_features = load_fp16_node_feat(self.base_path, 'author')
+    elif self.in_memory:
+      author_node_features = torch.from_numpy(np.load(author_feat_path))
     else:
       if self.dataset_size in ['large', 'full']:
         author_node_features = torch.from_numpy(np.memmap(author_feat_path, dtype='float32', mode='r', shape=(num_author_nodes,1024)))
@@ -220,39 +285,35 @@ class IGBHeteroDataset(object):
         author_node_features = torch.from_numpy(np.load(author_feat_path, mmap_mode='r'))
     self.feat_dict['author'] = author_node_features
 
-    if self.in_memory:
-      if self.use_fp16:
-        institute_node_features = torch.load(osp.join(self.base_path, 'institute', 'node_feat_fp16.pt'))
-      else:
-        institute_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'institute', 'node_feat.npy')))
+    if self.use_fp16:
+      institute_node_features = load_fp16_node_feat(self.base_path, 'institute')
+    elif self.in_memory:
+      institute_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'institute', 'node_feat.npy')))
     else:
       institute_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'institute', 'node_feat.npy'), mmap_mode='r'))
     self.feat_dict['institute'] = institute_node_features
 
-    if self.in_memory:
-      if self.use_fp16:
-        fos_node_features = torch.load(osp.join(self.base_path, 'fos', 'node_feat_fp16.pt'))
-      else:
-        fos_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'fos', 'node_feat.npy')))
+    if self.use_fp16:
+      fos_node_features = load_fp16_node_feat(self.base_path, 'fos')
+    elif self.in_memory:
+      fos_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'fos', 'node_feat.npy')))
     else:
       fos_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'fos', 'node_feat.npy'), mmap_mode='r'))
     self.feat_dict['fos'] = fos_node_features
 
     if self.dataset_size in ['large', 'full']:
-      if self.in_memory:
-        if self.use_fp16:
-          conference_node_features = torch.load(osp.join(self.base_path, 'conference', 'node_feat_fp16.pt'))
-        else:
-          conference_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'conference', 'node_feat.npy')))
+      if self.use_fp16:
+        conference_node_features = load_fp16_node_feat(self.base_path, 'conference')
+      elif self.in_memory:
+        conference_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'conference', 'node_feat.npy')))
       else:
         conference_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'conference', 'node_feat.npy'), mmap_mode='r'))
       self.feat_dict['conference'] = conference_node_features
       
-      if self.in_memory:
-        if self.use_fp16:
-          journal_node_features = torch.load(osp.join(self.base_path, 'journal', 'node_feat_fp16.pt'))
-        else:
-          journal_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'journal', 'node_feat.npy')))
+      if self.use_fp16:
+        journal_node_features = load_fp16_node_feat(self.base_path, 'journal')
+      elif self.in_memory:
+        journal_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'journal', 'node_feat.npy')))
       else:
         journal_node_features = torch.from_numpy(np.load(osp.join(self.base_path, 'journal', 'node_feat.npy'), mmap_mode='r'))
       self.feat_dict['journal'] = journal_node_features
@@ -4,7 +4,6 @@ import time, tqdm
 
 import graphlearn_torch as glt
 import mlperf_logging.mllog.constants as mllog_constants
-import numpy as np
 import sklearn.metrics
 import torch
 import torch.distributed
@@ -13,46 +12,58 @@ from mlperf_logging_utils import get_mlperf_logger, submission_info
 from torch.nn.parallel import DistributedDataParallel
 from utilities import create_ckpt_folder
 from rgnn import RGNN
+from seed_scheduler import BalancedSeedBatches, balanced_split
 
 mllogger = get_mlperf_logger(path=osp.dirname(osp.abspath(__file__)))
 
-def evaluate(model, dataloader, current_device, use_fp16, with_gpu, 
+class FeatureCacheCounter(object):
+  r""" Counts the sampled nodes whose features are stored in the partition,
+  in its feature cache (see build_feature_cache.py) or on remote partitions.
+  """
+  def __init__(self, dataset, device):
+    # 2: stored in the partition, 1: cached, 0: remote
+    self.locality = {
+      ntype: ((dataset.node_pb[ntype] == dataset.partition_idx).to(torch.int8) +
+              (dataset.node_feat_pb[ntype] == dataset.partition_idx).to(torch.int8)).to(device)
+      for ntype in dataset.get_node_types()
+    }
+    self.counts = torch.zeros(3, dtype=torch.int64, device=device)
+
+  def update(self, batch):
+    for ntype in batch.node_types:
+      self.counts += torch.bincount(self.locality[ntype][batch[ntype].node], minlength=3)
+
+  def summary(self):
+    remote, cached, local = (self.counts / self.counts.sum().clamp(min=1)).tolist()
+    self.counts.zero_()
+    return "Local {:.2%} | Cached {:.2%} | Remote {:.2%}".format(local, cached, remote)
+
+def evaluate(model, dataloader, current_device,
              rank, world_size, epoch_num):
   if rank == 0:
     mllogger.start(
         key=mllog_constants.EVAL_START,
         metadata={mllog_constants.EPOCH_NUM: epoch_num},
     )
-  predictions = []
-  labels = []
+  # number of correct predictions and of evaluated seeds
+  counts = torch.zeros(2, dtype=torch.int64, device=current_device)
   with torch.no_grad():
     for batch in tqdm.tqdm(dataloader):
       batch_size = batch['paper'].batch_size
-      if use_fp16:
-        x_dict = {node_name: node_feat.to(current_device).to(torch.float32)
-                  for node_name, node_feat in batch.x_dict.items()}
-      else:
-        x_dict = {node_name: node_feat.to(current_device)
-                  for node_name, node_feat in batch.x_dict.items()}
-      out = model(x_dict,
+      out = model(batch.x_dict,
                   batch.edge_index_dict,
                   num_sampled_nodes_dict=batch.num_sampled_nodes,
                   num_sampled_edges_dict=batch.num_sampled_edges)[:batch_size]
       batch_size = min(out.shape[0], batch_size)
-      labels.append(batch['paper'].y[:batch_size].cpu().clone().numpy())
-      predictions.append(out.argmax(1).cpu().clone().numpy())
-
-    predictions = np.concatenate(predictions)
-    labels = np.concatenate(labels)
-    acc = sklearn.metrics.accuracy_score(labels, predictions)
-
-    if with_gpu:
-      torch.cuda.synchronize()
-    torch.distributed.barrier()
+      counts[0] += (out.argmax(1) == batch['paper'].y[:batch_size].to(current_device)).sum()
+      counts[1] += batch_size
 
-    acc_tensor = torch.tensor(acc).to(current_device)
-    torch.distributed.all_reduce(acc_tensor, op=torch.distributed.ReduceOp.SUM)    
-    global_acc = acc_tensor.item() / world_size
+    # ranks evaluate different numbers of seeds, so counts are summed rather than accuracies averaged
+    rank_counts = counts.clone()
+    torch.distributed.all_reduce(counts, op=torch.distributed.ReduceOp.SUM)
+    correct, seen, rank_correct, rank_seen = torch.cat([counts, rank_counts]).tolist()
+    acc = rank_correct / max(rank_seen, 1)
+    global_acc = correct / seen
     if rank == 0:
       mllogger.event(
           key=mllog_constants.EVAL_ACCURACY,
@@ -77,10 +88,11 @@ def run_training_proc(local_proc_rank, num_nodes, node_rank, num_training_procs,
     training_pg_master_port,
     train_loader_master_port,
     val_loader_master_port,
-    with_gpu, trim_to_layer, use_fp16,
+    with_gpu, trim_to_layer,
     edge_dir, rpc_timeout,
     validation_acc, validation_frac_within_epoch, evaluate_on_epoch_end, 
-    checkpoint_on_epoch_end, ckpt_steps, ckpt_path):
+    checkpoint_on_epoch_end, ckpt_steps, ckpt_path, feature_cache_stats,
+    train_seed_cost, balance_window_batches):
 
   world_size=num_nodes*num_training_procs
   rank=node_rank*num_training_procs+local_proc_rank
@@ -119,13 +131,24 @@ def run_training_proc(local_proc_rank, num_nodes, node_rank, num_training_procs,
   )
 
   # Create distributed neighbor loader for training
-  train_idx = train_idx.split(train_idx.size(0) // num_training_procs)[local_proc_rank]
+  seed_batches = None
+  if train_seed_cost is not None:
+    # the same split on every process of the node, of equal expected sampled edges
+    part = balanced_split(train_seed_cost, num_training_procs, torch.Generator().manual_seed(random_seed))[local_proc_rank]
+    train_idx = train_idx[part]
+    seed_batches = BalancedSeedBatches(train_idx, train_seed_cost[part], train_batch_size,
+                                       balance_window_batches, random_seed)
+    # reordered in place for each epoch, the sampling workers read the order
+    # from shared memory as it is
+    train_idx = train_idx.clone().share_memory_()
+  else:
+    train_idx = train_idx.split(train_idx.size(0) // num_training_procs)[local_proc_rank]
   train_loader = glt.distributed.DistNeighborLoader(
     data=dataset,
     num_neighbors=[int(fanout) for fanout in fan_out.split(',')],
     input_nodes=('paper', train_idx),
     batch_size=train_batch_size,
-    shuffle=True,
+    shuffle=seed_batches is None,
     drop_last=False,
     edge_dir=edge_dir,
     collect_features=True,
@@ -212,6 +235,7 @@ def run_training_proc(local_proc_rank, num_nodes, node_rank, num_training_procs,
   if ckpt is not None:
     optimizer.load_state_dict(ckpt['optimizer_state_dict'])
   batch_num = (len(train_idx) + train_batch_size - 1) // train_batch_size
+  cache_counter = FeatureCacheCounter(dataset, current_device) if feature_cache_stats else None
   validation_freq = int(batch_num * validation_frac_within_epoch)
   is_success = False
   epoch_num = 0
@@ -229,16 +253,14 @@ def run_training_proc(local_proc_rank, num_nodes, node_rank, num_training_procs,
     idx = 0
     gpu_mem_alloc = 0
     epoch_start = time.time()
+    if seed_batches is not None:
+      train_idx.copy_(seed_batches.order(epoch))
     for batch in tqdm.tqdm(train_loader):
       idx += 1
+      if cache_counter is not None:
+        cache_counter.update(batch)
       batch_size = batch['paper'].batch_size
-      if use_fp16:
-        x_dict = {node_name: node_feat.to(current_device).to(torch.float32)
-                  for node_name,node_feat in batch.x_dict.items()}
-      else:
-        x_dict = {node_name: node_feat.to(current_device)
-                  for node_name,node_feat in batch.x_dict.items()}
-      out = model(x_dict,
+      out = model(batch.x_dict,
                   batch.edge_index_dict,
                   num_sampled_nodes_dict=batch.num_sampled_nodes,
                   num_sampled_edges_dict=batch.num_sampled_edges)[:batch_size]
@@ -274,8 +296,7 @@ def run_training_proc(local_proc_rank, num_nodes, node_rank, num_training_procs,
         epoch_num = round((epoch + idx / batch_num), 2)
         model.eval()
         rank_val_acc, global_acc = evaluate(model, val_loader, current_device, 
-                                            use_fp16, with_gpu, rank, 
-                                            world_size, epoch_num)
+                                            rank, world_size, epoch_num)
         if validation_acc is not None and global_acc >= validation_acc:
           is_success = True
           break
@@ -293,6 +314,9 @@ def run_training_proc(local_proc_rank, num_nodes, node_rank, num_training_procs,
         key=mllog_constants.EPOCH_STOP,
         metadata={mllog_constants.EPOCH_NUM: epoch},
       )
+    if cache_counter is not None:
+      tqdm.tqdm.write("Rank{:02d} | Epoch {:03d} | Feature fetches: {}".format(
+          current_ctx.rank, epoch, cache_counter.summary()))
     
     #checkpoint at the end of epoch
     if checkpoint_on_epoch_end:
@@ -307,8 +331,7 @@ def run_training_proc(local_proc_rank, num_nodes, node_rank, num_training_procs,
       epoch_num = epoch + 1
       model.eval()
       rank_val_acc, global_acc = evaluate(model, val_loader, current_device, 
-                                          use_fp16, with_gpu, rank, world_size, 
-                                          epoch_num)
+                                          rank, world_size, epoch_num)
       if validation_acc is not None and global_acc >= validation_acc:
         is_success = True
     
@@ -399,7 +422,8 @@ if __name__ == '__main__':
   parser.add_argument("--with_trim", action="store_true",
       help="use trim_to_layer function from PyG")
   parser.add_argument("--use_fp16", action="store_true",
-      help="load node/edge feature using fp16 format to reduce memory usage")
+      help="the partitions hold fp16 node features, built with --use_fp16; RGNN casts them on device, "
+           "so this flag only documents the run")
   parser.add_argument("--validation_frac_within_epoch", type=float, default=0.05,
       help="Fraction of the epoch after which validation should be performed.")
   parser.add_argument("--validation_acc", type=float, default=0.72,
@@ -412,6 +436,13 @@ if __name__ == '__main__':
       help="Save checkpoint every n steps. Default is -1, which means no checkpoint is saved.")
   parser.add_argument('--ckpt_path', type=str, default=None, 
       help="Path to load checkpoint from. Default is None.")
+  parser.add_argument("--feature_cache_stats", action="store_true",
+      help="Report the share of sampled node features stored locally, in the feature cache and remotely.")
+  parser.add_argument("--balance_seed_batches", action="store_true",
+      help="Split and batch the training seeds so that processes and batches sample about equally many "
+           "edges, with the seed costs saved by partition.py --seed_cost_fan_out.")
+  parser.add_argument('--balance_window_batches', type=int, default=32,
+      help="Number of random batches whose seeds are balanced together.")
   args = parser.parse_args()
   assert args.layout in ['COO', 'CSC', 'CSR']
 
@@ -453,6 +484,11 @@ if __name__ == '__main__':
   )
   train_idx.share_memory_()
   val_idx.share_memory_()
+  train_seed_cost = None
+  if args.balance_seed_batches:
+    train_seed_cost = torch.load(
+      osp.join(args.path, f'{args.dataset_size}-train-partitions', f'partition{data_pidx}_cost.pt')
+    ).share_memory_()
 
   if args.node_rank == 0:
     mllogger.event(key=mllog_constants.TRAIN_SAMPLES, value=train_idx.size(0) * world_size)
@@ -475,7 +511,6 @@ if __name__ == '__main__':
           args.val_loader_master_port,
           args.with_gpu,
           args.with_trim,
-          args.use_fp16,
           args.edge_dir,
           args.rpc_timeout,
           args.validation_acc, 
@@ -483,7 +518,10 @@ if __name__ == '__main__':
           args.evaluate_on_epoch_end,
           args.checkpoint_on_epoch_end,
           args.ckpt_steps,
-          args.ckpt_path),
+          args.ckpt_path,
+          args.feature_cache_stats,
+          train_seed_cost,
+          args.balance_window_batches),
     nprocs=args.num_training_procs,
     join=True
   )
@@ -0,0 +1,71 @@
+import torch
+
+class FeatureCollator(object):
+  r""" Moves the node features of sampled batches to device in one transfer.
+
+  The features of all node types of a batch are gathered into a single pinned
+  staging buffer and copied to device with one non-blocking copy on a side
+  stream, which overlaps the step still running on the previous batch. The
+  features keep their dtype, fp16 or bf16 features are cast by RGNN on device.
+  num_slots pairs of staging and device buffers are used in turn: a slot is
+  refilled once its previous copy is done and the step that consumed it has
+  been issued on the compute stream. Features already on device, e.g. pinned
+  with --pin_feature, are returned as they are.
+
+  Args:
+    device: The training device.
+    num_slots: The number of batches whose features may be in flight.
+  """
+  def __init__(self, device, num_slots=2):
+    self.device = torch.device(device)
+    self.num_slots = num_slots
+    self.staging = [None] * num_slots
+    self.buffers = [None] * num_slots
+    self.copied = [None] * num_slots
+    self.released = [None] * num_slots
+    self.slot = 0
+    self.last_slot = None
+    if self.device.type == 'cuda':
+      self.stream = torch.cuda.Stream(self.device)
+
+  def __call__(self, x_dict):
+    if (self.device.type != 'cuda' or
+        any(x.is_cuda for x in x_dict.values()) or
+        len({x.dtype for x in x_dict.values()}) > 1):
+      return {ntype: x.to(self.device) for ntype, x in x_dict.items()}
+    compute_stream = torch.cuda.current_stream(self.device)
+    # everything issued since the last call consumed the features of last_slot
+    if self.last_slot is not None:
+      self.released[self.last_slot] = torch.cuda.Event()
+      self.released[self.last_slot].record(compute_stream)
+    slot = self.slot
+    self.slot = (slot + 1) % self.num_slots
+    self.last_slot = slot
+
+    dtype = next(iter(x_dict.values())).dtype
+    numel = sum(x.numel() for x in x_dict.values())
+    if self.copied[slot] is not None:
+      self.copied[slot].synchronize()
+    if (self.staging[slot] is None or self.staging[slot].dtype != dtype or
+        self.staging[slot].numel() < numel):
+      # with room for larger batches, as the number of sampled nodes varies
+      size = numel + numel // 4
+      self.staging[slot] = torch.empty(size, dtype=dtype, pin_memory=True)
+      self.buffers[slot] = torch.empty(size, dtype=dtype, device=self.device)
+    staging = self.staging[slot][:numel]
+    torch.cat([x.reshape(-1) for x in x_dict.values()], out=staging)
+
+    buffer = self.buffers[slot][:numel]
+    with torch.cuda.stream(self.stream):
+      if self.released[slot] is not None:
+        self.stream.wait_event(self.released[slot])
+      buffer.copy_(staging, non_blocking=True)
+      self.copied[slot] = torch.cuda.Event()
+      self.copied[slot].record(self.stream)
+    compute_stream.wait_event(self.copied[slot])
+
+    out, offset = {}, 0
+    for ntype, x in x_dict.items():
+      out[ntype] = buffer[offset:offset + x.numel()].view(x.shape)
+      offset += x.numel()
+    return out
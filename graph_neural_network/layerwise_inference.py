@@ -0,0 +1,128 @@
+import numpy as np
+import os.path as osp
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+
+def in_neighbors(indptr, indices, dst_ids):
+  r""" All in-neighbors of dst_ids in a CSC topology, and the in-degree of
+  each of dst_ids.
+  """
+  starts = indptr[dst_ids]
+  deg = indptr[dst_ids + 1] - starts
+  offsets = torch.repeat_interleave(starts - (torch.cumsum(deg, 0) - deg), deg)
+  offsets += torch.arange(offsets.numel())
+  return indices[offsets].long(), deg
+
+class LayerwiseInference(object):
+  r""" Full-neighborhood inference of an RGNN, one layer at a time.
+
+  Layer i computes the embeddings of all nodes needed by layer i + 1 from the
+  embeddings of layer i - 1, in chunks of chunk_size nodes of a type together
+  with all their in-neighbors. Every node is computed once per layer, instead
+  of once per sampled neighborhood containing it, and the result does not
+  depend on sampling. Intermediate embeddings are written to float16 npy
+  memmaps in embedding_dir, shared by the ranks, which each compute a
+  contiguous share of every layer.
+
+  Args:
+    csc: The CSC topology (indptr, indices) of each edge type.
+    seeds: The nodes of node_type to classify.
+    num_nodes: The number of nodes of each type.
+    num_layers: The number of conv layers of the model.
+    hidden_dim: The output dimension of the hidden conv layers.
+    embedding_dir: Directory of the intermediate embedding files.
+    chunk_size: The number of nodes computed at once.
+  """
+  def __init__(self, csc, seeds, num_nodes, num_layers, hidden_dim,
+               embedding_dir, chunk_size=65536, node_type='paper'):
+    self.csc = csc
+    self.num_layers = num_layers
+    self.chunk_size = chunk_size
+    self.node_type = node_type
+    # needed[i]: sorted ids of the nodes whose layer i embedding is needed
+    self.needed = [None] * (num_layers + 1)
+    self.needed[num_layers] = {node_type: torch.unique(seeds)}
+    for i in range(num_layers, 1, -1):
+      masks = {}
+      for ntype, ids in self.needed[i].items():
+        masks.setdefault(ntype, torch.zeros(num_nodes[ntype], dtype=torch.bool))[ids] = True
+      for etype, (indptr, indices) in csc.items():
+        if etype[2] not in self.needed[i]:
+          continue
+        mask = masks.setdefault(etype[0], torch.zeros(num_nodes[etype[0]], dtype=torch.bool))
+        for ids in self.needed[i][etype[2]].split(chunk_size):
+          mask[in_neighbors(indptr, indices, ids)[0]] = True
+      self.needed[i - 1] = {ntype: mask.nonzero().squeeze(1) for ntype, mask in masks.items()}
+    self.embedding_files = [None] * num_layers
+    for i in range(1, num_layers):
+      self.embedding_files[i] = {}
+      for ntype, ids in self.needed[i].items():
+        path = osp.join(embedding_dir, f'layer{i}_{ntype}.npy')
+        np.lib.format.open_memmap(path, mode='w+', dtype=np.float16, shape=(ids.numel(), hidden_dim))
+        self.embedding_files[i][ntype] = path
+
+  def _rank_share(self, ids, rank, world_size):
+    return ids[ids.numel() * rank // world_size:ids.numel() * (rank + 1) // world_size]
+
+  def _layer_input(self, i, features, embeddings, ntype, ids, device):
+    if i == 0:
+      return features[ntype][ids].to(device).to(torch.float32)
+    rows = torch.searchsorted(self.needed[i][ntype], ids).numpy()
+    return torch.from_numpy(embeddings[ntype][rows]).to(device).to(torch.float32)
+
+  def _conv_chunk(self, conv, i, features, embeddings, ntype, dst_ids, device):
+    r""" Layer i output of dst_ids of ntype. dst_ids come first in the nodes of
+    ntype, followed by the in-neighbors of ntype, as in a sampled batch.
+    """
+    nbrs, dsts = {}, {}
+    for etype, (indptr, indices) in self.csc.items():
+      if etype[2] == ntype:
+        nbrs[etype], deg = in_neighbors(indptr, indices, dst_ids)
+        dsts[etype] = torch.repeat_interleave(torch.arange(dst_ids.numel()), deg)
+    node_ids, edge_index_dict = {ntype: [dst_ids]}, {}
+    for src_type in dict.fromkeys(etype[0] for etype in nbrs):
+      etypes = [etype for etype in nbrs if etype[0] == src_type]
+      ids, src = torch.unique(torch.cat([nbrs[etype] for etype in etypes]), return_inverse=True)
+      if src_type == ntype:
+        src += dst_ids.numel()
+      node_ids.setdefault(src_type, []).append(ids)
+      for etype, etype_src in zip(etypes, src.split([nbrs[etype].numel() for etype in etypes])):
+        edge_index_dict[etype] = torch.stack([etype_src, dsts[etype]]).to(device)
+    x_dict = {t: self._layer_input(i, features, embeddings, t, torch.cat(ids), device)
+              for t, ids in node_ids.items()}
+    return conv(x_dict, edge_index_dict)[ntype][:dst_ids.numel()]
+
+  @torch.no_grad()
+  def __call__(self, model, features, labels, device, rank=0, world_size=1):
+    r""" Classifies the seeds of this rank with model, an RGNN in eval mode,
+    and returns the number of correct predictions and of seeds, on device.
+    features and labels are indexed by global node ids.
+    """
+    num_correct = torch.zeros((), dtype=torch.int64, device=device)
+    num_seeds = torch.zeros((), dtype=torch.int64, device=device)
+    embeddings = {}
+    for i, conv in enumerate(model.convs):
+      last = i == self.num_layers - 1
+      if not last:
+        outputs = {ntype: np.load(path, mmap_mode='r+') for ntype, path in self.embedding_files[i + 1].items()}
+      for ntype, ids in self.needed[i + 1].items():
+        share = self._rank_share(ids, rank, world_size)
+        start = ids.numel() * rank // world_size
+        for dst_ids in share.split(self.chunk_size):
+          out = self._conv_chunk(conv, i, features, embeddings, ntype, dst_ids, device)
+          if last:
+            out = model.lin(out)
+            y = labels[dst_ids].to(device)
+            num_correct += (out.argmax(1) == y).sum()
+            num_seeds += dst_ids.numel()
+          else:
+            outputs[ntype][start:start + dst_ids.numel()] = F.leaky_relu(out).to(torch.float16).cpu().numpy()
+            start += dst_ids.numel()
+      if not last:
+        for output in outputs.values():
+          output.flush()
+        embeddings = {ntype: np.load(path, mmap_mode='r') for ntype, path in self.embedding_files[i + 1].items()}
+        if world_size > 1:
+          dist.barrier()
+    return num_correct, num_seeds
@@ -4,8 +4,192 @@ import os.path as osp
 import graphlearn_torch as glt
 import torch
 
-from dataset import IGBHeteroDataset
-from typing import Literal
+from dataset import IGBHeteroDataset, load_csc
+from seed_scheduler import balanced_split, estimate_sampled_edges
+from typing import List, Literal, Optional
+
+# node types assigned by LocalityPartitioner, the other node types are small
+LOCALITY_NTYPES = ['paper', 'author']
+
+def fit_to_capacity(parts, preference, room, num_parts):
+  r""" Moves the least preferred nodes of every partition beyond its room to
+  the partitions with room left, in partition order.
+  """
+  keep = torch.ones(parts.numel(), dtype=torch.bool)
+  for pidx in range(num_parts):
+    idx = (parts == pidx).nonzero().squeeze(1)
+    if idx.numel() > room[pidx]:
+      order = preference[idx].argsort(descending=True)
+      keep[idx[order[max(int(room[pidx]), 0):]]] = False
+  excess = (~keep).nonzero().squeeze(1)
+  if excess.numel() > 0:
+    room_left = (room - torch.bincount(parts[keep], minlength=num_parts)).clamp(min=0)
+    parts[excess] = torch.searchsorted(torch.cumsum(room_left, 0), torch.arange(excess.numel()), right=True).clamp(max=num_parts - 1)
+  return parts
+
+class LocalityPartitioner(glt.partition.RandomPartitioner):
+  r""" Assigns paper and author nodes so that most sampled neighbors are stored
+  on the partition of their seed, the other node types are assigned randomly.
+
+  Nodes are streamed in chunks of stream_chunk_size ids through a linear
+  deterministic greedy (LDG) pass: each node goes to the partition holding
+  most of its neighbors assigned by the previous chunks, weighted by the room
+  left in that partition. Nodes without assigned neighbors, e.g. in the first
+  chunk, are spread over the partitions in proportion to their room.
+  refine_rounds rounds of label propagation, over chunks of node_chunk_size
+  ids, then move nodes to the partition of most of their neighbors, training
+  seeds in pairs of swaps.
+  Training seeds are split evenly, every partition gets at most
+  (1 + balance_slack) times its share of the nodes of each type.
+
+  Args:
+    in_neighbors: The CSC topology (indptr, indices) of the edge types between
+      paper and author nodes, see load_csc.
+    train_idx: The training seeds, paper node ids.
+    Other args are the ones of RandomPartitioner.
+  """
+  def __init__(self, output_dir, num_parts, num_nodes, edge_index,
+               in_neighbors, train_idx, refine_rounds=2, balance_slack=0.05,
+               node_chunk_size=1 << 20, stream_chunk_size=1 << 14, **kwargs):
+    super().__init__(output_dir, num_parts, num_nodes, edge_index, **kwargs)
+    self.in_neighbors = in_neighbors
+    self.refine_rounds = refine_rounds
+    self.balance_slack = balance_slack
+    self.node_chunk_size = node_chunk_size
+    self.stream_chunk_size = stream_chunk_size
+    self.is_seed = {ntype: torch.zeros(num_nodes[ntype], dtype=torch.bool) for ntype in LOCALITY_NTYPES}
+    self.is_seed['paper'][train_idx] = True
+    self.num_seeds = train_idx.numel()
+    self.assignment = {}
+
+  def _chunks(self, ntype, chunk_size=None):
+    chunk_size = chunk_size or self.node_chunk_size
+    for start in range(0, self.num_nodes[ntype], chunk_size):
+      yield start, min(start + chunk_size, self.num_nodes[ntype])
+
+  def _neighbor_counts(self, ntype, start, end):
+    r""" Number of assigned neighbors of nodes [start, end) of ntype on each partition. """
+    counts = torch.zeros((end - start) * self.num_parts, dtype=torch.int64)
+    for etype, (indptr, indices) in self.in_neighbors.items():
+      if etype[2] != ntype:
+        continue
+      deg = indptr[start + 1:end + 1] - indptr[start:end]
+      rows = torch.repeat_interleave(torch.arange(end - start), deg)
+      parts = self.assignment[etype[0]][indices[indptr[start]:indptr[end]].long()].long()
+      assigned = parts >= 0
+      counts += torch.bincount(rows[assigned] * self.num_parts + parts[assigned], minlength=counts.numel())
+    return counts.view(end - start, self.num_parts).float()
+
+  def _node_capacity(self, ntype):
+    return int((1 + self.balance_slack) * self.num_nodes[ntype] / self.num_parts) + 1
+
+  def _greedy_pass(self, ntype):
+    capacity = self._node_capacity(ntype)
+    seed_capacity = (self.num_seeds + self.num_parts - 1) // self.num_parts
+    node_load = torch.zeros(self.num_parts, dtype=torch.int64)
+    seed_load = torch.zeros(self.num_parts, dtype=torch.int64)
+    for start, end in self._chunks(ntype, self.stream_chunk_size):
+      counts = self._neighbor_counts(ntype, start, end)
+      is_seed = self.is_seed[ntype][start:end]
+      # LDG: neighbors on a partition, discounted by how full the partition is
+      score = counts * (1 - node_load / capacity).clamp(min=0)
+      score[is_seed] = counts[is_seed] * (1 - seed_load / seed_capacity).clamp(min=0)
+      preference, parts = score.max(1)
+      # nodes without assigned neighbors are spread where there is room
+      no_neighbor = preference <= 0
+      if no_neighbor.any():
+        room = (capacity - node_load).clamp(min=1).float()
+        parts[no_neighbor] = torch.multinomial(room, int(no_neighbor.sum()), replacement=True)
+      preference[no_neighbor] = -1
+      # seeds are balanced exactly, the other nodes within the slack
+      parts[is_seed] = fit_to_capacity(parts[is_seed], preference[is_seed], seed_capacity - seed_load, self.num_parts)
+      seed_load += torch.bincount(parts[is_seed], minlength=self.num_parts)
+      node_load += torch.bincount(parts[is_seed], minlength=self.num_parts)
+      parts[~is_seed] = fit_to_capacity(parts[~is_seed], preference[~is_seed], capacity - node_load, self.num_parts)
+      node_load += torch.bincount(parts[~is_seed], minlength=self.num_parts)
+      self.assignment[ntype][start:end] = parts.to(self.assignment[ntype].dtype)
+
+  def _refine(self, ntype):
+    capacity = self._node_capacity(ntype)
+    assignment = self.assignment[ntype]
+    node_load = torch.bincount(assignment.long(), minlength=self.num_parts)
+    num_moved = 0
+    for start, end in self._chunks(ntype):
+      counts = self._neighbor_counts(ntype, start, end)
+      current = assignment[start:end].long()
+      best_count, best = counts.max(1)
+      gain = best_count - counts.gather(1, current.unsqueeze(1)).squeeze(1)
+      is_seed = self.is_seed[ntype][start:end]
+      # seeds are swapped in pairs between two partitions, keeping them balanced
+      seed_moves = ((gain > 0) & is_seed).nonzero().squeeze(1)
+      for pidx in range(self.num_parts):
+        for qidx in range(pidx + 1, self.num_parts):
+          to_q = seed_moves[(current[seed_moves] == pidx) & (best[seed_moves] == qidx)]
+          to_p = seed_moves[(current[seed_moves] == qidx) & (best[seed_moves] == pidx)]
+          num_swaps = min(to_q.numel(), to_p.numel())
+          if num_swaps == 0:
+            continue
+          assignment[start + to_q[gain[to_q].argsort(descending=True)[:num_swaps]]] = qidx
+          assignment[start + to_p[gain[to_p].argsort(descending=True)[:num_swaps]]] = pidx
+          num_moved += 2 * num_swaps
+      movable = ((gain > 0) & ~is_seed).nonzero().squeeze(1)
+      for pidx in range(self.num_parts):
+        candidates = movable[best[movable] == pidx]
+        room = int(capacity - node_load[pidx])
+        if candidates.numel() == 0 or room <= 0:
+          continue
+        candidates = candidates[gain[candidates].argsort(descending=True)[:room]]
+        node_load[pidx] += candidates.numel()
+        node_load -= torch.bincount(current[candidates], minlength=self.num_parts)
+        assignment[start + candidates] = pidx
+        num_moved += candidates.numel()
+    return num_moved
+
+  def assign(self):
+    r""" Computes the partition of the paper and author nodes. """
+    dtype = torch.int8 if self.num_parts < 128 else torch.int16
+    for ntype in LOCALITY_NTYPES:
+      self.assignment[ntype] = torch.full((self.num_nodes[ntype],), -1, dtype=dtype)
+    # authors come second, when all papers they wrote are assigned
+    for ntype in LOCALITY_NTYPES:
+      self._greedy_pass(ntype)
+    for i in range(self.refine_rounds):
+      num_moved = sum(self._refine(ntype) for ntype in LOCALITY_NTYPES)
+      print(f'-- Refinement round {i}: moved {num_moved} nodes')
+
+  def edge_cut(self):
+    r""" Returns the fraction of cut edges of each edge type between paper and
+    author nodes, of all of them, and the fraction of in-neighbors of training
+    seeds on another partition, which is the ratio of remote fetches of the
+    first sampling hop.
+    """
+    cut, num_cut, num_edges, num_remote, num_seed_edges = {}, 0, 0, 0, 0
+    for etype, (indptr, indices) in self.in_neighbors.items():
+      etype_cut = 0
+      for start, end in self._chunks(etype[2]):
+        deg = indptr[start + 1:end + 1] - indptr[start:end]
+        dst_parts = torch.repeat_interleave(self.assignment[etype[2]][start:end], deg)
+        remote = self.assignment[etype[0]][indices[indptr[start]:indptr[end]].long()] != dst_parts
+        etype_cut += int(remote.sum())
+        if etype[2] == 'paper':
+          is_seed = torch.repeat_interleave(self.is_seed['paper'][start:end], deg)
+          num_remote += int((remote & is_seed).sum())
+          num_seed_edges += int(is_seed.sum())
+      cut[etype] = etype_cut / max(indices.numel(), 1)
+      num_cut += etype_cut
+      num_edges += indices.numel()
+    return cut, num_cut / max(num_edges, 1), num_remote / max(num_seed_edges, 1)
+
+  def _partition_node(self, ntype=None):
+    if ntype not in LOCALITY_NTYPES:
+      return super()._partition_node(ntype)
+    if not self.assignment:
+      self.assign()
+    partition_book = self.assignment[ntype].to(torch.int64)
+    ids = torch.arange(self.num_nodes[ntype], dtype=torch.int64)
+    partition_results = [torch.masked_select(ids, partition_book == pidx) for pidx in range(self.num_parts)]
+    return partition_results, partition_book
+
 
 def partition_dataset(src_path: str,
                       dst_path: str,
@@ -17,7 +201,11 @@ def partition_dataset(src_path: str,
                       use_label_2K: bool=False,
                       with_feature: bool=True,
                       use_fp16: bool=False,
-                      layout: Literal['CSC', 'CSR', 'COO'] = 'COO'):
+                      layout: Literal['CSC', 'CSR', 'COO'] = 'COO',
+                      partitioner: Literal['random', 'locality'] = 'random',
+                      refine_rounds: int=2,
+                      balance_slack: float=0.05,
+                      seed_cost_fan_out: Optional[List[int]]=None):
   print(f'-- Loading igbh_{dataset_size} ...')
   data = IGBHeteroDataset(src_path, dataset_size, in_memory, use_label_2K, use_fp16=use_fp16)
   node_num = {k : v.shape[0] for k, v in data.feat_dict.items()}
@@ -27,13 +215,61 @@ def partition_dataset(src_path: str,
   glt.utils.ensure_dir(label_dir)
   torch.save(data.label.squeeze(), osp.join(label_dir, 'label.pt'))
 
+  partitions_dir = osp.join(dst_path, f'{dataset_size}-partitions')
+  partitioner_kwargs = dict(
+    output_dir=partitions_dir,
+    num_parts=num_partitions,
+    num_nodes=node_num,
+    edge_index=data.edge_dict,
+    node_feat=data.feat_dict,
+    node_feat_dtype = torch.float16 if use_fp16 else torch.float32,
+    edge_assign_strategy=edge_assign_strategy,
+    chunk_size=chunk_size,
+  )
+  if partitioner == 'locality':
+    print('-- Assigning paper and author nodes ...')
+    in_neighbors = {etype: load_csc(data, etype, node_num[etype[2]]) for etype in data.edge_dict
+                    if etype[0] in LOCALITY_NTYPES and etype[2] in LOCALITY_NTYPES}
+    graph_partitioner = LocalityPartitioner(in_neighbors=in_neighbors, train_idx=data.train_idx,
+                                            refine_rounds=refine_rounds, balance_slack=balance_slack,
+                                            **partitioner_kwargs)
+    graph_partitioner.assign()
+    cut, total_cut, remote_ratio = graph_partitioner.edge_cut()
+    for etype, etype_cut in cut.items():
+      print(f'-- Edge cut of {etype}: {etype_cut:.4f}')
+    print(f'-- Edge cut: {total_cut:.4f}, random partitioning: {1 - 1 / num_partitions:.4f}')
+    print(f'-- Remote fetch ratio of training seed neighbors: {remote_ratio:.4f}')
+  else:
+    graph_partitioner = glt.partition.RandomPartitioner(**partitioner_kwargs)
+
   print('-- Partitioning training idx ...')
   train_idx = data.train_idx
-  train_idx = train_idx.split(train_idx.size(0) // num_partitions)
+  if seed_cost_fan_out is not None:
+    print(f'-- Estimating the sampling cost of the training seeds with fan-out {seed_cost_fan_out} ...')
+    in_neighbors = {etype: load_csc(data, etype, node_num[etype[2]]) for etype in data.edge_dict}
+    seed_cost = estimate_sampled_edges(in_neighbors, node_num, seed_cost_fan_out)[train_idx]
+  if partitioner == 'locality':
+    # train on the partition holding the seed, equally many seeds per partition
+    owner = graph_partitioner.assignment['paper'][train_idx]
+    parts = [(owner == pidx).nonzero().squeeze(1) for pidx in range(num_partitions)]
+    num_seeds = min(part.size(0) for part in parts)
+    parts = [part[:num_seeds] for part in parts]
+  elif seed_cost_fan_out is not None:
+    # equally many seeds and sampled edges per partition, seeds still assigned at random
+    parts = balanced_split(seed_cost, num_partitions, torch.Generator().manual_seed(0))
+  else:
+    parts = torch.arange(train_idx.size(0)).split(train_idx.size(0) // num_partitions)
   train_idx_partitions_dir = osp.join(dst_path, f'{dataset_size}-train-partitions')
   glt.utils.ensure_dir(train_idx_partitions_dir)
   for pidx in range(num_partitions):
-    torch.save(train_idx[pidx], osp.join(train_idx_partitions_dir, f'partition{pidx}.pt'))
+    torch.save(train_idx[parts[pidx]], osp.join(train_idx_partitions_dir, f'partition{pidx}.pt'))
+    if seed_cost_fan_out is not None:
+      # read by dist_train_rgnn.py --balance_seed_batches
+      torch.save(seed_cost[parts[pidx]], osp.join(train_idx_partitions_dir, f'partition{pidx}_cost.pt'))
+  if seed_cost_fan_out is not None:
+    part_cost = torch.stack([seed_cost[parts[pidx]].sum() for pidx in range(num_partitions)])
+    print(f'-- Expected sampled edges per partition: max {part_cost.max().item():.4g}, '
+          f'min {part_cost.min().item():.4g}')
 
   print('-- Partitioning validation idx ...')
   val_idx = data.val_idx
@@ -44,18 +280,7 @@ def partition_dataset(src_path: str,
     torch.save(val_idx[pidx], osp.join(val_idx_partitions_dir, f'partition{pidx}.pt'))
 
   print('-- Partitioning graph and features ...')
-  partitions_dir = osp.join(dst_path, f'{dataset_size}-partitions')
-  partitioner = glt.partition.RandomPartitioner(
-    output_dir=partitions_dir,
-    num_parts=num_partitions,
-    num_nodes=node_num,
-    edge_index=data.edge_dict,
-    node_feat=data.feat_dict,
-    node_feat_dtype = torch.float16 if use_fp16 else torch.float32,
-    edge_assign_strategy=edge_assign_strategy,
-    chunk_size=chunk_size,
-  )
-  partitioner.partition(with_feature)
+  graph_partitioner.partition(with_feature)
 
   if layout in ['CSC', 'CSR']:
     compress_edge_dict = {}
@@ -129,6 +354,16 @@ if __name__ == '__main__':
       help="save partitioned node/edge feature into fp16 format")
   parser.add_argument("--layout", type=str, default='COO', 
       help="layout of the partitioned graph: CSC, CSR, COO")
+  parser.add_argument("--partitioner", type=str, default='random',
+      choices=['random', 'locality'],
+      help="random node assignment, or locality aware assignment of paper and author nodes")
+  parser.add_argument("--refine_rounds", type=int, default=2,
+      help="label propagation rounds of the locality partitioner")
+  parser.add_argument("--balance_slack", type=float, default=0.05,
+      help="fraction of nodes a partition may hold above its share with the locality partitioner")
+  parser.add_argument("--seed_cost_fan_out", type=str, default=None,
+      help="fan-out of training, e.g. '15,10,5': estimates the sampled edges of every training seed, "
+           "balances them across the random partitions and saves them for --balance_seed_batches")
 
   args = parser.parse_args()
 
@@ -143,5 +378,9 @@ if __name__ == '__main__':
     use_label_2K=args.num_classes==2983,
     with_feature=args.with_feature==1,
     use_fp16=args.use_fp16,
-    layout = args.layout
+    layout = args.layout,
+    partitioner=args.partitioner,
+    refine_rounds=args.refine_rounds,
+    balance_slack=args.balance_slack,
+    seed_cost_fan_out=[int(fanout) for fanout in args.seed_cost_fan_out.split(',')] if args.seed_cost_fan_out else None
   )
@@ -17,6 +17,10 @@ class RGNN(torch.nn.Module):
     model: "rsage" or "rgat".
     heads: Number of multi-head-attentions for GAT.
     node_type: The predict node type for node classification.
+    with_trim: Whether to trim the sampled subgraph to each layer.
+
+  The input features may be fp16 or bf16, they are cast to the dtype of the
+  model parameters.
 
   """
   def __init__(self, etypes, in_dim, h_dim, out_dim, num_layers=2,
@@ -43,6 +47,10 @@ class RGNN(torch.nn.Module):
 
   def forward(self, x_dict, edge_index_dict, num_sampled_edges_dict=None,
               num_sampled_nodes_dict=None):
+    # fp16 or bf16 features are cast on device, unless autocast handles them
+    if not torch.is_autocast_enabled():
+      dtype = next(self.parameters()).dtype
+      x_dict = {key: x.to(dtype) for key, x in x_dict.items()}
     for i, conv in enumerate(self.convs):
       if self.with_trim:
         x_dict, edge_index_dict, _ = trim_to_layer(
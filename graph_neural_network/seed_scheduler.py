@@ -0,0 +1,82 @@
+import torch
+
+def estimate_sampled_edges(in_neighbors, num_nodes, fan_out, node_type='paper',
+                           chunk_size=1 << 20):
+  r""" Expected number of edges sampled from each node of node_type with
+  fan_out, from the CSC topology (indptr, indices) of every edge type, see
+  load_csc. At each hop, a node samples min(degree, fanout) in-neighbors of
+  every edge type, uniformly, which then add the mean expected cost of its
+  in-neighbors at the next hop. Sampled nodes are not deduplicated, so this
+  overestimates the cost of dense neighborhoods, but ranks seeds by cost.
+  """
+  cost = {ntype: torch.zeros(num, dtype=torch.float64) for ntype, num in num_nodes.items()}
+  for fanout in reversed(fan_out):
+    next_cost = {ntype: torch.zeros_like(ntype_cost) for ntype, ntype_cost in cost.items()}
+    for etype, (indptr, indices) in in_neighbors.items():
+      src_type, _, dst_type = etype
+      for start in range(0, num_nodes[dst_type], chunk_size):
+        end = min(start + chunk_size, num_nodes[dst_type])
+        deg = indptr[start + 1:end + 1] - indptr[start:end]
+        rows = torch.repeat_interleave(torch.arange(end - start), deg)
+        nbr_cost = torch.zeros(end - start, dtype=torch.float64).index_add_(
+          0, rows, cost[src_type][indices[indptr[start]:indptr[end]].long()])
+        sampled = (deg if fanout < 0 else deg.clamp(max=fanout)).double()
+        next_cost[dst_type][start:end] += sampled * (1 + nbr_cost / deg.clamp(min=1))
+    cost = next_cost
+  return cost[node_type].float()
+
+def balanced_split(cost, num_parts, generator=None):
+  r""" Splits the positions of cost into num_parts equally sized parts of
+  about equal total cost. Positions are shuffled, sorted by cost, with equal
+  costs kept in shuffled order, and dealt to the parts back and forth; each
+  part is then shuffled. As with equal splits, the positions beyond a multiple
+  of num_parts, picked at random, are dropped.
+  """
+  order = torch.randperm(cost.numel(), generator=generator)
+  order = order[:cost.numel() // num_parts * num_parts]
+  order = order[torch.sort(cost[order], descending=True, stable=True).indices]
+  order = order.view(-1, num_parts)
+  order[1::2] = order[1::2].flip(1)
+  return [part[torch.randperm(part.numel(), generator=generator)] for part in order.t()]
+
+class BalancedSeedBatches(object):
+  r""" Orders the seeds of each epoch into batches of about equal expected
+  sampling cost, which evens out the step times of the ranks of synchronous
+  data-parallel training.
+
+  The seeds are shuffled and cut into windows of window_batches batches, and
+  the seeds of a window are dealt to its batches by balanced_split. Every
+  batch thus covers the whole cost range, while the seeds sharing a batch
+  remain random. A loader reading the order of an epoch without shuffling
+  yields the balanced batches.
+
+  Args:
+    seeds: The seeds.
+    seed_cost: The expected sampling cost of each seed, see
+      estimate_sampled_edges.
+    batch_size: The number of seeds per batch.
+    window_batches: The number of batches whose seeds are balanced together.
+    random_seed: The seed of the shuffling, combined with the epoch.
+  """
+  def __init__(self, seeds, seed_cost, batch_size, window_batches=32, random_seed=0):
+    self.seeds = seeds
+    self.seed_cost = seed_cost
+    self.batch_size = batch_size
+    self.window_batches = window_batches
+    self.random_seed = random_seed
+
+  def order(self, epoch):
+    generator = torch.Generator().manual_seed(self.random_seed + epoch)
+    perm = torch.randperm(self.seeds.numel(), generator=generator)
+    window = self.window_batches * self.batch_size
+    batches = []
+    for start in range(0, perm.numel(), window):
+      positions = perm[start:start + window]
+      num_batches = positions.numel() // self.batch_size
+      if num_batches > 1:
+        full = positions[:num_batches * self.batch_size]
+        batches += [full[part] for part in balanced_split(self.seed_cost[full], num_batches, generator)]
+        # only the last window may hold an incomplete batch
+        positions = positions[num_batches * self.batch_size:]
+      batches.append(positions)
+    return self.seeds[torch.cat(batches)]
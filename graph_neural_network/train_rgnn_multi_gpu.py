@@ -1,7 +1,5 @@
 import argparse, datetime, os
-import numpy as np
 import os.path as osp
-import sklearn.metrics
 import time, tqdm
 import torch
 import warnings
@@ -12,45 +10,67 @@ import mlperf_logging.mllog.constants as mllog_constants
 
 from torch.nn.parallel import DistributedDataParallel
 
-from dataset import IGBHeteroDataset
+from dataset import IGBHeteroDataset, load_csc
+from feature_collation import FeatureCollator
+from layerwise_inference import LayerwiseInference
 from mlperf_logging_utils import get_mlperf_logger, submission_info
 from utilities import create_ckpt_folder
 from rgnn import RGNN
+from seed_scheduler import BalancedSeedBatches, balanced_split, estimate_sampled_edges
 
 warnings.filterwarnings("ignore")
 mllogger = get_mlperf_logger(path=osp.dirname(osp.abspath(__file__)))
 
-def evaluate(model, dataloader, current_device, rank, world_size, epoch_num):
+def evaluate(model, dataloader, feature_collator, current_device, rank, world_size,
+             epoch_num, num_seeds=None, target_acc=None, check_freq=0):
+  r""" Validation accuracy of this rank and of all ranks, weighted by their
+  numbers of seeds. With check_freq > 0, the ranks reduce their counters every
+  check_freq batches and stop once the accuracy over all num_seeds validation
+  seeds reaches target_acc, or can no longer reach it, whatever the remaining
+  predictions; every rank must then iterate over the same number of batches.
+  The accuracy over all seeds reported after such an early stop is the bound
+  that decided it: assuming the remaining predictions are all wrong when the
+  target is reached, and all correct when it is out of reach. It is then also
+  returned as the accuracy of this rank.
+  """
   if rank == 0:
     mllogger.start(
         key=mllog_constants.EVAL_START,
         metadata={mllog_constants.EPOCH_NUM: epoch_num},
     )
-  predictions = []
-  labels = []
+  # number of correct predictions and of evaluated seeds
+  counts = torch.zeros(2, dtype=torch.int64, device=current_device)
+  stopped_early = False
   with torch.no_grad():
-    for batch in dataloader:
+    for idx, batch in enumerate(dataloader):
       batch_size = batch['paper'].batch_size
-      out = model(
-        {
-          node_name: node_feat.to(current_device).to(torch.float32)
-          for node_name, node_feat in batch.x_dict.items()
-        },  
-        batch.edge_index_dict
-      )[:batch_size]
-      labels.append(batch['paper'].y[:batch_size].cpu().numpy())
-      predictions.append(out.argmax(1).cpu().numpy())
-
-    predictions = np.concatenate(predictions)
-    labels = np.concatenate(labels)
-    acc = sklearn.metrics.accuracy_score(labels, predictions)
-
-    torch.cuda.synchronize()
-    dist.barrier()
+      out = model(feature_collator(batch.x_dict), batch.edge_index_dict)[:batch_size]
+      counts[0] += (out.argmax(1) == batch['paper'].y[:batch_size]).sum()
+      counts[1] += batch_size
+      if target_acc is not None and check_freq > 0 and (idx + 1) % check_freq == 0:
+        global_counts = counts.clone()
+        dist.all_reduce(global_counts, op=dist.ReduceOp.SUM)
+        correct, seen = global_counts.tolist()
+        if (correct >= target_acc * num_seeds or
+            correct + num_seeds - seen < target_acc * num_seeds):
+          stopped_early = True
+          break
 
-    acc_tensor = torch.tensor(acc).to(current_device)
-    torch.distributed.all_reduce(acc_tensor, op=torch.distributed.ReduceOp.SUM)    
-    global_acc = acc_tensor.item() / world_size
+    rank_counts = counts.clone()
+    dist.all_reduce(counts, op=dist.ReduceOp.SUM)
+    correct, seen, rank_correct, rank_seen = torch.cat([counts, rank_counts]).tolist()
+    acc = rank_correct / max(rank_seen, 1)
+    global_acc = correct / seen
+    if stopped_early:
+      if correct >= target_acc * num_seeds:
+        global_acc = correct / num_seeds
+      else:
+        global_acc = (correct + num_seeds - seen) / num_seeds
+      # the seeds of this rank were not all evaluated either
+      acc = global_acc
+      if rank == 0:
+        print(f'Validation stopped after {seen} of {num_seeds} seeds, '
+              f'reporting the accuracy bound {global_acc:.4f}')
     if rank == 0:
       mllogger.event(
           key=mllog_constants.EVAL_ACCURACY,
@@ -61,13 +81,39 @@ def evaluate(model, dataloader, current_device, rank, world_size, epoch_num):
           key=mllog_constants.EVAL_STOP,
           metadata={mllog_constants.EPOCH_NUM: epoch_num},
       )
-    return acc, global_acc
+  return acc, global_acc
+
+def evaluate_layerwise(model, engine, dataset, current_device, rank, world_size, epoch_num):
+  if rank == 0:
+    mllogger.start(
+        key=mllog_constants.EVAL_START,
+        metadata={mllog_constants.EPOCH_NUM: epoch_num},
+    )
+  num_correct, num_seeds = engine(model.module, dataset.node_features,
+                                  dataset.get_node_label('paper'), current_device,
+                                  rank, world_size)
+  acc = num_correct.item() / max(num_seeds.item(), 1)
+  counts = torch.stack([num_correct, num_seeds])
+  torch.distributed.all_reduce(counts, op=torch.distributed.ReduceOp.SUM)
+  global_acc = counts[0].item() / counts[1].item()
+  if rank == 0:
+    mllogger.event(
+        key=mllog_constants.EVAL_ACCURACY,
+        value=global_acc,
+        metadata={mllog_constants.EPOCH_NUM: epoch_num},
+    )
+    mllogger.end(
+        key=mllog_constants.EVAL_STOP,
+        metadata={mllog_constants.EPOCH_NUM: epoch_num},
+    )
+  return acc, global_acc
 
 def run_training_proc(rank, world_size,
     hidden_channels, num_classes, num_layers, model_type, num_heads, fan_out,
     epochs, train_batch_size, val_batch_size, learning_rate, random_seed, dataset, 
     train_idx, val_idx, with_gpu, validation_acc, validation_frac_within_epoch,
-    evaluate_on_epoch_end, checkpoint_on_epoch_end, ckpt_steps, ckpt_path):
+    evaluate_on_epoch_end, checkpoint_on_epoch_end, ckpt_steps, ckpt_path,
+    layerwise_engine, eval_check_freq, train_seed_cost, balance_window_batches):
   if rank == 0:
     if ckpt_steps > 0:
       ckpt_dir = create_ckpt_folder(base_dir=osp.dirname(osp.abspath(__file__)))
@@ -80,13 +126,23 @@ def run_training_proc(rank, world_size,
   
   print(f'Rank {rank} init graphlearn_torch NeighborLoader...')
   # Create rank neighbor loader for training
-  train_idx = train_idx.split(train_idx.size(0) // world_size)[rank]
+  seed_batches = None
+  if train_seed_cost is not None:
+    # the same split on every rank, of equal expected sampled edges
+    part = balanced_split(train_seed_cost, world_size, torch.Generator().manual_seed(random_seed))[rank]
+    train_idx = train_idx[part]
+    seed_batches = BalancedSeedBatches(train_idx, train_seed_cost[part], train_batch_size,
+                                       balance_window_batches, random_seed)
+    # reordered in place for each epoch, the loader reads the order as it is
+    train_idx = train_idx.clone()
+  else:
+    train_idx = train_idx.split(train_idx.size(0) // world_size)[rank]
   train_loader = glt.loader.NeighborLoader(
     data=dataset,
     num_neighbors=[int(fanout) for fanout in fan_out.split(',')],
     input_nodes=('paper', train_idx),
     batch_size=train_batch_size,
-    shuffle=True,
+    shuffle=seed_batches is None,
     drop_last=False,
     device=current_device,
     seed=random_seed
@@ -94,6 +150,8 @@ def run_training_proc(rank, world_size,
 
   # Create rank neighbor loader for validation.
   val_idx = val_idx.split(val_idx.size(0) // world_size)[rank]
+  # the ranks evaluate equal shares of the validation seeds
+  num_val_seeds = val_idx.size(0) * world_size
   val_loader = glt.loader.NeighborLoader(
     data=dataset,
     num_neighbors=[int(fanout) for fanout in fan_out.split(',')],
@@ -141,6 +199,7 @@ def run_training_proc(rank, world_size,
 
   loss_fcn = torch.nn.CrossEntropyLoss().to(current_device)
   optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+  feature_collator = FeatureCollator(current_device)
   if ckpt is not None:
     optimizer.load_state_dict(ckpt['optimizer_state_dict'])
 
@@ -162,24 +221,20 @@ def run_training_proc(rank, world_size,
     idx = 0
     gpu_mem_alloc = 0
     epoch_start = time.time()
+    if seed_batches is not None:
+      train_idx.copy_(seed_batches.order(epoch))
     for batch in train_loader:
       idx += 1
       batch_size = batch['paper'].batch_size
-      out = model(
-        {
-          node_name: node_feat.to(current_device).to(torch.float32)
-          for node_name, node_feat in batch.x_dict.items()
-        },  
-        batch.edge_index_dict
-      )[:batch_size]
+      out = model(feature_collator(batch.x_dict), batch.edge_index_dict)[:batch_size]
       y = batch['paper'].y[:batch_size]
       loss = loss_fcn(out, y)
       optimizer.zero_grad()
       loss.backward()
       optimizer.step()
-      total_loss += loss.item()
-      train_acc += sklearn.metrics.accuracy_score(y.cpu().numpy(),
-          out.argmax(1).detach().cpu().numpy())*100
+      # kept on device, so that the next batch is sampled and copied while this step runs
+      total_loss += loss.detach()
+      train_acc += (out.argmax(1) == y).float().mean() * 100
       gpu_mem_alloc += (
           torch.cuda.max_memory_allocated() / 1000000
           if with_gpu
@@ -202,8 +257,13 @@ def run_training_proc(rank, world_size,
         dist.barrier()
         epoch_num = round((epoch + idx / batch_num), 2)
         model.eval()
-        rank_val_acc, global_acc = evaluate(model, val_loader, current_device, 
-                                 rank, world_size, epoch_num)
+        if layerwise_engine is not None:
+          rank_val_acc, global_acc = evaluate_layerwise(model, layerwise_engine, dataset,
+                                                        current_device, rank, world_size, epoch_num)
+        else:
+          rank_val_acc, global_acc = evaluate(model, val_loader, feature_collator, current_device, 
+                                              rank, world_size, epoch_num, num_val_seeds,
+                                              validation_acc, eval_check_freq)
         if validation_acc is not None and global_acc >= validation_acc:
           is_success = True
           break
@@ -231,8 +291,13 @@ def run_training_proc(rank, world_size,
     if  evaluate_on_epoch_end and not is_success:
       epoch_num = epoch + 1
       model.eval()
-      rank_val_acc, global_acc = evaluate(model, val_loader, current_device, 
-                                          rank, world_size, epoch_num)
+      if layerwise_engine is not None:
+        rank_val_acc, global_acc = evaluate_layerwise(model, layerwise_engine, dataset,
+                                                      current_device, rank, world_size, epoch_num)
+      else:
+        rank_val_acc, global_acc = evaluate(model, val_loader, feature_collator, current_device, 
+                                            rank, world_size, epoch_num, num_val_seeds,
+                                            validation_acc, eval_check_freq)
       if validation_acc is not None and global_acc >= validation_acc:
         is_success = True
       
@@ -243,8 +308,8 @@ def run_training_proc(rank, world_size,
           "Rank{:02d} | Epoch {:03d} | Loss {:.4f} | Train Acc {:.2f} | Val Acc {:.2f} | Time {} | GPU {:.1f} MB".format(
               rank,
               epoch,
-              total_loss,
-              train_acc,
+              float(total_loss),
+              float(train_acc),
               rank_val_acc*100,
               str(datetime.timedelta(seconds = int(time.time() - epoch_start))),
               gpu_mem_alloc
@@ -312,10 +377,23 @@ if __name__ == '__main__':
         help="Evaluate using validation set on each epoch end.")
   parser.add_argument("--checkpoint_on_epoch_end", action="store_true",
       help="Save checkpoint on each epoch end.")
+  parser.add_argument("--eval_check_freq", type=int, default=0,
+      help="Stop a validation early once --validation_acc is reached or out of reach, "
+           "checked every n batches. Default is 0, which evaluates all validation seeds.")
   parser.add_argument('--ckpt_steps', type=int, default=-1, 
         help="Save checkpoint every n steps. Default is -1, which means no checkpoint is saved.")
   parser.add_argument('--ckpt_path', type=str, default=None, 
         help="Path to load checkpoint from. Default is None.")
+  parser.add_argument("--layerwise_eval", action="store_true",
+      help="Validate with layer-wise full-neighborhood inference instead of sampled mini-batches.")
+  parser.add_argument('--layerwise_chunk_size', type=int, default=65536,
+      help="Number of nodes per chunk of layer-wise inference.")
+  parser.add_argument('--layerwise_dir', type=str, default=None,
+      help="Directory of the intermediate embeddings of layer-wise inference. Default is {path}/{dataset_size}-layerwise.")
+  parser.add_argument("--balance_seed_batches", action="store_true",
+      help="Split and batch the training seeds so that ranks and batches sample about equally many edges.")
+  parser.add_argument('--balance_window_batches', type=int, default=32,
+      help="Number of random batches whose seeds are balanced together.")
   args = parser.parse_args()
   args.with_gpu = (not args.cpu_mode) and torch.cuda.is_available()
   assert args.layout in ['COO', 'CSC', 'CSR']
@@ -356,6 +434,27 @@ if __name__ == '__main__':
   mllogger.event(key=mllog_constants.TRAIN_SAMPLES, value=train_idx.size(0))
   mllogger.event(key=mllog_constants.EVAL_SAMPLES, value=val_idx.size(0))
 
+  num_nodes = {ntype: feat.shape[0] for ntype, feat in igbh_dataset.feat_dict.items()}
+  csc = {}
+  if args.layerwise_eval or args.balance_seed_batches:
+    assert args.edge_dir == 'in', "layer-wise inference and seed balancing use the in-neighbors of nodes"
+    for etype in igbh_dataset.edge_dict:
+      indptr, indices = load_csc(igbh_dataset, etype, num_nodes[etype[2]])
+      csc[etype] = (indptr.share_memory_(), indices.share_memory_())
+
+  train_seed_cost = None
+  if args.balance_seed_batches:
+    fan_out = [int(fanout) for fanout in args.fan_out.split(',')]
+    train_seed_cost = estimate_sampled_edges(csc, num_nodes, fan_out)[train_idx].share_memory_()
+
+  layerwise_engine = None
+  if args.layerwise_eval:
+    layerwise_dir = args.layerwise_dir or osp.join(args.path, f'{args.dataset_size}-layerwise')
+    glt.utils.ensure_dir(layerwise_dir)
+    layerwise_engine = LayerwiseInference(csc, val_idx, num_nodes, args.num_layers,
+                                          args.hidden_channels, layerwise_dir,
+                                          args.layerwise_chunk_size)
+
   print('--- Launching training processes ...\n')
   torch.multiprocessing.spawn(
     run_training_proc,
@@ -366,7 +465,8 @@ if __name__ == '__main__':
           glt_dataset, train_idx, val_idx, args.with_gpu,
           args.validation_acc, args.validation_frac_within_epoch, 
           args.evaluate_on_epoch_end, args.checkpoint_on_epoch_end, 
-          args.ckpt_steps, args.ckpt_path),
+          args.ckpt_steps, args.ckpt_path, layerwise_engine, args.eval_check_freq,
+          train_seed_cost, args.balance_window_batches),
     nprocs=world_size,
     join=True
   )
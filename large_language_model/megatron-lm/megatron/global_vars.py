@@ -49,11 +49,21 @@ def get_current_global_batch_size():
     return _GLOBAL_NUM_MICROBATCHES_CALCULATOR.get_current_global_batch_size()
 
 
+def get_current_global_tokens():
+    return _GLOBAL_NUM_MICROBATCHES_CALCULATOR.get_current_global_tokens()
+
+
 def update_num_microbatches(consumed_samples, consistency_check=True):
     _GLOBAL_NUM_MICROBATCHES_CALCULATOR.update(consumed_samples,
                                                consistency_check)
 
 
+def update_current_global_batch(global_samples, global_tokens):
+    """Report the size of a variable (token-budget) global batch."""
+    _GLOBAL_NUM_MICROBATCHES_CALCULATOR.update_global_batch(global_samples,
+                                                            global_tokens)
+
+
 def get_tokenizer():
     """Return tokenizer."""
     _ensure_var_is_initialized(_GLOBAL_TOKENIZER, 'tokenizer')
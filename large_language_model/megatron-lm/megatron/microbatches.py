@@ -21,8 +21,23 @@ from abc import abstractmethod
 
 def build_num_microbatches_calculator(args):
 
+    # Token-budget micro-batches (finetuning on variable-length samples).
+    max_tokens_per_micro_batch = getattr(args, 'max_tokens_per_micro_batch',
+                                         None)
+    if max_tokens_per_micro_batch is not None:
+        assert args.rampup_batch_size is None, 'batch size rampup is not ' \
+            'supported with --max-tokens-per-micro-batch'
+        num_microbatches_calculator = TokenBudgetNumMicroBatches(
+            max_tokens_per_micro_batch, args.global_batch_size,
+            args.micro_batch_size, args.data_parallel_size)
+        if args.rank == 0:
+            print('setting number of micro-batches to constant {} with at '
+                  'most {} tokens per micro-batch'.format(
+                      num_microbatches_calculator.get(),
+                      max_tokens_per_micro_batch), flush=True)
+
     # Constant num micro-batches.
-    if args.rampup_batch_size is None:
+    elif args.rampup_batch_size is None:
         num_microbatches_calculator = ConstantNumMicroBatches(
             args.global_batch_size, args.micro_batch_size,
             args.data_parallel_size)
@@ -57,6 +72,7 @@ class NumMicroBatchesCalculator(ABC):
     def __init__(self):
         self.num_micro_batches = None
         self.current_global_batch_size = None
+        self.current_global_tokens = None
 
     def get(self):
         return self.num_micro_batches
@@ -64,6 +80,11 @@ class NumMicroBatchesCalculator(ABC):
     def get_current_global_batch_size(self):
         return self.current_global_batch_size
 
+    def get_current_global_tokens(self):
+        """Non-padding tokens in the current global batch. Only known
+        for calculators that track variable-size batches, None otherwise."""
+        return self.current_global_tokens
+
     @abstractmethod
     def update(self, consumed_samples, consistency_check):
         pass
@@ -83,11 +104,44 @@ class ConstantNumMicroBatches(NumMicroBatchesCalculator):
                                  micro_batch_times_data_parallel
         assert self.num_micro_batches >= 1
         self.current_global_batch_size = global_batch_size
+        self.current_global_tokens = None
 
     def update(self, consumed_samples, consistency_check):
         pass
 
 
+class TokenBudgetNumMicroBatches(ConstantNumMicroBatches):
+
+    def __init__(self, max_tokens_per_micro_batch, global_batch_size,
+                 micro_batch_size, data_parallel_size):
+        """Token-budget micro-batches.
+        The number of micro-batches is constant, but each micro-batch is
+        filled with as many (length-bucketed) samples as fit in
+        `max_tokens_per_micro_batch` padded tokens, so the number of
+        samples and tokens per global batch changes every step. The data
+        loader reports the actual global batch through
+        `update_global_batch` so that the learning rate schedule advances
+        by the samples that were really consumed.
+        Arguments:
+            max_tokens_per_micro_batch: padded tokens per micro-batch
+            global_batch_size: nominal global batch size, only used until
+               the first batch is reported
+            micro_batch_size: nominal micro batch size
+            data_parallel_size: data parallel size.
+        """
+        super(TokenBudgetNumMicroBatches, self).__init__(
+            global_batch_size, micro_batch_size, data_parallel_size)
+        assert max_tokens_per_micro_batch > 0
+        self.max_tokens_per_micro_batch = max_tokens_per_micro_batch
+
+    def update_global_batch(self, global_samples, global_tokens):
+        """Record the samples and non-padding tokens of the global batch
+        that is about to be consumed (summed across data parallel ranks)."""
+        assert global_samples > 0
+        self.current_global_batch_size = int(global_samples)
+        self.current_global_tokens = int(global_tokens)
+
+
 class RampupBatchsizeNumMicroBatches(NumMicroBatchesCalculator):
 
     def __init__(self, start_batch_size, batch_size_increment, ramup_samples,
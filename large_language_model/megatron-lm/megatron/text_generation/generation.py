@@ -25,10 +25,13 @@ from .communication import (
     broadcast_from_last_pipeline_stage,
     broadcast_from_last_to_first_pipeline_stage)
 from .forward_step import ForwardStep
-from .sampling import sample
+from .sampling import sample, decay_top_p
 from .beam_utils import BeamHypotheses
 
 MAX_TOKENS_TO_OOM = 12000  # (rprenger) Perfect value depends on hardware and network
+# Early termination needs the done flag on the host, so it is only checked
+# every few tokens instead of synchronizing with the device at each step.
+EARLY_TERMINATION_CHECK_INTERVAL = 8
 
 def score_and_return_on_first_stage(model, tokens, lengths):
     """Function for just scoring.
@@ -171,7 +174,7 @@ def generate_tokens_probs_and_return_on_first_stage(
                 device=torch.cuda.current_device()) * max_sequence_length
     
     # Whether we have reached a termination id.
-    is_generation_done = torch.zeros(batch_size, dtype=torch.uint8,
+    is_generation_done = torch.zeros(batch_size, dtype=torch.bool,
                                      device=torch.cuda.current_device())
 
     # =============
@@ -204,16 +207,15 @@ def generate_tokens_probs_and_return_on_first_stage(
                                     top_p=top_p,
                                     temperature=temperature,
                                     vocab_size=tokenizer.vocab_size)
-                if top_p > 0.0 and top_p_decay > 0.0:
-                    top_p = top_p * top_p_decay
-                    if top_p_bound > 0.0:
-                        top_p = max(top_p, top_p_bound)
+                top_p = decay_top_p(top_p, top_p_decay, top_p_bound)
 
                 # If a prompt length is smaller or equal th current context
                 # length, it means we have started generating tokens
                 started = lengths <= context_length
-                # Update the tokens.
-                tokens[started, context_length] = new_sample[started]
+                # Update the tokens. Use a select rather than boolean
+                # indexing, which would synchronize with the host.
+                tokens[:, context_length] = torch.where(
+                    started, new_sample, tokens[:, context_length])
 
                 # Calculate the log probabilities.
                 if return_output_log_probs:
@@ -241,31 +243,46 @@ def generate_tokens_probs_and_return_on_first_stage(
             prev_context_length = context_length
 
             # Check if all the sequences have hit the termination_id.
-            done = None
             if mpu.is_pipeline_last_stage():
                 # TODO(rprenger) These stopping methods are tokenizer dependent
                 # instead tokenization should be in the inference loop so stop sequences can be used
                 if stop_on_double_eol:
-                    hit_double_eol = (new_sample == 628).byte() & started.byte()
-                    hit_two_eols = (new_sample == 198).byte() & (tokens[:, context_length-1] == 198).byte() & started.byte()
-                    done_token = hit_double_eol | hit_two_eols
+                    done_token = (new_sample == 628) | \
+                        ((new_sample == 198) &
+                         (tokens[:, context_length-1] == 198))
                 elif stop_on_eol:
-                    hit_double_eol = (new_sample == 628).byte() & started.byte()
-                    hit_eol = (new_sample == 198).byte() & started.byte()
-                    done_token = hit_double_eol | hit_eol
-                else: 
-                    done_token = (new_sample == termination_id).byte() & \
-                        started.byte()
-                
-                just_finished = (done_token & ~is_generation_done).bool()
-                generated_sequence_lengths[just_finished.view(-1)] = \
-                    context_length + 1
-                is_generation_done = is_generation_done | done_token
-                done = torch.all(is_generation_done)
-            done = broadcast_from_last_pipeline_stage(1, torch.uint8,
-                                                      tensor=done)
-            if use_eod_token_for_early_termination and done:
-                break
+                    done_token = (new_sample == 628) | (new_sample == 198)
+                else:
+                    done_token = new_sample == termination_id
+                done_token &= started
+
+                just_finished = done_token & ~is_generation_done
+                generated_sequence_lengths.masked_fill_(just_finished,
+                                                        context_length + 1)
+                is_generation_done |= done_token
+
+            # The done flag is only brought back to the host every few
+            # steps; all stages follow the same schedule.
+            if use_eod_token_for_early_termination and \
+               (context_length == max_sequence_length - 1 or
+                (context_length - min_prompt_length + 1) %
+                EARLY_TERMINATION_CHECK_INTERVAL == 0):
+                done = None
+                if mpu.is_pipeline_last_stage():
+                    done = torch.all(is_generation_done).byte()
+                done = broadcast_from_last_pipeline_stage(1, torch.uint8,
+                                                          tensor=done)
+                if done:
+                    # Every sequence may have finished a few steps ago,
+                    # rewind to the step where the last one did.
+                    last_length = None
+                    if mpu.is_pipeline_last_stage():
+                        last_length = generated_sequence_lengths.max()
+                    last_length = broadcast_from_last_pipeline_stage(
+                        1, torch.int64, tensor=last_length)
+                    context_length = max(int(last_length) - 1,
+                                         min_prompt_length)
+                    break
             
     # ===================================================
     # Update the length of based on max generated length.
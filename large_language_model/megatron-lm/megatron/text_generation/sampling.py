@@ -24,6 +24,13 @@ import torch
 
 
 
+# Number of highest logits considered for top-p sampling. The nucleus is
+# usually a few hundred tokens at most, so a partial top-k avoids a full
+# sort per step. Only rows whose nucleus is larger are fully sorted, see
+# _sample_from_candidates.
+TOP_P_NUM_CANDIDATES = 1024
+
+
 def modify_logits_for_top_k_filtering(logits, top_k):
     """Set the logits for none top-k values to -inf."""
 
@@ -32,22 +39,24 @@ def modify_logits_for_top_k_filtering(logits, top_k):
 
 
 
+def _top_p_filter(sorted_probs, top_p):
+    """Given probabilities sorted in descending order, return the mask of
+    entries outside of the nucleus. The token that crosses `top_p` is kept
+    (equivalent to the shift-by-one of the original implementation)."""
+
+    cumulative_probs = sorted_probs.cumsum(dim=-1)
+    # Filteration based on the cumulative sum of the previous tokens, so
+    # the first token is always kept.
+    return (cumulative_probs - sorted_probs) > top_p
+
+
+
 def modify_logits_for_top_p_filtering(logits, top_p):
     """Set the logits for none top-p values to -inf."""
 
     # First sort and calculate cumulative sum of probabilities.
     sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-    cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
-
-    # Filteration based on the cumulative sum.
-    filter_ = cumulative_probs > top_p
-    # This shift by 1 is weird and I cannot justify it. This existed
-    # in the original implementation:
-    #   https://github.com/ari-holtzman/degen/blob/master/gen.py
-    # and I guess it is needed so keeping it for now.
-    filter_[:, 1:] = filter_[:, :-1].clone()
-    # Make sure we at least have one token to select from.
-    filter_[..., 0] = 0
+    filter_ = _top_p_filter(sorted_logits.softmax(dim=-1), top_p)
 
     # Fill in the filtered part
     filter_ = filter_.scatter(1, sorted_indices, filter_)
@@ -55,6 +64,47 @@ def modify_logits_for_top_p_filtering(logits, top_p):
 
 
 
+def _sample_from_candidates(logits, num_candidates, top_p):
+    """Sample from the `num_candidates` highest logits, optionally
+    restricted to the top-p nucleus. Probabilities are normalized over
+    the full vocabulary so the nucleus is identical to the one obtained
+    with a full sort whenever the candidates cover `top_p`. Rows whose
+    candidates do not cover it are filtered with a full sort instead, only
+    those rows. Finding them reads their indices back to the host, the one
+    sync of top-p sampling, which is needed to size the fallback."""
+
+    values, indices = torch.topk(logits, num_candidates, dim=-1)
+    if top_p > 0.0:
+        log_norm = torch.logsumexp(logits, dim=-1, keepdim=True)
+        candidate_probs = torch.exp(values - log_norm)
+        values = values.masked_fill(_top_p_filter(candidate_probs, top_p),
+                                    float('-Inf'))
+    probs = values.softmax(dim=-1)
+    choice = torch.multinomial(probs, num_samples=1)
+    samples = torch.gather(indices, 1, choice).view(-1)
+    if top_p > 0.0 and num_candidates < logits.size(1):
+        uncovered = (candidate_probs.sum(dim=-1) < top_p).nonzero().view(-1)
+        if uncovered.numel() > 0:
+            # The nucleus is larger than the candidates, sort these rows.
+            uncovered_logits = logits[uncovered]
+            modify_logits_for_top_p_filtering(uncovered_logits, top_p)
+            samples[uncovered] = torch.multinomial(
+                uncovered_logits.softmax(dim=-1), num_samples=1).view(-1)
+    return samples
+
+
+
+def decay_top_p(top_p, top_p_decay, top_p_bound):
+    """Top-p value to use for the next generated token."""
+
+    if top_p > 0.0 and top_p_decay > 0.0:
+        top_p = top_p * top_p_decay
+        if top_p_bound > 0.0:
+            top_p = max(top_p, top_p_bound)
+    return top_p
+
+
+
 def sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
     """ Sample and generate a token.
     Note: logits has the dimension [b, v] where b is the batch size
@@ -62,11 +112,13 @@ def sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
     If vocab_size is provided, we will make sure the sample that is
     generated is in [0, vocab-size). This will avoid out of vocabulary
     generations due to padding.
+    Temperature, top-k and top-p are applied on a partial top-k of the
+    logits instead of filtering and renormalizing the full vocabulary.
     """
 
     # Check logits for consistency.
     assert logits.ndim == 2, 'expected the logits to be of [b, v] shape.'
-    assert logits.type() == 'torch.cuda.FloatTensor', \
+    assert logits.dtype == torch.float32, \
         'input logits should be floats.'
 
 
@@ -77,26 +129,27 @@ def sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
 
     # Top-k or top-p sampling.
     else:
-        # Clone so we do not modify the inputs,
-        logits = logits.clone()
-        # Apply temperature in place.
+        # Apply temperature out of place so we do not modify the inputs.
         if temperature != 1.0:
-            logits.div_(temperature)
+            logits = logits / temperature
 
+        samples = None
         if top_k > 1:
             assert top_p == 0.0, 'cannot set both top-k and top-p samplings.'
             assert top_k <= logits.size(1), 'top-k is larger than logit size.'
             if vocab_size:
                 assert top_k < vocab_size, 'top-k is larger than vocab size.'
-            modify_logits_for_top_k_filtering(logits, top_k)
+            samples = _sample_from_candidates(logits, top_k, 0.0)
 
         elif top_p > 0.0:
             assert top_p <= 1.0, 'top-p should be in (0, 1].'
-            modify_logits_for_top_p_filtering(logits, top_p)
+            num_candidates = min(TOP_P_NUM_CANDIDATES, logits.size(1))
+            samples = _sample_from_candidates(logits, num_candidates, top_p)
 
-        # After filtering, we need to recalculate the distribution.
-        probs = logits.softmax(dim=-1)
-        samples = torch.multinomial(probs, num_samples=1).view(-1)
+        if samples is None:
+            # After filtering, we need to recalculate the distribution.
+            probs = logits.softmax(dim=-1)
+            samples = torch.multinomial(probs, num_samples=1).view(-1)
 
     # If vocab size is provided, make sure the samples are in
     # in the range [0, vocab-size).
@@ -29,6 +29,7 @@ from megatron import get_signal_handler
 from megatron import get_timers
 from megatron import get_tensorboard_writer
 from megatron import get_current_global_batch_size
+from megatron import get_current_global_tokens
 from megatron import get_num_microbatches
 from megatron import is_last_rank
 from megatron import update_num_microbatches
@@ -504,9 +505,13 @@ def train_step(forward_step_func, data_iterator,
 
     # Update learning rate.
     if update_successful:
-        increment = get_num_microbatches() * \
-                    args.micro_batch_size * \
-                    args.data_parallel_size
+        if getattr(args, 'max_tokens_per_micro_batch', None) is not None:
+            # Token-budget batches: advance by the samples actually seen.
+            increment = get_current_global_batch_size()
+        else:
+            increment = get_num_microbatches() * \
+                        args.micro_batch_size * \
+                        args.data_parallel_size
         opt_param_scheduler.step(increment=increment)
         skipped_iter = 0
     else:
@@ -594,6 +599,9 @@ def training_log(loss_dict, total_loss_dict, learning_rate, iteration,
     # Calculate batch size.
     batch_size = args.micro_batch_size * args.data_parallel_size * \
         get_num_microbatches()
+    batch_tokens = get_current_global_tokens()
+    if batch_tokens is not None:
+        batch_size = get_current_global_batch_size()
 
     total_iterations = total_loss_dict[advanced_iters_key] + \
                        total_loss_dict[skipped_iters_key]
@@ -670,6 +678,8 @@ def training_log(loss_dict, total_loss_dict, learning_rate, iteration,
             elapsed_time_per_iteration * 1000.0)
         log_string += ' learning rate: {:.3E} |'.format(learning_rate)
         log_string += ' global batch size: {:5d} |'.format(batch_size)
+        if batch_tokens is not None:
+            log_string += ' global batch tokens: {:8d} |'.format(batch_tokens)
         for key in total_loss_dict:
             if key not in [advanced_iters_key, skipped_iters_key,
                            nan_iters_key]:
@@ -17,9 +17,12 @@
 
 from functools import partial
 import sys
+import time
+import numpy as np
 import torch
 
 from megatron import get_args, get_num_microbatches
+from megatron import update_current_global_batch
 from megatron import print_rank_0
 from megatron import get_timers
 from megatron import mpu
@@ -103,6 +106,151 @@ def build_data_loader(dataset, micro_batch_size, num_workers, drop_last,
     return data_loader
 
 
+# Trimmed sequence lengths are rounded up to a multiple of this value.
+_TOKEN_BUDGET_PAD_MULTIPLE = 8
+
+
+def _round_up_length(length, max_length):
+    multiple = _TOKEN_BUDGET_PAD_MULTIPLE
+    return min(((length + multiple - 1) // multiple) * multiple, max_length)
+
+
+def get_sample_lengths(dataset):
+    """Number of non-padding tokens of each sample. For multi-sequence
+    samples (e.g. RACE choices) the longest sequence is used."""
+    if hasattr(dataset, 'sample_lengths'):
+        return np.asarray(dataset.sample_lengths, dtype=np.int64)
+
+    start_time = time.time()
+    lengths = np.empty(len(dataset), dtype=np.int64)
+    for idx in range(len(dataset)):
+        padding_mask = np.asarray(dataset[idx]['padding_mask'])
+        lengths[idx] = padding_mask.sum(axis=-1).max()
+    print_rank_0(' > computed lengths of {} samples in {:.2f} seconds'.format(
+        len(dataset), time.time() - start_time))
+    return lengths
+
+
+class TokenBudgetBatchSampler(object):
+    """Distributed batch sampler that fills each micro-batch with samples
+    of similar length up to `max_tokens` padded tokens. Each sample holds
+    `sample_multiplier` sequences of its length (e.g. the RACE choices),
+    which all count towards the budget.
+
+    Samples are shuffled, split into buckets of `bucket_size`, sorted by
+    length within a bucket and greedily packed. All ranks build the same
+    batches from the same seed and take every `world_size`-th one. The
+    number of batches per rank is fixed by the first epoch so that
+    iteration based resumption stays valid; later epochs are truncated or
+    wrapped around to that count.
+    """
+
+    def __init__(self, sample_lengths, max_tokens, bucket_size,
+                 rank, world_size, max_length, seed=0, drop_last=True,
+                 sample_multiplier=1):
+        # Padded tokens of each sample, over all its sequences.
+        self.sample_lengths = np.array(
+            [_round_up_length(int(length), max_length) * sample_multiplier
+             for length in sample_lengths], dtype=np.int64)
+        assert self.sample_lengths.max() <= max_tokens, \
+            'max tokens per micro-batch ({}) is smaller than the longest ' \
+            'sample ({})'.format(max_tokens, self.sample_lengths.max())
+        assert bucket_size > 0
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        num_batches = len(self._build_batches(seed))
+        if drop_last:
+            self.num_batches_per_rank = num_batches // world_size
+        else:
+            self.num_batches_per_rank = \
+                (num_batches + world_size - 1) // world_size
+        assert self.num_batches_per_rank > 0, 'not enough samples for ' \
+            '{} data parallel ranks'.format(world_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _build_batches(self, seed):
+        rng = np.random.RandomState(seed)
+        indices = rng.permutation(len(self.sample_lengths))
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.sample_lengths[bucket],
+                                       kind='stable')]
+            batch = []
+            for idx in bucket:
+                # Bucket is sorted, so the current sample is the longest.
+                length = self.sample_lengths[idx]
+                if batch and length * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                batch.append(int(idx))
+            if batch:
+                batches.append(batch)
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def __iter__(self):
+        batches = self._build_batches(self.seed + self.epoch)
+        num_batches = self.num_batches_per_rank * self.world_size
+        while len(batches) < num_batches:
+            batches.extend(batches[:num_batches - len(batches)])
+        for batch in batches[self.rank:num_batches:self.world_size]:
+            yield batch
+
+    def __len__(self):
+        return self.num_batches_per_rank
+
+
+def token_budget_collate_fn(batch):
+    """Collate samples and trim the padding shared by the whole batch."""
+    batch = torch.utils.data.dataloader.default_collate(batch)
+    max_length = batch['text'].size(-1)
+    length = int(batch['padding_mask'].sum(dim=-1).max())
+    length = _round_up_length(length, max_length)
+    for key in ('text', 'types', 'padding_mask'):
+        batch[key] = batch[key][..., :length].contiguous()
+    return batch
+
+
+def build_token_budget_data_loader(dataset, max_tokens, bucket_size,
+                                   num_workers, drop_last):
+    """Data loader with a variable number of samples per micro-batch."""
+    args = get_args()
+
+    batch_sampler = TokenBudgetBatchSampler(
+        get_sample_lengths(dataset), max_tokens, bucket_size,
+        mpu.get_data_parallel_rank(), mpu.get_data_parallel_world_size(),
+        args.seq_length, drop_last=drop_last,
+        sample_multiplier=getattr(dataset, 'sample_multiplier', 1))
+
+    data_loader = torch.utils.data.DataLoader(dataset,
+                                              batch_sampler=batch_sampler,
+                                              num_workers=num_workers,
+                                              pin_memory=True,
+                                              collate_fn=token_budget_collate_fn)
+
+    return data_loader
+
+
+def _update_token_budget_global_batch(batch):
+    """Report the samples and non-padding tokens of a token-budget batch,
+    summed over the data parallel group, to the micro-batch calculator."""
+    text = batch['text']
+    counts = torch.cuda.LongTensor([text.numel() // text.size(-1),
+                                    int(batch['padding_mask'].sum())])
+    torch.distributed.all_reduce(counts,
+                                 group=mpu.get_data_parallel_group())
+    global_samples, global_tokens = counts.tolist()
+    update_current_global_batch(global_samples, global_tokens)
+
+
 def _build_infinite_size_dataloader(dataloader):
     """Build a looped dataloader with infinite size."""
 
@@ -121,9 +269,22 @@ def _build_train_valid_dataloaders(train_dataset, valid_dataset,
 
     print_rank_0('building train and validation dataloaders ...')
     # Training dataset.
-    train_dataloader = build_data_loader(train_dataset, args.micro_batch_size,
-                                         args.num_workers, not args.keep_last,
-                                         task_collate_fn)
+    if args.max_tokens_per_micro_batch is not None:
+        assert task_collate_fn is None, \
+            'token-budget batching does not support task collate functions'
+        assert mpu.get_pipeline_model_parallel_world_size() == 1, \
+            'token-budget batching requires static shapes across ' \
+            'pipeline stages'
+        train_dataloader = build_token_budget_data_loader(
+            train_dataset, args.max_tokens_per_micro_batch,
+            args.token_budget_bucket_size, args.num_workers,
+            not args.keep_last)
+    else:
+        train_dataloader = build_data_loader(train_dataset,
+                                             args.micro_batch_size,
+                                             args.num_workers,
+                                             not args.keep_last,
+                                             task_collate_fn)
     # Set the training iterations.
     args.train_iters_per_epoch = len(train_dataloader)
     args.train_iters = args.epochs * args.train_iters_per_epoch
@@ -149,6 +310,20 @@ def _build_train_valid_dataloaders(train_dataset, valid_dataset,
         # account for that when setting the micro batch size.
         args.micro_batch_size *= train_dataset.sample_multiplier
         args.global_batch_size *= train_dataset.sample_multiplier
+    if args.max_tokens_per_micro_batch is not None:
+        # Batches hold a variable number of samples. Use the average
+        # global batch size so sample-based LR warmup and decay cover
+        # the whole run. Only the LR scheduler, built after the data
+        # loaders, reads this value: the micro-batch calculator was built
+        # from the nominal one at initialization and gets the actual size
+        # of every batch from _update_token_budget_global_batch.
+        num_sequences = len(train_dataset) * \
+            getattr(train_dataset, 'sample_multiplier', 1)
+        args.global_batch_size = max(
+            1, num_sequences // args.train_iters_per_epoch)
+        print_rank_0(' > token-budget batching: {} iterations per epoch, '
+                     'average global batch size {}'.format(
+                         args.train_iters_per_epoch, args.global_batch_size))
 
     return train_dataloader, valid_dataloader
 
@@ -182,7 +357,10 @@ def _train(model, optimizer, lr_scheduler, forward_step,
         print_rank_0('working on epoch {} ...'.format(epoch + 1))
 
         # Set the data loader epoch to shuffle the index iterator.
-        train_dataloader.sampler.set_epoch(args.seed + epoch)
+        if args.max_tokens_per_micro_batch is not None:
+            train_dataloader.batch_sampler.set_epoch(args.seed + epoch)
+        else:
+            train_dataloader.sampler.set_epoch(args.seed + epoch)
 
         # For all the batches in the dataset.
         for iteration_, batch in enumerate(train_dataloader):
@@ -193,6 +371,9 @@ def _train(model, optimizer, lr_scheduler, forward_step,
             # Set to zero so the next epoch does not skip any batches.
             start_iteration = 0
 
+            if args.max_tokens_per_micro_batch is not None:
+                _update_token_budget_global_batch(batch)
+
             # Train for one step.
             out = train_step(forward_step, batch, model, optimizer, lr_scheduler)
 
@@ -38,6 +38,16 @@ def get_tasks_args(parser):
     group.add_argument('--keep-last', action='store_true',
                        help='Keep the last batch (maybe incomplete) in'
                        'the data loader')
+    group.add_argument('--max-tokens-per-micro-batch', type=int, default=None,
+                       help='If set, fill each finetuning micro-batch with '
+                       'length-bucketed samples up to this many padded '
+                       'tokens instead of using a fixed micro-batch size. All '
+                       'sequences of multi-sequence samples (e.g. RACE '
+                       'choices) count towards the budget.')
+    group.add_argument('--token-budget-bucket-size', type=int, default=1000,
+                       help='Number of shuffled samples that are sorted by '
+                       'length together when building token-budget '
+                       'micro-batches.')
     group.add_argument('--train-data', nargs='+', default=None,
                        help='Whitespace separated paths or corpora names '
                        'for training.')
@@ -47,6 +57,11 @@ def get_tasks_args(parser):
                        help='Sliding window for overlapping evaluation.')
     group.add_argument('--strict-lambada', action='store_true',
                        help='Use more difficult formulation of lambada.')
+    group.add_argument('--packed-zeroshot-eval', action='store_true',
+                       help='Pack several lambada examples per sequence with '
+                       'separate attention segments, and only compute '
+                       'logits for the scored tokens of overlapping '
+                       'wikitext windows.')
     # Retriever args
     group.add_argument('--qa-data-dev', type=str, default=None,
                        help='Path to the QA dataset dev file.')
@@ -126,6 +126,67 @@ class _LambadaDataset(torch.utils.data.Dataset):
         return {'text': np.array(tokens), 'pad_mask': pad_mask}
 
 
+class _PackedLambadaDataset(torch.utils.data.Dataset):
+    """Packs consecutive lambada examples into full sequences. Each example
+    is a separate attention segment with position ids starting at zero, so
+    predictions match evaluating the examples one by one."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.seq_len = dataset.seq_len
+        self.pad_idx = dataset.pad_idx
+        self.num_examples = len(dataset)
+
+        self.packs = []
+        pack = []
+        pack_length = 0
+        for idx in range(len(dataset)):
+            length = len(dataset.tokens[idx]) + len(dataset.labels[idx])
+            assert length <= self.seq_len + 1, \
+                'lambada example {} is longer than the sequence ' \
+                'length'.format(idx)
+            if pack and pack_length + length > self.seq_len + 1:
+                self.packs.append(pack)
+                pack = []
+                pack_length = 0
+            pack.append(idx)
+            pack_length += length
+        if pack:
+            self.packs.append(pack)
+        print_rank_0(' > packed {} lambada examples into {} '
+                     'sequences'.format(self.num_examples, len(self.packs)))
+
+    def __len__(self):
+        return len(self.packs)
+
+    def __getitem__(self, idx):
+        tokens = []
+        pad_mask = []
+        segment_ids = []
+        position_ids = []
+        for segment, example_idx in enumerate(self.packs[idx]):
+            context = self.dataset.tokens[example_idx]
+            labels = self.dataset.labels[example_idx]
+            num_tokens = len(context) + len(labels)
+            tokens += context + labels
+            pad_mask += [0] * len(context) + [1] * len(labels)
+            segment_ids += [segment] * num_tokens
+            position_ids += list(range(num_tokens))
+        num_pad = self.seq_len + 1 - len(tokens)
+        tokens += [self.pad_idx] * num_pad
+        pad_mask += [0] * num_pad
+        # Padding gets its own segment, past any real segment index.
+        segment_ids += [self.seq_len] * num_pad
+        position_ids += [0] * num_pad
+
+        # Inputs are tokens[:-1] and targets are tokens[1:].
+        return {'text': np.array(tokens),
+                'pad_mask': np.array(pad_mask[1:]),
+                'segment_ids': np.array(segment_ids[:-1]),
+                'position_ids': np.array(position_ids[:-1]),
+                'num_segments': len(self.packs[idx])}
+
+
 def _build_lambada_dataset():
     """Build lambada dataset."""
     args = get_args()
@@ -135,6 +196,8 @@ def _build_lambada_dataset():
     val_dataset = _LambadaDataset(args.valid_data[0], tokenizer.eod, tokenizer,
                                   args.seq_length, args.strict_lambada)
     print_rank_0(' > found {} samples.'.format(len(val_dataset)))
+    if args.packed_zeroshot_eval:
+        val_dataset = _PackedLambadaDataset(val_dataset)
 
     return val_dataset
 
@@ -16,6 +16,7 @@
 """GPT zero-shot evaluation."""
 
 import math
+import time
 
 import torch
 
@@ -25,6 +26,7 @@ from megatron import get_tokenizer
 from megatron import mpu
 from megatron.checkpointing import load_checkpoint
 from megatron.model import GPTModel
+from megatron.model.gpt_model import post_language_model_processing
 from megatron.training import get_model
 from megatron.utils import get_ltor_masks_and_position_ids, unwrap_model
 from megatron.p2p_communication import recv_forward, send_forward
@@ -82,8 +84,108 @@ def process_batch(batch):
     return tokens, labels, attention_mask, position_ids, loss_mask
 
 
+def process_packed_batch(batch):
+    """Process a batch of packed examples. Tokens only attend to earlier
+    tokens of the same segment."""
+
+    loss_mask = batch['pad_mask'].long().cuda().contiguous().byte()
+    tokens_ = batch['text'].long().cuda().contiguous()
+    labels = tokens_[:, 1:].contiguous()
+    tokens = tokens_[:, :-1].contiguous()
+    segment_ids = batch['segment_ids'].long().cuda().contiguous()
+    position_ids = batch['position_ids'].long().cuda().contiguous()
+
+    # Causal block-diagonal mask, True marks masked out positions.
+    seq_length = tokens.size(1)
+    causal = torch.tril(torch.ones((seq_length, seq_length),
+                                   dtype=torch.bool, device=tokens.device))
+    same_segment = segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)
+    attention_mask = (~(causal & same_segment)).unsqueeze(1)
+
+    return tokens, labels, attention_mask, position_ids, loss_mask, \
+        segment_ids
+
+
+def _packed_accuracy_forward_step(batch, model):
+    """Forward step for packed lambada examples. Returns the number of
+    examples whose label tokens are all predicted correctly."""
+
+    tokens, labels, attention_mask, position_ids, loss_mask, segment_ids = \
+        process_packed_batch(batch)
+
+    args = get_args()
+    args.micro_batch_size = len(labels)
+
+    input_tensor = recv_forward()
+
+    unwrapped_model = unwrap_model(
+        model, (torchDDP, LocalDDP, Float16Module))
+    unwrapped_model.set_input_tensor(input_tensor)
+    output = model(tokens, position_ids, attention_mask)
+
+    send_forward(output)
+
+    if mpu.is_pipeline_last_stage():
+        outputs = torch.argmax(output, -1)
+        wrong = ((outputs != labels) & loss_mask.bool()).long()
+        # Padding is segment seq_length and never has wrong tokens.
+        wrong_per_segment = torch.zeros(
+            (wrong.size(0), wrong.size(1) + 1), dtype=torch.long,
+            device=wrong.device).scatter_add_(1, segment_ids, wrong)
+        num_wrong = (wrong_per_segment > 0).sum()
+        num_examples = batch['num_segments'].sum().cuda()
+        return (num_examples - num_wrong).float()
+    return None
+
+
+def _scored_loss_forward_step(batch, model):
+    """Forward step for overlapping windows that only computes the logits
+    of the tokens that are scored. The overlapped context still goes
+    through the transformer but skips the output layer and the loss."""
+
+    tokens, labels, attention_mask, position_ids, loss_mask = process_batch(
+        batch)
+
+    args = get_args()
+    args.micro_batch_size = len(labels)
+
+    # First scored position in the batch, computed from the host copy so
+    # there is no device synchronization.
+    scored = torch.nonzero(batch['pad_mask'].sum(dim=0))
+    first_scored = int(scored[0]) if len(scored) > 0 else 0
+
+    input_tensor = recv_forward()
+
+    unwrapped_model = unwrap_model(
+        model, (torchDDP, LocalDDP, Float16Module))
+    unwrapped_model.set_input_tensor(input_tensor)
+    output = unwrapped_model.language_model(tokens, position_ids,
+                                            attention_mask)
+
+    send_forward(output)
+
+    if mpu.is_pipeline_last_stage():
+        # [s, b, h] language model output, keep the scored positions.
+        output = output[first_scored:]
+        losses = post_language_model_processing(
+            output, labels[:, first_scored:],
+            unwrapped_model.word_embeddings_weight(),
+            unwrapped_model.parallel_output,
+            False)
+        loss = torch.sum(losses.view(-1).float() *
+                         loss_mask[:, first_scored:].contiguous().view(-1).float())
+        return loss
+    return None
+
+
 def forward_step(batch, model, eval_metric):
     """Forward step."""
+    args = get_args()
+    if args.packed_zeroshot_eval:
+        if eval_metric == 'accuracy':
+            return _packed_accuracy_forward_step(batch, model)
+        if eval_metric == 'loss':
+            return _scored_loss_forward_step(batch, model)
 
     # Get the batch.
     tokens, labels, attention_mask, position_ids, loss_mask = process_batch(
@@ -155,7 +257,16 @@ def evaluate_and_print_results(task, data_loader, model, eval_metric):
     """Evaluate and print results on screen."""
 
     # Evaluate and get results.
+    torch.distributed.barrier()
+    start_time = time.time()
     output = evaluate(data_loader, model, eval_metric)
+    torch.distributed.barrier()
+    elapsed_time = time.time() - start_time
+
+    args = get_args()
+    num_sequences = len(data_loader.dataset)
+    num_examples = getattr(data_loader.dataset, 'num_examples',
+                           num_sequences)
 
     string = ' validation results on {} | '.format(task)
     if is_last_rank():
@@ -169,19 +280,23 @@ def evaluate_and_print_results(task, data_loader, model, eval_metric):
             string += 'avg loss: {:.4E} | '.format(val_loss)
             string += 'ppl: {:.4E} | '.format(ppl)
             string += 'adjusted ppl: {:.4E} | '.format(adjusted_ppl)
-            string += 'token ratio: {} |'.format(token_ratio)
+            string += 'token ratio: {} | '.format(token_ratio)
 
         elif eval_metric == 'accuracy':
-            num_examples = len(data_loader.dataset)
             acc = output / num_examples
             string += 'number correct: {:.4E} | '.format(output)
             string += 'total examples: {:.4E} | '.format(num_examples)
-            string += 'avg accuracy: {:.4E}'.format(acc)
+            string += 'avg accuracy: {:.4E} | '.format(acc)
 
         else:
             raise NotImplementedError('evaluation method for {} metric is not '
                                       'implemented yet.'.format(eval_metric))
 
+        string += 'elapsed time (s): {:.2f} | '.format(elapsed_time)
+        string += 'examples/s: {:.1f} | '.format(num_examples / elapsed_time)
+        string += 'tokens/s: {:.1f}'.format(
+            num_sequences * args.seq_length / elapsed_time)
+
         length = len(string) + 1
         print('-' * length)
         print(string)
@@ -204,6 +319,12 @@ def main():
         raise NotImplementedError('{} task is not implemented.'.format(
             args.task))
 
+    if args.packed_zeroshot_eval and eval_metric == 'accuracy':
+        # The fused causal softmax kernel ignores the attention mask, which
+        # would let packed examples attend to each other.
+        assert not args.masked_softmax_fusion, \
+            'packed lambada evaluation requires --no-masked-softmax-fusion'
+
     # Set up model and load checkpoint.
     model = get_model(get_model_provider(eval_metric), wrap_with_ddp=False)
     if args.load is not None:
@@ -0,0 +1,127 @@
+# coding=utf-8
+# Copyright (c) 2022, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark of the token sampling used during text generation.
+
+Compares the partial top-k sampling in megatron.text_generation.sampling
+against filtering and renormalizing the full vocabulary, for a range of
+vocabulary and batch sizes. Runs on GPU if available, otherwise on CPU.
+"""
+
+import argparse
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+import time
+
+import torch
+
+from megatron.text_generation.sampling import (
+    modify_logits_for_top_k_filtering,
+    modify_logits_for_top_p_filtering,
+    sample)
+
+
+def full_vocab_sample(logits, top_k=0, top_p=0.0, temperature=1.0):
+    """Reference sampling that filters the full vocabulary."""
+    logits = logits.clone()
+    if temperature != 1.0:
+        logits.div_(temperature)
+    if top_k > 1:
+        modify_logits_for_top_k_filtering(logits, top_k)
+    elif top_p > 0.0:
+        modify_logits_for_top_p_filtering(logits, top_p)
+    probs = logits.softmax(dim=-1)
+    return torch.multinomial(probs, num_samples=1).view(-1)
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_sampling(sample_func, logits, iterations, warmup, **kwargs):
+    """Return generated tokens per second."""
+    for _ in range(warmup):
+        sample_func(logits, **kwargs)
+    _synchronize(logits.device)
+    start_time = time.time()
+    for _ in range(iterations):
+        sample_func(logits, **kwargs)
+    _synchronize(logits.device)
+    elapsed = time.time() - start_time
+    return logits.size(0) * iterations / elapsed
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    group = parser.add_argument_group(title='benchmark')
+    group.add_argument('--vocab-sizes', type=int, nargs='+',
+                       default=[32000, 50304, 128000],
+                       help='Vocabulary sizes to benchmark.')
+    group.add_argument('--batch-sizes', type=int, nargs='+',
+                       default=[1, 8, 64],
+                       help='Batch sizes to benchmark.')
+    group.add_argument('--top-k', type=int, default=0,
+                       help='Top-k sampling parameter.')
+    group.add_argument('--top-p', type=float, default=0.9,
+                       help='Top-p sampling parameter.')
+    group.add_argument('--temperature', type=float, default=1.0,
+                       help='Sampling temperature.')
+    group.add_argument('--iterations', type=int, default=100,
+                       help='Number of timed sampling steps.')
+    group.add_argument('--warmup', type=int, default=10,
+                       help='Number of untimed sampling steps.')
+    group.add_argument('--seed', type=int, default=1234,
+                       help='Random seed for the synthetic logits.')
+    args = parser.parse_args()
+
+    if args.top_k > 0 and args.top_p > 0.0:
+        print('top-k and top-p are exclusive, ignoring top-p.')
+        args.top_p = 0.0
+
+    return args
+
+
+def main():
+    args = get_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(args.seed)
+    print('> benchmarking sampling on {} with top-k {}, top-p {}, '
+          'temperature {}'.format(device, args.top_k, args.top_p,
+                                  args.temperature), flush=True)
+
+    kwargs = dict(top_k=args.top_k, top_p=args.top_p,
+                  temperature=args.temperature)
+    print('{:>10} {:>8} {:>18} {:>18} {:>8}'.format(
+        'vocab', 'batch', 'full (tokens/s)', 'partial (tokens/s)',
+        'speedup'))
+    for vocab_size in args.vocab_sizes:
+        for batch_size in args.batch_sizes:
+            # Scaled normal logits give a nucleus of realistic size.
+            logits = torch.randn(batch_size, vocab_size, device=device,
+                                 dtype=torch.float32) * 4.0
+            full = time_sampling(full_vocab_sample, logits,
+                                 args.iterations, args.warmup, **kwargs)
+            partial = time_sampling(sample, logits,
+                                    args.iterations, args.warmup, **kwargs)
+            print('{:>10d} {:>8d} {:>18.1f} {:>18.1f} {:>7.2f}x'.format(
+                vocab_size, batch_size, full, partial, partial / full),
+                flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+# coding=utf-8
+# Copyright (c) 2022, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Validate an mmap indexed dataset and collect statistics.
+
+The .idx arrays are memory mapped and checked in chunks, and the .bin file
+is read in large sequential blocks of whole documents by a thread pool,
+without building an MMapIndexedDataset or warming up the page cache. The
+statistics are written next to the dataset as <prefix>_stats.npz (tokens
+per document, token histogram and duplicate documents) and a json summary.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import struct
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+import time
+
+import numpy as np
+
+from megatron.data import indexed_dataset
+
+
+# Number of index entries checked at once.
+_INDEX_CHUNK = 1 << 24
+
+
+class IndexReader(object):
+    """Memory maps the arrays of an mmap .idx file without warmup."""
+
+    def __init__(self, path):
+        magic = indexed_dataset.MMapIndexedDataset.Index._HDR_MAGIC
+        with open(path, 'rb') as stream:
+            magic_test = stream.read(len(magic))
+            if magic_test != magic:
+                raise ValueError('{} is not an mmap index file'.format(path))
+            version, = struct.unpack('<Q', stream.read(8))
+            if version != 1:
+                raise ValueError('unsupported index version {}'.format(
+                    version))
+            dtype_code, = struct.unpack('<B', stream.read(1))
+            self.dtype = np.dtype(indexed_dataset.dtypes[dtype_code])
+            self.num_sequences, = struct.unpack('<Q', stream.read(8))
+            self.doc_count, = struct.unpack('<Q', stream.read(8))
+            offset = stream.tell()
+
+        self.expected_size = offset + self.num_sequences * (4 + 8) + \
+            self.doc_count * 8
+        self.file_size = os.path.getsize(path)
+        if self.file_size != self.expected_size:
+            raise ValueError('index file is {} bytes, header implies {} '
+                             'bytes'.format(self.file_size,
+                                            self.expected_size))
+
+        self.sizes = np.memmap(path, dtype=np.int32, mode='r',
+                               offset=offset, shape=(self.num_sequences,))
+        offset += self.num_sequences * 4
+        self.pointers = np.memmap(path, dtype=np.int64, mode='r',
+                                  offset=offset, shape=(self.num_sequences,))
+        offset += self.num_sequences * 8
+        self.doc_idx = np.memmap(path, dtype=np.int64, mode='r',
+                                 offset=offset, shape=(self.doc_count,))
+
+
+def check_index(index, data_size):
+    """Check sizes, pointers and document index against each other and the
+    size of the .bin file. Returns a list of error strings."""
+    errors = []
+    itemsize = index.dtype.itemsize
+    n = index.num_sequences
+
+    if n > 0 and index.pointers[0] != 0:
+        errors.append('first pointer is {}, expected 0'.format(
+            index.pointers[0]))
+    for start in range(0, n, _INDEX_CHUNK):
+        end = min(start + _INDEX_CHUNK + 1, n)
+        sizes = np.asarray(index.sizes[start:end], dtype=np.int64)
+        pointers = np.asarray(index.pointers[start:end])
+        bad = np.nonzero(sizes < 0)[0]
+        if len(bad) > 0:
+            errors.append('{} negative sizes, first at sequence {}'.format(
+                len(bad), start + bad[0]))
+        expected = pointers[:-1] + sizes[:-1] * itemsize
+        bad = np.nonzero(expected != pointers[1:])[0]
+        if len(bad) > 0:
+            errors.append('{} pointers do not follow the previous size, '
+                          'first at sequence {}'.format(len(bad),
+                                                       start + bad[0] + 1))
+    if n > 0:
+        end = int(index.pointers[-1]) + int(index.sizes[-1]) * itemsize
+    else:
+        end = 0
+    if end != data_size:
+        errors.append('sequences end at byte {}, data file has {} '
+                      'bytes'.format(end, data_size))
+
+    doc_idx = np.asarray(index.doc_idx)
+    if index.doc_count == 0 or doc_idx[0] != 0:
+        errors.append('document index does not start at 0')
+    elif doc_idx[-1] != n:
+        errors.append('document index ends at {}, expected {}'.format(
+            doc_idx[-1], n))
+    bad = np.nonzero(np.diff(doc_idx) < 0)[0]
+    if len(bad) > 0:
+        errors.append('{} decreasing document index entries, first at '
+                      'document {}'.format(len(bad), bad[0] + 1))
+
+    return errors
+
+
+def get_document_offsets(index, data_size):
+    """Byte offset of the start of each document, plus the end offset."""
+    doc_idx = np.asarray(index.doc_idx)
+    offsets = np.full(len(doc_idx), data_size, dtype=np.int64)
+    valid = doc_idx < index.num_sequences
+    offsets[valid] = index.pointers[doc_idx[valid]]
+    return offsets
+
+
+def split_documents(doc_offsets, chunk_bytes):
+    """Split documents into contiguous ranges of about chunk_bytes."""
+    num_docs = len(doc_offsets) - 1
+    boundaries = [0]
+    while boundaries[-1] < num_docs:
+        start = boundaries[-1]
+        end = int(np.searchsorted(doc_offsets, doc_offsets[start] + chunk_bytes,
+                                  side='right')) - 1
+        boundaries.append(min(max(end, start + 1), num_docs))
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+class ChunkScanner(object):
+    """Reads a range of documents from the .bin file and computes their
+    token histogram and content hashes."""
+
+    def __init__(self, data_path, dtype, doc_offsets, vocab_size):
+        self.fd = os.open(data_path, os.O_RDONLY)
+        self.dtype = dtype
+        self.doc_offsets = doc_offsets
+        self.vocab_size = vocab_size
+
+    def close(self):
+        os.close(self.fd)
+
+    def _read(self, start, length):
+        buffer = bytearray(length)
+        view = memoryview(buffer)
+        read = 0
+        while read < length:
+            data = os.pread(self.fd, length - read, start + read)
+            if not data:
+                raise IOError('unexpected end of data file at byte {}'.format(
+                    start + read))
+            view[read:read + len(data)] = data
+            read += len(data)
+        return buffer
+
+    def __call__(self, doc_range):
+        first, last = doc_range
+        start = int(self.doc_offsets[first])
+        end = int(self.doc_offsets[last])
+        buffer = self._read(start, end - start)
+        tokens = np.frombuffer(buffer, dtype=self.dtype)
+
+        if len(tokens) > 0:
+            min_token = int(tokens.min())
+            max_token = int(tokens.max())
+        else:
+            min_token, max_token = 0, -1
+        if min_token < 0:
+            counts = None
+        else:
+            counts = np.bincount(tokens, minlength=self.vocab_size)
+
+        hashes = np.empty(last - first, dtype=np.uint64)
+        bounds = self.doc_offsets[first:last + 1] - start
+        for i in range(last - first):
+            digest = hashlib.blake2b(buffer[bounds[i]:bounds[i + 1]],
+                                     digest_size=8).digest()
+            hashes[i] = int.from_bytes(digest, 'little')
+
+        return counts, hashes, min_token, max_token
+
+
+def find_duplicates(hashes):
+    """For each document, the index of the first document with the same
+    content, or -1 if it is the first occurrence."""
+    _, first, inverse = np.unique(hashes, return_index=True,
+                                  return_inverse=True)
+    duplicate_of = first[inverse].astype(np.int64)
+    duplicate_of[duplicate_of == np.arange(len(hashes))] = -1
+    return duplicate_of
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    group = parser.add_argument_group(title='input data')
+    group.add_argument('--data-path', type=str, required=True,
+                       help='Path to the dataset without .bin/.idx suffix')
+    group.add_argument('--vocab-size', type=int, default=None,
+                       help='If set, report token ids outside of the '
+                       'vocabulary as errors.')
+
+    group = parser.add_argument_group(title='output data')
+    group.add_argument('--output-prefix', type=str, default=None,
+                       help='Output path without suffix, defaults to '
+                       '<data-path>_stats')
+
+    group = parser.add_argument_group(title='runtime')
+    group.add_argument('--workers', type=int, default=8,
+                       help='Number of reader threads')
+    group.add_argument('--chunk-size-mb', type=int, default=256,
+                       help='Approximate size of each sequential read')
+    group.add_argument('--log-interval', type=int, default=100,
+                       help='Interval between progress updates in chunks')
+    args = parser.parse_args()
+
+    if args.output_prefix is None:
+        args.output_prefix = args.data_path + '_stats'
+
+    return args
+
+
+def main():
+    args = get_args()
+    start_time = time.time()
+
+    index_path = indexed_dataset.index_file_path(args.data_path)
+    data_path = indexed_dataset.data_file_path(args.data_path)
+    print('Opening', index_path)
+    index = IndexReader(index_path)
+    data_size = os.path.getsize(data_path)
+    print(f'{index.num_sequences} sequences, {index.doc_count - 1} documents, '
+          f'dtype {index.dtype}, {data_size / 1024 ** 3:.2f} GB of data')
+
+    errors = check_index(index, data_size)
+    for error in errors:
+        print('ERROR:', error, file=sys.stderr)
+    if errors:
+        print('Index is inconsistent, not scanning the data file.')
+        sys.exit(1)
+    print(f'Index is consistent ({time.time() - start_time:.1f} s)')
+
+    doc_offsets = get_document_offsets(index, data_size)
+    doc_tokens = np.diff(doc_offsets) // index.dtype.itemsize
+    num_docs = len(doc_tokens)
+    doc_ranges = split_documents(doc_offsets,
+                                 args.chunk_size_mb * 1024 * 1024)
+
+    vocab_size = args.vocab_size or 0
+    token_counts = np.zeros(vocab_size, dtype=np.int64)
+    doc_hashes = np.empty(num_docs, dtype=np.uint64)
+    min_token, max_token = 0, -1
+    scanner = ChunkScanner(data_path, index.dtype, doc_offsets, vocab_size)
+    scan_start = time.time()
+    bytes_read = 0
+    with ThreadPoolExecutor(args.workers) as executor:
+        # Keep a bounded number of chunks in flight to bound memory.
+        pending = []
+        next_range = 0
+        done = 0
+        while done < len(doc_ranges):
+            while next_range < len(doc_ranges) and \
+                  len(pending) < 2 * args.workers:
+                pending.append((doc_ranges[next_range],
+                                executor.submit(scanner,
+                                                doc_ranges[next_range])))
+                next_range += 1
+            (first, last), future = pending.pop(0)
+            counts, hashes, chunk_min, chunk_max = future.result()
+            if chunk_min < 0:
+                errors.append('negative token id in documents {} to '
+                              '{}'.format(first, last))
+            elif len(counts) > len(token_counts):
+                counts[:len(token_counts)] += token_counts
+                token_counts = counts.astype(np.int64)
+            else:
+                token_counts[:len(counts)] += counts
+            doc_hashes[first:last] = hashes
+            if chunk_max >= 0:
+                min_token = min(min_token, chunk_min)
+                max_token = max(max_token, chunk_max)
+            bytes_read += int(doc_offsets[last] - doc_offsets[first])
+            done += 1
+            if done % args.log_interval == 0:
+                elapsed = time.time() - scan_start
+                print(f'Scanned {done}/{len(doc_ranges)} chunks '
+                      f'({bytes_read / elapsed / 1024 ** 2:.1f} MB/s).',
+                      file=sys.stderr)
+    scanner.close()
+
+    if args.vocab_size is not None and max_token >= args.vocab_size:
+        errors.append('token id {} is outside of the vocabulary of size '
+                      '{}'.format(max_token, args.vocab_size))
+
+    duplicate_of = find_duplicates(doc_hashes)
+    # Empty documents all hash the same but are not duplicates of anything.
+    duplicate_of[doc_tokens == 0] = -1
+    is_duplicate = duplicate_of >= 0
+    summary = {
+        'data_path': args.data_path,
+        'dtype': str(index.dtype),
+        'num_sequences': int(index.num_sequences),
+        'num_documents': int(num_docs),
+        'num_tokens': int(doc_tokens.sum()),
+        'num_empty_documents': int((doc_tokens == 0).sum()),
+        'num_duplicate_documents': int(is_duplicate.sum()),
+        'num_duplicate_tokens': int(doc_tokens[is_duplicate].sum()),
+        'num_distinct_token_ids': int((token_counts > 0).sum()),
+        'max_token_id': int(max_token),
+        'document_tokens_percentiles': {
+            str(p): float(np.percentile(doc_tokens, p)) if num_docs else 0.0
+            for p in (0, 50, 90, 99, 100)},
+        'errors': errors,
+    }
+
+    np.savez(args.output_prefix + '.npz',
+             document_tokens=doc_tokens,
+             document_hashes=doc_hashes,
+             duplicate_of=duplicate_of,
+             token_counts=token_counts)
+    with open(args.output_prefix + '.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    elapsed = time.time() - start_time
+    print(json.dumps(summary, indent=2))
+    print(f'Wrote {args.output_prefix}.npz and {args.output_prefix}.json '
+          f'in {elapsed:.1f} s ({data_size / elapsed / 1024 ** 2:.1f} MB/s).')
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+# coding=utf-8
+# Copyright (c) 2022, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Approximate document deduplication of JSON lines before preprocessing.
+
+MinHash signatures of word n-gram shingles are computed by a pool of
+worker processes. Documents are bucketed with locality sensitive hashing
+over bands of the signature, and a candidate is dropped if the estimated
+Jaccard similarity with an already kept document reaches the threshold.
+LSH buckets and signatures of kept documents are stored in an sqlite
+index, so later shards can be deduplicated against earlier ones by
+passing the same --index-path.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import time
+import zlib
+
+import numpy as np
+
+
+# Minhash permutations are (a * x + b) mod _MERSENNE_PRIME on 32-bit
+# shingle hashes, which fits in 64-bit integer arithmetic.
+_MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+
+
+def fingerprint(path, block_size=1 << 20):
+    """Identifies a shard by its size and the hash of its first block, so
+    that shards with the same name in different directories differ."""
+    with open(path, 'rb') as f:
+        digest = hashlib.blake2b(f.read(block_size), digest_size=16)
+    return '{}:{}'.format(os.path.getsize(path), digest.hexdigest())
+
+
+def open_file(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class Encoder(object):
+    def __init__(self, args):
+        self.args = args
+
+    def initializer(self):
+        # Use Encoder class as a container for global data
+        rng = np.random.RandomState(self.args.seed)
+        Encoder.a = rng.randint(1, int(_MERSENNE_PRIME),
+                                size=self.args.num_perm).astype(np.uint64)
+        Encoder.b = rng.randint(0, int(_MERSENNE_PRIME),
+                                size=self.args.num_perm).astype(np.uint64)
+
+    def shingles(self, text):
+        words = re.findall(r'\w+', text.lower())
+        ngram = self.args.ngram
+        if len(words) < ngram:
+            return [' '.join(words)] if words else []
+        return [' '.join(words[i:i + ngram])
+                for i in range(len(words) - ngram + 1)]
+
+    def encode(self, json_line):
+        data = json.loads(json_line)
+        shingles = self.shingles(data[self.args.json_key])
+        if len(shingles) == 0:
+            return json_line, None
+        hashes = np.fromiter((zlib.crc32(s.encode('utf-8'))
+                              for s in set(shingles)),
+                             dtype=np.uint64) % _MERSENNE_PRIME
+        # [num_perm, num_shingles] -> [num_perm]
+        permuted = (Encoder.a[:, None] * hashes[None, :] +
+                    Encoder.b[:, None]) % _MERSENNE_PRIME
+        signature = permuted.min(axis=1).astype(np.uint32)
+        return json_line, signature.tobytes()
+
+
+class LSHIndex(object):
+    """On-disk LSH buckets and signatures of the kept documents."""
+
+    def __init__(self, path, num_perm, num_bands, seed, ngram):
+        assert num_perm % num_bands == 0, \
+            'number of permutations must be divisible by number of bands'
+        self.num_bands = num_bands
+        self.rows = num_perm // num_bands
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS config (num_perm INTEGER, '
+            'num_bands INTEGER, seed INTEGER, ngram INTEGER)')
+        columns = [row[1] for row in
+                   self.connection.execute('PRAGMA table_info(config)')]
+        if 'ngram' not in columns:
+            raise ValueError('index {} does not record its shingle size, '
+                             'rebuild it'.format(path))
+        config = self.connection.execute(
+            'SELECT num_perm, num_bands, seed, ngram FROM config').fetchone()
+        if config is None:
+            self.connection.execute('INSERT INTO config VALUES (?, ?, ?, ?)',
+                                    (num_perm, num_bands, seed, ngram))
+        elif tuple(config) != (num_perm, num_bands, seed, ngram):
+            raise ValueError('index {} was built with {} permutations, {} '
+                             'bands, seed {} and {}-word shingles'.format(
+                                 path, *config))
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, '
+            'source TEXT, fingerprint TEXT, line INTEGER, signature BLOB)')
+        columns = [row[1] for row in
+                   self.connection.execute('PRAGMA table_info(documents)')]
+        if 'fingerprint' not in columns:
+            raise ValueError('index {} does not record the fingerprint of '
+                             'its shards, rebuild it'.format(path))
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS documents_fingerprint_line '
+            'ON documents (fingerprint, line)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS buckets (band INTEGER, key INTEGER, '
+            'document INTEGER, PRIMARY KEY (band, key, document))')
+
+    def band_keys(self, signature):
+        keys = []
+        band_bytes = self.rows * 4
+        for band in range(self.num_bands):
+            digest = hashlib.blake2b(
+                signature[band * band_bytes:(band + 1) * band_bytes],
+                digest_size=8).digest()
+            keys.append(int.from_bytes(digest, 'little', signed=True))
+        return keys
+
+    def find_duplicate(self, signature, keys, threshold):
+        """Return (document id, similarity) of a kept document with
+        estimated Jaccard similarity >= threshold, or None."""
+        candidates = set()
+        for band, key in enumerate(keys):
+            for row in self.connection.execute(
+                    'SELECT document FROM buckets WHERE band = ? AND key = ?',
+                    (band, key)):
+                candidates.add(row[0])
+        values = np.frombuffer(signature, dtype=np.uint32)
+        for document in sorted(candidates):
+            other, = self.connection.execute(
+                'SELECT signature FROM documents WHERE id = ?',
+                (document,)).fetchone()
+            similarity = float(np.mean(
+                values == np.frombuffer(other, dtype=np.uint32)))
+            if similarity >= threshold:
+                return document, similarity
+        return None
+
+    def contains(self, fingerprint, line):
+        """Whether the document was kept by an earlier run on the same
+        shard."""
+        return self.connection.execute(
+            'SELECT 1 FROM documents WHERE fingerprint = ? AND line = ?',
+            (fingerprint, line)).fetchone() is not None
+
+    def add(self, source, fingerprint, line, signature, keys):
+        cursor = self.connection.execute(
+            'INSERT INTO documents (source, fingerprint, line, signature) '
+            'VALUES (?, ?, ?, ?)', (source, fingerprint, line, signature))
+        document = cursor.lastrowid
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)',
+            [(band, key, document) for band, key in enumerate(keys)])
+        return document
+
+    def describe(self, document):
+        return self.connection.execute(
+            'SELECT source, line FROM documents WHERE id = ?',
+            (document,)).fetchone()
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    group = parser.add_argument_group(title='input data')
+    group.add_argument('--input', type=str, required=True,
+                       help='Path to input JSON lines, may be gzipped')
+    group.add_argument('--json-key', type=str, default='text',
+                       help='Key of the text to deduplicate on')
+
+    group = parser.add_argument_group(title='minhash')
+    group.add_argument('--ngram', type=int, default=5,
+                       help='Number of words per shingle.')
+    group.add_argument('--num-perm', type=int, default=128,
+                       help='Number of minhash permutations.')
+    group.add_argument('--bands', type=int, default=16,
+                       help='Number of LSH bands, must divide --num-perm.')
+    group.add_argument('--threshold', type=float, default=0.8,
+                       help='Estimated Jaccard similarity above which a '
+                       'document is a duplicate.')
+    group.add_argument('--seed', type=int, default=1234,
+                       help='Seed of the minhash permutations. Must be the '
+                       'same for all shards sharing an index.')
+
+    group = parser.add_argument_group(title='output data')
+    group.add_argument('--output', type=str, required=True,
+                       help='Path to the filtered JSON lines, gzipped if it '
+                       'ends with .gz')
+    group.add_argument('--index-path', type=str, required=True,
+                       help='Path to the sqlite LSH index. Reuse it to '
+                       'deduplicate new shards against previous ones.')
+    group.add_argument('--stats-output', type=str, default=None,
+                       help='Path to the json statistics, defaults to '
+                       '<output>.stats.json')
+    group.add_argument('--duplicates-output', type=str, default=None,
+                       help='If set, write the line number and matched '
+                       'document of every removed duplicate as JSON lines.')
+
+    group = parser.add_argument_group(title='runtime')
+    group.add_argument('--workers', type=int, default=1,
+                       help='Number of worker processes to launch')
+    group.add_argument('--log-interval', type=int, default=10000,
+                       help='Interval between progress updates')
+    group.add_argument('--commit-interval', type=int, default=10000,
+                       help='Number of documents between index commits')
+    args = parser.parse_args()
+
+    if args.stats_output is None:
+        args.stats_output = args.output + '.stats.json'
+
+    return args
+
+
+def main():
+    args = get_args()
+    startup_start = time.time()
+
+    print("Opening", args.input)
+    fin = open_file(args.input, 'r')
+    source = os.path.abspath(args.input)
+    source_fingerprint = fingerprint(args.input)
+
+    encoder = Encoder(args)
+    pool = multiprocessing.Pool(args.workers, initializer=encoder.initializer)
+    encoded_docs = pool.imap(encoder.encode, fin, 64)
+
+    index = LSHIndex(args.index_path, args.num_perm, args.bands, args.seed,
+                     args.ngram)
+    fout = open_file(args.output, 'w')
+    fdup = None
+    if args.duplicates_output is not None:
+        fdup = open(args.duplicates_output, 'w', encoding='utf-8')
+
+    startup_end = time.time()
+    proc_start = time.time()
+    print("Time to startup:", startup_end - startup_start)
+
+    num_docs = 0
+    num_kept = 0
+    num_empty = 0
+    bytes_in = 0
+    bytes_removed = 0
+    for line_number, (json_line, signature) in enumerate(encoded_docs):
+        num_docs += 1
+        if not json_line.endswith('\n'):
+            json_line += '\n'
+        num_bytes = len(json_line.encode('utf-8'))
+        bytes_in += num_bytes
+        if signature is None:
+            # Nothing to compare on, keep it.
+            num_empty += 1
+            num_kept += 1
+            fout.write(json_line)
+            continue
+
+        if index.contains(source_fingerprint, line_number):
+            # Kept by an earlier run on this shard, it would match itself.
+            num_kept += 1
+            fout.write(json_line)
+            continue
+
+        keys = index.band_keys(signature)
+        duplicate = index.find_duplicate(signature, keys, args.threshold)
+        if duplicate is None:
+            index.add(source, source_fingerprint, line_number, signature,
+                      keys)
+            num_kept += 1
+            fout.write(json_line)
+        else:
+            bytes_removed += num_bytes
+            if fdup is not None:
+                document, similarity = duplicate
+                dup_source, dup_line = index.describe(document)
+                fdup.write(json.dumps({'line': line_number,
+                                       'duplicate_of_source': dup_source,
+                                       'duplicate_of_line': dup_line,
+                                       'similarity': similarity}) + '\n')
+
+        if num_docs % args.commit_interval == 0:
+            index.commit()
+        if num_docs % args.log_interval == 0:
+            elapsed = time.time() - proc_start
+            mbs = bytes_in / elapsed / 1024 / 1024
+            print(f"Processed {num_docs} documents, removed "
+                  f"{num_docs - num_kept}",
+                  f"({num_docs / elapsed} docs/s, {mbs} MB/s).",
+                  file=sys.stderr)
+
+    pool.close()
+    index.close()
+    fout.close()
+    if fdup is not None:
+        fdup.close()
+    fin.close()
+
+    elapsed = time.time() - proc_start
+    stats = {
+        'input': args.input,
+        'output': args.output,
+        'index_path': args.index_path,
+        'num_documents': num_docs,
+        'num_kept': num_kept,
+        'num_removed': num_docs - num_kept,
+        'num_empty': num_empty,
+        'removed_fraction': (num_docs - num_kept) / max(1, num_docs),
+        'bytes_in': bytes_in,
+        'bytes_removed': bytes_removed,
+        'ngram': args.ngram,
+        'num_perm': args.num_perm,
+        'bands': args.bands,
+        'threshold': args.threshold,
+        'elapsed_seconds': elapsed,
+        'docs_per_second': num_docs / max(elapsed, 1e-9),
+    }
+    with open(args.stats_output, 'w') as f:
+        json.dump(stats, f, indent=2)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import List, Optional, Tuple
+
+import torch
+from torch import distributed as dist
+
+DEFAULT_AUROC_NUM_BINS = 1 << 20
+# Number of local quantiles each rank contributes to pick the sample sort splitters.
+SAMPLE_SORT_OVERSAMPLING = 128
+
+
+def _is_distributed() -> bool:
+    return (
+        dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+    )
+
+
+def _auroc_from_histograms(
+    pos: torch.Tensor, neg: torch.Tensor, neg_below: float = 0.0
+) -> torch.Tensor:
+    """
+    Mann-Whitney numerator of positive/negative counts per ascending score bucket.
+    Pairs falling into the same bucket count as ties, i.e. 1/2.
+
+    Args:
+        pos (torch.Tensor): number of positives per bucket, in ascending score order.
+        neg (torch.Tensor): number of negatives per bucket, in ascending score order.
+        neg_below (float): number of negatives scored below the first bucket.
+
+    Returns:
+        torch.Tensor: sum over positives of the negatives ranked below them.
+    """
+    neg_cumsum = torch.cumsum(neg, dim=0)
+    return (pos * (neg_below + neg_cumsum - 0.5 * neg)).sum()
+
+
+class BinnedAUROC:
+    """
+    Streaming binary AUROC with bounded memory.
+
+    Predictions in [0, 1] are accumulated into `num_bins` equal-width bins
+    separately for positives and negatives, so memory is O(num_bins) regardless
+    of the number of samples and the histograms of all ranks are combined with a
+    single all_reduce. Pairs of a positive and a negative in the same bin count
+    as ties, which bounds the absolute error by `error_bound()`.
+
+    Args:
+        num_bins (int): number of histogram bins over [0, 1].
+        device (torch.device): device on which the histograms are kept.
+        sync_ranks (bool): whether compute() combines the histograms of all ranks.
+            If False, it only uses the samples of the calling rank.
+    """
+
+    def __init__(
+        self,
+        num_bins: int = DEFAULT_AUROC_NUM_BINS,
+        device: Optional[torch.device] = None,
+        sync_ranks: bool = True,
+    ) -> None:
+        if num_bins < 1:
+            raise ValueError(f"num_bins must be positive, got {num_bins}.")
+        self.num_bins = num_bins
+        # Row 0 holds negatives, row 1 positives. Float64 keeps counts exact up to 2**53.
+        self.hist = torch.zeros(2, num_bins, dtype=torch.float64, device=device)
+        self.sync_ranks = sync_ranks
+        self._reduced = False
+
+    def to(self, device: torch.device) -> "BinnedAUROC":
+        self.hist = self.hist.to(device)
+        return self
+
+    def reset(self) -> None:
+        self.hist.zero_()
+        self._reduced = False
+
+    def update(self, preds: torch.Tensor, labels: torch.Tensor) -> None:
+        assert not self._reduced, "update() called after compute(), call reset() first."
+        preds = preds.detach().reshape(-1)
+        labels = labels.detach().reshape(-1).to(torch.long)
+        bins = (preds.to(torch.float64) * self.num_bins).long()
+        bins.clamp_(0, self.num_bins - 1)
+        # A single bincount over (label, bin) fills both histograms.
+        self.hist.view(-1).add_(
+            torch.bincount(labels * self.num_bins + bins, minlength=2 * self.num_bins)
+        )
+
+    __call__ = update
+
+    def _reduce(self) -> None:
+        if not self._reduced and self.sync_ranks and _is_distributed():
+            dist.all_reduce(self.hist, op=dist.ReduceOp.SUM)
+        self._reduced = True
+
+    @property
+    def num_samples(self) -> int:
+        """Number of samples accumulated so far, summed over ranks after compute()."""
+        return int(self.hist.sum().item())
+
+    def compute(self) -> torch.Tensor:
+        """
+        Reduces the histograms across ranks and returns the AUROC.
+        All ranks must call it.
+        """
+        self._reduce()
+        neg, pos = self.hist[0], self.hist[1]
+        num_pos, num_neg = pos.sum(), neg.sum()
+        if num_pos == 0 or num_neg == 0:
+            return torch.tensor(0.0, dtype=torch.float64, device=self.hist.device)
+        return _auroc_from_histograms(pos, neg) / (num_pos * num_neg)
+
+    def error_bound(self) -> float:
+        """
+        Upper bound on |compute() - exact AUROC|: half of the fraction of
+        positive/negative pairs that share a bin.
+        """
+        self._reduce()
+        neg, pos = self.hist[0], self.hist[1]
+        num_pairs = (pos.sum() * neg.sum()).item()
+        if num_pairs == 0:
+            return 0.0
+        return 0.5 * (pos * neg).sum().item() / num_pairs
+
+
+class ExactAUROC:
+    """
+    Exact binary AUROC computed with a distributed sample sort.
+
+    Keeps all predictions, like torchmetrics.AUROC, but avoids gathering them on
+    one rank: at compute() the scores are range partitioned across ranks with
+    splitters sampled from local quantiles, each rank ranks its partition
+    locally (with ties counting 1/2) and the partial Mann-Whitney sums are
+    combined with an all_reduce.
+
+    Args:
+        device (torch.device): device on which the predictions are kept.
+    """
+
+    def __init__(self, device: Optional[torch.device] = None) -> None:
+        self.device = device
+        self.preds: List[torch.Tensor] = []
+        self.labels: List[torch.Tensor] = []
+        self._num_samples = 0
+
+    def to(self, device: torch.device) -> "ExactAUROC":
+        self.device = device
+        return self
+
+    def reset(self) -> None:
+        self.preds = []
+        self.labels = []
+        self._num_samples = 0
+
+    def update(self, preds: torch.Tensor, labels: torch.Tensor) -> None:
+        self.preds.append(preds.detach().reshape(-1).to(torch.float32))
+        self.labels.append(labels.detach().reshape(-1).to(torch.float32))
+
+    __call__ = update
+
+    @property
+    def num_samples(self) -> int:
+        """Number of samples summed over ranks, valid after compute()."""
+        return self._num_samples
+
+    def _local_tensors(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        if not self.preds:
+            empty = torch.empty(0, dtype=torch.float32, device=self.device)
+            return empty, empty.clone()
+        return torch.cat(self.preds), torch.cat(self.labels)
+
+    def _partition(
+        self, preds: torch.Tensor, labels: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Exchanges samples so that rank r holds the r-th score range."""
+        world_size = dist.get_world_size()
+        device = preds.device
+        # Local quantiles -> global splitters.
+        num_quantiles = SAMPLE_SORT_OVERSAMPLING
+        if preds.numel() > 0:
+            sorted_preds = torch.sort(preds).values
+            idx = torch.linspace(
+                0, preds.numel() - 1, num_quantiles, device=device
+            ).long()
+            quantiles = sorted_preds[idx]
+        else:
+            quantiles = torch.full((num_quantiles,), 0.5, device=device)
+        all_quantiles = [torch.empty_like(quantiles) for _ in range(world_size)]
+        dist.all_gather(all_quantiles, quantiles)
+        all_quantiles = torch.sort(torch.cat(all_quantiles)).values
+        splitters = all_quantiles[
+            torch.arange(1, world_size, device=device) * num_quantiles
+        ].contiguous()
+
+        # Equal scores always land in the same partition, so ties never cross ranks.
+        dest = torch.bucketize(preds, splitters, right=True)
+        order = torch.argsort(dest)
+        send = torch.stack([preds, labels], dim=1)[order].contiguous()
+        send_counts = torch.bincount(dest, minlength=world_size)
+        recv_counts = torch.empty_like(send_counts)
+        dist.all_to_all_single(recv_counts, send_counts)
+        recv = send.new_empty((int(recv_counts.sum().item()), 2))
+        dist.all_to_all_single(
+            recv,
+            send,
+            output_split_sizes=recv_counts.tolist(),
+            input_split_sizes=send_counts.tolist(),
+        )
+        return recv[:, 0], recv[:, 1]
+
+    def compute(self) -> torch.Tensor:
+        """
+        Returns the exact AUROC over all ranks. All ranks must call it.
+        """
+        preds, labels = self._local_tensors()
+        distributed = _is_distributed()
+        if distributed:
+            preds, labels = self._partition(preds, labels)
+
+        unique_preds, inverse = torch.unique(preds, sorted=True, return_inverse=True)
+        labels = labels.to(torch.float64)
+        pos = torch.zeros(
+            unique_preds.numel(), dtype=torch.float64, device=preds.device
+        ).index_add_(0, inverse, labels)
+        neg = (
+            torch.bincount(inverse, minlength=unique_preds.numel()).to(torch.float64)
+            - pos
+        )
+
+        # Negatives held by lower ranks score below every local sample.
+        local_neg = neg.sum().reshape(1)
+        neg_below = 0.0
+        if distributed:
+            all_neg = [torch.empty_like(local_neg) for _ in range(dist.get_world_size())]
+            dist.all_gather(all_neg, local_neg)
+            neg_below = torch.cat(all_neg)[: dist.get_rank()].sum()
+
+        totals = torch.stack(
+            [_auroc_from_histograms(pos, neg, neg_below), pos.sum(), local_neg[0]]
+        )
+        if distributed:
+            dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+        numerator, num_pos, num_neg = totals.tolist()
+        self._num_samples = int(num_pos + num_neg)
+        if num_pos == 0 or num_neg == 0:
+            return torch.tensor(0.0, dtype=torch.float64, device=preds.device)
+        return torch.tensor(
+            numerator / (num_pos * num_neg), dtype=torch.float64, device=preds.device
+        )
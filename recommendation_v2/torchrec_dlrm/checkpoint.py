@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import random
+import re
+import shutil
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+from torch import distributed as dist
+from torch.distributed._shard.sharded_tensor import ShardedTensor
+
+# Marks the local shards of a ShardedTensor in saved state dicts.
+LOCAL_SHARDS = "__local_shards__"
+STEP_DIR_PATTERN = re.compile(r"^step_(\d+)$")
+
+
+def _to_local(obj: Any) -> Any:
+    """
+    Copies a (nested) state dict to CPU, replacing each ShardedTensor by the list of
+    its local shards. Every rank saves only the shards it owns.
+    """
+    if isinstance(obj, ShardedTensor):
+        return {
+            LOCAL_SHARDS: [shard.tensor.detach().cpu() for shard in obj.local_shards()]
+        }
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu()
+    if isinstance(obj, dict):
+        return {k: _to_local(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_local(v) for v in obj)
+    return obj
+
+
+def _restore(target: Any, saved: Any) -> Any:
+    """
+    Copies saved into the tensors and local shards of target in place and returns
+    target with its non-tensor leaves replaced by the saved values.
+    """
+    if isinstance(target, ShardedTensor):
+        local_shards = target.local_shards()
+        assert len(local_shards) == len(saved[LOCAL_SHARDS]), (
+            "Checkpoint was saved with a different sharding plan."
+        )
+        for shard, tensor in zip(local_shards, saved[LOCAL_SHARDS]):
+            shard.tensor.detach().copy_(tensor)
+        return target
+    if isinstance(target, torch.Tensor):
+        target.detach().copy_(saved)
+        return target
+    if isinstance(target, dict):
+        missing = target.keys() - saved.keys()
+        assert not missing, f"Checkpoint is missing {sorted(missing)}"
+        return {k: _restore(v, saved[k]) for k, v in target.items()}
+    if isinstance(target, (list, tuple)):
+        return type(target)(_restore(t, s) for t, s in zip(target, saved))
+    return saved
+
+
+def _rng_state() -> Dict[str, Any]:
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+
+def _set_rng_state(state: Dict[str, Any]) -> None:
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+class Checkpointer:
+    """
+    Saves and restores the sharded DLRM training state for exact resumption.
+
+    Each rank writes its own file, step_{N}/rank_{r}.pt, holding its local shards
+    of the DistributedModelParallel model and fused embedding optimizer, the dense
+    parameters and optimizer state, the LR scheduler, RNG states and the training
+    position given by the caller. Tensors are copied to CPU on the training thread
+    and written by a background thread, so ranks write in parallel with each other
+    and with training. A checkpoint is complete once all world_size rank files
+    exist; files are renamed into place only after being fully written.
+
+    Args:
+        checkpoint_dir (str): directory holding the step_{N} checkpoints.
+        keep (int): number of most recent checkpoints kept.
+    """
+
+    def __init__(self, checkpoint_dir: str, keep: int = 2) -> None:
+        assert keep >= 2, "keep at least 2 checkpoints so one is always complete"
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self._writer: Optional[threading.Thread] = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def _step_dirs(self) -> List[int]:
+        steps = []
+        for name in os.listdir(self.checkpoint_dir):
+            match = STEP_DIR_PATTERN.match(name)
+            if match:
+                steps.append(int(match.group(1)))
+        return sorted(steps, reverse=True)
+
+    def _rank_path(self, step: int, rank: int) -> str:
+        return os.path.join(self.checkpoint_dir, f"step_{step}", f"rank_{rank}.pt")
+
+    def _is_complete(self, step: int) -> bool:
+        return all(
+            os.path.exists(self._rank_path(step, rank))
+            for rank in range(self.world_size)
+        )
+
+    def wait(self) -> None:
+        """Blocks until the previous checkpoint of this rank is on disk."""
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def save(
+        self,
+        step: int,
+        model: torch.nn.Module,
+        optimizer: torch.optim.Optimizer,
+        lr_scheduler: Any,
+        train_state: Dict[str, Any],
+    ) -> None:
+        """
+        Snapshots the training state after `step` training steps. train_state holds
+        the position of training (epoch, batches trained in the epoch, ...).
+        """
+        self.wait()
+        state = {
+            "model": _to_local(model.state_dict()),
+            "optimizer": _to_local(optimizer.state_dict()),
+            "lr_scheduler": lr_scheduler.state_dict(),
+            "rng": _rng_state(),
+            "train_state": dict(train_state, step=step),
+            "world_size": self.world_size,
+        }
+        path = self._rank_path(step, self.rank)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def write() -> None:
+            torch.save(state, path + ".tmp")
+            os.replace(path + ".tmp", path)
+            self._remove_old()
+
+        self._writer = threading.Thread(target=write, name="checkpoint_writer")
+        self._writer.start()
+
+    def _remove_old(self) -> None:
+        """
+        Removes the checkpoints beyond the `keep` most recent ones that are older
+        than the newest complete checkpoint. Newer steps may still be being written
+        by slower ranks, so the newest complete one is never removed.
+        """
+        steps = self._step_dirs()
+        complete = next((step for step in steps if self._is_complete(step)), None)
+        if complete is None:
+            return
+        for old_step in steps[self.keep :]:
+            if old_step >= complete:
+                continue
+            try:
+                os.remove(self._rank_path(old_step, self.rank))
+                if self.rank == 0:
+                    shutil.rmtree(
+                        os.path.join(self.checkpoint_dir, f"step_{old_step}"),
+                        ignore_errors=True,
+                    )
+            except FileNotFoundError:
+                pass
+
+    def latest_step(self) -> Optional[int]:
+        """Newest checkpoint written by all ranks, agreed on by all ranks."""
+        for step in self._step_dirs():
+            if self._is_complete(step):
+                break
+        else:
+            step = -1
+        # Ranks may see the file system at slightly different times.
+        agreed = torch.tensor([step], dtype=torch.int64)
+        if dist.get_backend() == dist.Backend.NCCL:
+            agreed = agreed.cuda()
+        dist.all_reduce(agreed, op=dist.ReduceOp.MIN)
+        step = int(agreed.item())
+        return None if step < 0 else step
+
+    def load(
+        self,
+        model: torch.nn.Module,
+        optimizer: torch.optim.Optimizer,
+        lr_scheduler: Any,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Restores the latest complete checkpoint in place, if any, and returns its
+        train_state. The sharding plan and world size must be the same as when it
+        was saved.
+        """
+        step = self.latest_step()
+        if step is None:
+            return None
+        state = torch.load(self._rank_path(step, self.rank), map_location="cpu")
+        assert state["world_size"] == self.world_size, (
+            f"Checkpoint was saved with world size {state['world_size']},"
+            f" resuming with {self.world_size}"
+        )
+        _restore(model.state_dict(), state["model"])
+        optimizer.load_state_dict(
+            _restore(optimizer.state_dict(), state["optimizer"])
+        )
+        lr_scheduler.load_state_dict(state["lr_scheduler"])
+        _set_rng_state(state["rng"])
+        return state["train_state"]
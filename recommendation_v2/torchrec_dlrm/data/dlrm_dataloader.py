@@ -23,14 +23,20 @@ from torchrec.datasets.random import RandomRecDataset
 try:
     # pyre-ignore[21]
     # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm/data:multi_hot_criteo
-    from data.multi_hot_criteo import MultiHotCriteoIterDataPipe
+    from data.multi_hot_criteo import (
+        MultiHotCriteoIterDataPipe,
+        OnTheFlyMultiHotCriteoIterDataPipe,
+    )
 
 except ImportError:
     pass
 
 # internal import
 try:
-    from .multi_hot_criteo import MultiHotCriteoIterDataPipe  # noqa F811
+    from .multi_hot_criteo import (  # noqa F811
+        MultiHotCriteoIterDataPipe,
+        OnTheFlyMultiHotCriteoIterDataPipe,
+    )
 except ImportError:
     pass
 
@@ -71,14 +77,35 @@ def _get_in_memory_dataloader(
     args: argparse.Namespace,
     stage: str,
 ) -> DataLoader:
-    if args.in_memory_binary_criteo_path is not None:
+    multi_hot_kwargs = {
+        "prefetch_batches": getattr(args, "mmap_prefetch_batches", 0),
+        "prefetch_threads": getattr(args, "mmap_prefetch_threads", 4),
+        "shuffle_window_batches": getattr(args, "shuffle_window_batches", 0)
+        if stage == "train"
+        else 0,
+    }
+    if args.in_memory_binary_criteo_path is not None and getattr(
+        args, "multi_hot_in_dataloader", False
+    ):
+        dir_path = args.in_memory_binary_criteo_path
+        sparse_part = "sparse.npy"
+        datapipe = OnTheFlyMultiHotCriteoIterDataPipe
+        datapipe_kwargs = {
+            "multi_hot_sizes": args.multi_hot_sizes,
+            "multi_hot_distribution_type": args.multi_hot_distribution_type,
+            "num_gather_threads": args.multi_hot_gather_threads,
+            **multi_hot_kwargs,
+        }
+    elif args.in_memory_binary_criteo_path is not None:
         dir_path = args.in_memory_binary_criteo_path
         sparse_part = "sparse.npy"
         datapipe = InMemoryBinaryCriteoIterDataPipe
+        datapipe_kwargs = {}
     else:
         dir_path = args.synthetic_multi_hot_criteo_path
         sparse_part = "sparse_multi_hot.npz"
         datapipe = MultiHotCriteoIterDataPipe
+        datapipe_kwargs = multi_hot_kwargs
 
     if stage == "train":
         stage_files: List[List[str]] = [
@@ -111,6 +138,7 @@ def _get_in_memory_dataloader(
             hashes=args.num_embeddings_per_feature
             if args.num_embeddings is None
             else ([args.num_embeddings] * CAT_FEATURE_COUNT),
+            **datapipe_kwargs,
         ),
         batch_size=None,
         pin_memory=args.pin_memory,
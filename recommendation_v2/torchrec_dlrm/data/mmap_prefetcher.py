@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import collections
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+import numpy as np
+
+# Size of the reads used to pull prefetched row ranges into the page cache.
+READ_CHUNK_BYTES = 4 << 20
+
+T = TypeVar("T")
+# (file_idx, row_start, row_end)
+RowRange = Tuple[int, int, int]
+
+
+def _mmap_root(arr: np.ndarray) -> Optional[np.memmap]:
+    """Returns the memmap owning the file mapping of arr, or None if arr is in memory."""
+    root = arr
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    if not isinstance(root, np.memmap) or getattr(root, "_mmap", None) is None:
+        return None
+    return root
+
+
+class _ArraySegments:
+    """Maps row ranges of a C-contiguous memmapped array to byte ranges of its file."""
+
+    def __init__(self, arr: np.ndarray, root: np.memmap) -> None:
+        self.filename: str = root.filename
+        # Byte offset in the file of arr[0], which may be a slice of root.
+        self.offset: int = root.offset + (
+            arr.__array_interface__["data"][0] - root.__array_interface__["data"][0]
+        )
+        self.row_bytes: int = arr.strides[0]
+
+    def byte_range(self, row_start: int, row_end: int) -> Tuple[int, int]:
+        return (
+            self.offset + row_start * self.row_bytes,
+            (row_end - row_start) * self.row_bytes,
+        )
+
+
+class MmapPrefetcher:
+    """
+    Reads the row ranges of upcoming batches of memmapped datasets on a background
+    thread pool, so that page faults are served from the page cache instead of
+    blocking the training step.
+
+    Ranges are read with preadv into a per-thread scratch buffer, which populates
+    the page cache regardless of the kernel read-ahead heuristics, and the mappings
+    are advised as sequential. Arrays that are not memmapped or not row-major are
+    skipped.
+
+    Args:
+        arrays_per_file (List[List[np.ndarray]]): for each file index, the arrays
+            (dense, labels, sparse features, ...) whose rows are read together.
+        prefetch_batches (int): number of batches read ahead of the consumer.
+        num_threads (int): number of reader threads.
+
+    Example::
+
+        prefetcher = MmapPrefetcher([[dense, labels, *sparse]], 4, 8)
+        for batch_idx, row_ranges in prefetcher.prefetch(batches):
+            ...
+        print(prefetcher.stats())
+    """
+
+    def __init__(
+        self,
+        arrays_per_file: List[List[np.ndarray]],
+        prefetch_batches: int,
+        num_threads: int,
+    ) -> None:
+        assert prefetch_batches > 0, "prefetch_batches must be positive"
+        self.prefetch_batches = prefetch_batches
+        self.num_threads = num_threads
+        self.segments_per_file: List[List[_ArraySegments]] = []
+        for arrays in arrays_per_file:
+            segments = []
+            for arr in arrays:
+                root = _mmap_root(arr)
+                if root is None or not arr.flags.c_contiguous:
+                    continue
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    root._mmap.madvise(mmap.MADV_SEQUENTIAL)
+                segments.append(_ArraySegments(arr, root))
+            self.segments_per_file.append(segments)
+
+        self._fds: Dict[str, int] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+        self.stall_seconds = 0.0
+        self.num_batches = 0
+
+    def _fd(self, filename: str) -> int:
+        with self._lock:
+            fd = self._fds.get(filename)
+            if fd is None:
+                fd = os.open(filename, os.O_RDONLY)
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                self._fds[filename] = fd
+            return fd
+
+    def _read(self, filename: str, offset: int, length: int) -> None:
+        buf = getattr(self._local, "buf", None)
+        if buf is None:
+            buf = self._local.buf = bytearray(READ_CHUNK_BYTES)
+        fd = self._fd(filename)
+        start = time.perf_counter()
+        end = offset + length
+        total = 0
+        while offset < end:
+            view = memoryview(buf)[: min(READ_CHUNK_BYTES, end - offset)]
+            n = os.preadv(fd, [view], offset)
+            if n <= 0:
+                break
+            offset += n
+            total += n
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.bytes_read += total
+            self.read_seconds += elapsed
+
+    def _submit(
+        self, pool: ThreadPoolExecutor, row_ranges: List[RowRange]
+    ) -> List[Future]:
+        futures = []
+        for file_idx, row_start, row_end in row_ranges:
+            for segments in self.segments_per_file[file_idx]:
+                offset, length = segments.byte_range(row_start, row_end)
+                if length > 0:
+                    futures.append(
+                        pool.submit(self._read, segments.filename, offset, length)
+                    )
+        return futures
+
+    def prefetch(
+        self, batches: Iterable[Tuple[T, List[RowRange]]]
+    ) -> Iterator[Tuple[T, List[RowRange]]]:
+        """
+        Yields the items of batches, each once its row ranges have been read.
+        Reads for the following prefetch_batches items are in flight meanwhile.
+        """
+        pending: Deque[Tuple[Tuple[T, List[RowRange]], List[Future]]] = (
+            collections.deque()
+        )
+        batches = iter(batches)
+        with ThreadPoolExecutor(
+            self.num_threads, thread_name_prefix="mmap_prefetch"
+        ) as pool:
+            try:
+                while True:
+                    while len(pending) <= self.prefetch_batches:
+                        item = next(batches, None)
+                        if item is None:
+                            break
+                        pending.append((item, self._submit(pool, item[1])))
+                    if not pending:
+                        return
+                    item, futures = pending.popleft()
+                    start = time.perf_counter()
+                    wait(futures)
+                    self.stall_seconds += time.perf_counter() - start
+                    self.num_batches += 1
+                    for future in futures:
+                        future.result()
+                    yield item
+            finally:
+                for _, futures in pending:
+                    for future in futures:
+                        future.cancel()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "batches": self.num_batches,
+            "bytes_read": self.bytes_read,
+            "read_seconds": self.read_seconds,
+            "stall_seconds": self.stall_seconds,
+            "read_MBps_per_thread": self.bytes_read
+            / max(self.read_seconds, 1e-9)
+            / 2**20,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds = {}
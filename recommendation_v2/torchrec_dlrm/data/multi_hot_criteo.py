@@ -4,13 +4,15 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import itertools
+import os
 import zipfile
-from typing import Dict, Iterator, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
 import torch
 from iopath.common.file_io import PathManager, PathManagerFactory
-from pyre_extensions import none_throws
 from torch.utils.data import IterableDataset
 from torchrec.datasets.criteo import (
     CAT_FEATURE_COUNT,
@@ -19,6 +21,63 @@ from torchrec.datasets.criteo import (
 from torchrec.datasets.utils import Batch, PATH_MANAGER_KEY
 from torchrec.sparse.jagged_tensor import KeyedJaggedTensor
 
+# OSS import
+try:
+    # pyre-ignore[21]
+    # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm/data:mmap_prefetcher
+    from data.mmap_prefetcher import MmapPrefetcher
+
+    # pyre-ignore[21]
+    # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm:multi_hot
+    from multi_hot import Multihot
+
+except ImportError:
+    pass
+
+# internal import
+try:
+    from ..multi_hot import Multihot  # noqa F811
+    from .mmap_prefetcher import MmapPrefetcher  # noqa F811
+except ImportError:
+    pass
+
+# Number of preallocated batch buffers each iterator cycles through.
+DEFAULT_NUM_BATCH_BUFFERS = 8
+
+
+class _BatchBuffer:
+    """
+    Preallocated storage for one batch. Sparse features are laid out feature-major
+    in a single values array, exactly as KeyedJaggedTensor expects them, so rows
+    are copied once from the dataset arrays and the batch tensors are views.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        num_dense: int,
+        multi_hot_sizes: List[int],
+        dense_dtype: np.dtype,
+        sparse_dtype: np.dtype,
+        labels_dtype: np.dtype,
+    ) -> None:
+        self.multi_hot_sizes = multi_hot_sizes
+        self.dense = np.empty((batch_size, num_dense), dtype=dense_dtype)
+        self.values = np.empty(batch_size * sum(multi_hot_sizes), dtype=sparse_dtype)
+        self.labels = np.empty(batch_size, dtype=labels_dtype)
+
+    def views(
+        self, batch_size: int
+    ) -> Tuple[np.ndarray, List[np.ndarray], np.ndarray, np.ndarray]:
+        values = self.values[: batch_size * sum(self.multi_hot_sizes)]
+        sparse = []
+        start = 0
+        for multi_hot_size in self.multi_hot_sizes:
+            end = start + batch_size * multi_hot_size
+            sparse.append(values[start:end].reshape(batch_size, multi_hot_size))
+            start = end
+        return self.dense[:batch_size], sparse, self.labels[:batch_size], values
+
 
 class MultiHotCriteoIterDataPipe(IterableDataset):
     """
@@ -31,12 +90,16 @@ class MultiHotCriteoIterDataPipe(IterableDataset):
         stage (str): "train", "val", or "test".
         dense_paths (List[str]): List of path strings to dense npy files.
         sparse_paths (List[str]): List of path strings to multi-hot sparse npz files.
+            If an npz file does not exist, the directory of the same name without the
+            .npz extension holding one npy file per feature is used instead.
         labels_paths (List[str]): List of path strings to labels npy files.
         batch_size (int): batch size.
         rank (int): rank.
         world_size (int): world size.
         drop_last (Optional[bool]): Whether to drop the last batch if it is incomplete.
-        shuffle_batches (bool): Whether to shuffle batches
+        shuffle_batches (bool): Whether to shuffle batches. The permutation of each
+            batch is derived from shuffle_training_set_random_seed, the epoch set with
+            set_epoch and the batch index, so that resumed runs see the same batches.
         shuffle_training_set (bool): Whether to shuffle all samples in the dataset.
         shuffle_training_set_random_seed (int): The random generator seed used when
             shuffling the training set.
@@ -44,6 +107,20 @@ class MultiHotCriteoIterDataPipe(IterableDataset):
             Length of this list should be CAT_FEATURE_COUNT.
         path_manager_key (str): Path manager key used to load from different
             filesystems.
+        num_batch_buffers (int): Number of preallocated batch buffers each iterator
+            cycles through. Batches share memory with these buffers, so a batch is
+            only valid until num_batch_buffers - 1 further batches have been drawn
+            from the same iterator.
+        prefetch_batches (int): With mmap_mode, number of this rank's batches whose
+            rows are read into the page cache ahead of time by background threads.
+            0 disables read-ahead.
+        prefetch_threads (int): Number of read-ahead threads.
+        shuffle_window_batches (int): If positive, the rows of each window of
+            shuffle_window_batches consecutive batches of this rank are read into
+            memory together and shuffled across the window before being split into
+            batches again. The permutation of each window is derived from
+            shuffle_training_set_random_seed, the epoch, the rank and the window
+            index. Memory use is bounded by the window, unlike shuffle_training_set.
 
     Example::
 
@@ -74,6 +151,10 @@ class MultiHotCriteoIterDataPipe(IterableDataset):
         mmap_mode: bool = False,
         hashes: Optional[List[int]] = None,
         path_manager_key: str = PATH_MANAGER_KEY,
+        num_batch_buffers: int = DEFAULT_NUM_BATCH_BUFFERS,
+        prefetch_batches: int = 0,
+        prefetch_threads: int = 4,
+        shuffle_window_batches: int = 0,
     ) -> None:
         self.stage = stage
         self.dense_paths = dense_paths
@@ -86,6 +167,14 @@ class MultiHotCriteoIterDataPipe(IterableDataset):
         self.shuffle_batches = shuffle_batches
         self.shuffle_training_set = shuffle_training_set
         np.random.seed(shuffle_training_set_random_seed)
+        self.shuffle_seed: int = (
+            0
+            if shuffle_training_set_random_seed is None
+            else shuffle_training_set_random_seed
+        )
+        self.epoch = 0
+        # Batches of this rank skipped by the next iterator, see set_start_batch.
+        self._start_batch = 0
         self.mmap_mode = mmap_mode
         # hashes are not used because they were already applied in the
         # script that generates the multi-hot dataset.
@@ -104,15 +193,10 @@ class MultiHotCriteoIterDataPipe(IterableDataset):
             self.labels_arrs: List[np.ndarray] = [
                 np.load(f, mmap_mode=m) for f in self.labels_paths
             ]
-            self.sparse_arrs: List = []
-            for sparse_path in self.sparse_paths:
-                multi_hot_ids_l = []
-                for feat_id_num in range(CAT_FEATURE_COUNT):
-                    multi_hot_ft_ids = self._load_from_npz(
-                        sparse_path, f"{feat_id_num}.npy"
-                    )
-                    multi_hot_ids_l.append(multi_hot_ft_ids)
-                self.sparse_arrs.append(multi_hot_ids_l)
+            self.sparse_arrs: List = [
+                self._load_sparse_arrs(sparse_path, m)
+                for sparse_path in self.sparse_paths
+            ]
         len_d0 = len(self.dense_arrs[0])
         second_half_start_index = int(len_d0 // 2 + len_d0 % 2)
         if stage == "val":
@@ -154,9 +238,7 @@ class MultiHotCriteoIterDataPipe(IterableDataset):
                 self.last_batch_sizes += remainder // self.world_size
             self.last_batch_sizes[: remainder % self.world_size] += 1
 
-        self.multi_hot_sizes: List[int] = [
-            multi_hot_feat.shape[-1] for multi_hot_feat in self.sparse_arrs[0]
-        ]
+        self.multi_hot_sizes: List[int] = self._get_multi_hot_sizes()
 
         # These values are the same for the KeyedJaggedTensors in all batches, so they
         # are computed once here. This avoids extra work from the KeyedJaggedTensor sync
@@ -165,6 +247,56 @@ class MultiHotCriteoIterDataPipe(IterableDataset):
         self.index_per_key: Dict[str, int] = {
             key: i for (i, key) in enumerate(self.keys)
         }
+        # KeyedJaggedTensor metadata only depends on the batch size, which takes at
+        # most a handful of values (full batch and last batch sizes).
+        self._kjt_metadata: Dict[
+            int, Tuple[torch.Tensor, torch.Tensor, List[int], List[int]]
+        ] = {}
+        assert num_batch_buffers >= 2, "num_batch_buffers must be at least 2"
+        self.num_batch_buffers = num_batch_buffers
+        self.prefetch_batches = prefetch_batches
+        self.prefetch_threads = prefetch_threads
+        self._prefetcher: Optional[MmapPrefetcher] = None
+        self.shuffle_window_batches = shuffle_window_batches
+
+    def _load_sparse_arrs(
+        self, sparse_path: str, mmap_mode: Optional[str]
+    ) -> List[np.ndarray]:
+        """Returns the sparse arrays of one file: one multi-hot array per feature."""
+        return [
+            self._load_sparse_feature(sparse_path, f"{feat_id_num}.npy")
+            for feat_id_num in range(CAT_FEATURE_COUNT)
+        ]
+
+    def _get_multi_hot_sizes(self) -> List[int]:
+        return [multi_hot_feat.shape[-1] for multi_hot_feat in self.sparse_arrs[0]]
+
+    def _get_sparse_dtype(self) -> np.dtype:
+        return self.sparse_arrs[0][0].dtype
+
+    def _copy_sparse_rows(
+        self,
+        file_idx: int,
+        slice_: slice,
+        sparse_buffers: List[np.ndarray],
+        buffer_slice: slice,
+    ) -> None:
+        """Copies rows slice_ of file file_idx to rows buffer_slice of the features."""
+        for feats_buffer, feats in zip(sparse_buffers, self.sparse_arrs[file_idx]):
+            feats_buffer[buffer_slice] = feats[slice_, :]
+
+    def _load_sparse_feature(self, fname, npy_name):
+        # materialize_synthetic_multihot_dataset.py --output_format npy writes the
+        # members of day_{i}_sparse_multi_hot.npz as files of a
+        # day_{i}_sparse_multi_hot directory instead.
+        npy_dir = fname[: -len(".npz")] if fname.endswith(".npz") else fname
+        if not os.path.exists(fname) and os.path.isdir(npy_dir):
+            arr = np.load(os.path.join(npy_dir, npy_name), mmap_mode="r")
+            assert (
+                arr.dtype == "int32"
+            ), f"sparse multi-hot dtype is {arr.dtype} but should be int32"
+            return arr
+        return self._load_from_npz(fname, npy_name)
 
     def _load_from_npz(self, fname, npy_name):
         # figure out offset of .npy in .npz
@@ -190,70 +322,99 @@ class MultiHotCriteoIterDataPipe(IterableDataset):
             offset=offset,
         )
 
+    def _get_kjt_metadata(
+        self, batch_size: int
+    ) -> Tuple[torch.Tensor, torch.Tensor, List[int], List[int]]:
+        metadata = self._kjt_metadata.get(batch_size)
+        if metadata is None:
+            lengths = torch.tensor(
+                self.multi_hot_sizes, dtype=torch.int32
+            ).repeat_interleave(batch_size)
+            offsets = torch.cat(
+                (torch.zeros(1, dtype=torch.int64), torch.cumsum(lengths, dim=0))
+            )
+            length_per_key = [
+                batch_size * multi_hot_size for multi_hot_size in self.multi_hot_sizes
+            ]
+            offset_per_key = [0] + list(itertools.accumulate(length_per_key))
+            metadata = (lengths, offsets, length_per_key, offset_per_key)
+            self._kjt_metadata[batch_size] = metadata
+        return metadata
+
+    def _new_batch_buffer(self, num_batches: int = 1) -> _BatchBuffer:
+        # The last batches may hold one row more than batch_size, see last_batch_sizes.
+        return _BatchBuffer(
+            num_batches * max(self.batch_size, int(self.last_batch_sizes.max())),
+            self.dense_arrs[0].shape[1],
+            self.multi_hot_sizes,
+            self.dense_arrs[0].dtype,
+            self._get_sparse_dtype(),
+            self.labels_arrs[0].dtype,
+        )
+
     def _np_arrays_to_batch(
         self,
         dense: np.ndarray,
         sparse: List[np.ndarray],
         labels: np.ndarray,
+        values: Optional[np.ndarray] = None,
+        batch_idx: int = 0,
     ) -> Batch:
+        """
+        Builds a Batch from arrays owned by the datapipe. Arrays are shuffled in
+        place and the returned tensors share memory with them. values, if given,
+        is the feature-major concatenation of sparse that sparse are views of.
+        batch_idx seeds the shuffling of the batch.
+        """
         if self.shuffle_batches:
             # Shuffle all 3 in unison
-            shuffler = np.random.permutation(len(dense))
-            sparse = [multi_hot_ft[shuffler, :] for multi_hot_ft in sparse]
-            dense = dense[shuffler]
-            labels = labels[shuffler]
+            shuffler = np.random.default_rng(
+                (self.shuffle_seed, self.epoch, batch_idx)
+            ).permutation(len(dense))
+            for multi_hot_ft in sparse:
+                multi_hot_ft[:] = multi_hot_ft[shuffler, :]
+            dense[:] = dense[shuffler]
+            labels[:] = labels[shuffler]
 
         batch_size = len(dense)
-        lengths = torch.ones((CAT_FEATURE_COUNT * batch_size), dtype=torch.int32)
-        for k, multi_hot_size in enumerate(self.multi_hot_sizes):
-            lengths[k * batch_size : (k + 1) * batch_size] = multi_hot_size
-        offsets = torch.cumsum(torch.concat((torch.tensor([0]), lengths)), dim=0)
-        length_per_key = [
-            batch_size * multi_hot_size for multi_hot_size in self.multi_hot_sizes
-        ]
-        offset_per_key = torch.cumsum(
-            torch.concat((torch.tensor([0]), torch.tensor(length_per_key))), dim=0
+        lengths, offsets, length_per_key, offset_per_key = self._get_kjt_metadata(
+            batch_size
         )
-        values = torch.concat([torch.from_numpy(feat).flatten() for feat in sparse])
+        if values is None:
+            values = np.concatenate([feat.reshape(-1) for feat in sparse])
         return Batch(
-            dense_features=torch.from_numpy(dense.copy()),
+            dense_features=torch.from_numpy(dense),
             sparse_features=KeyedJaggedTensor(
                 keys=self.keys,
-                values=values,
+                values=torch.from_numpy(values),
                 lengths=lengths,
                 offsets=offsets,
                 stride=batch_size,
                 length_per_key=length_per_key,
-                offset_per_key=offset_per_key.tolist(),
+                offset_per_key=offset_per_key,
                 index_per_key=self.index_per_key,
             ),
-            labels=torch.from_numpy(labels.reshape(-1).copy()),
+            labels=torch.from_numpy(labels.reshape(-1)),
         )
 
-    def __iter__(self) -> Iterator[Batch]:
-        # Invariant: buffer never contains more than batch_size rows.
-        buffer: Optional[List[np.ndarray]] = None
-
-        def append_to_buffer(
-            dense: np.ndarray,
-            sparse: List[np.ndarray],
-            labels: np.ndarray,
-        ) -> None:
-            nonlocal buffer
-            if buffer is None:
-                buffer = [dense, sparse, labels]
-            else:
-                buffer[0] = np.concatenate((buffer[0], dense))
-                buffer[1] = [np.concatenate((b, s)) for b, s in zip(buffer[1], sparse)]
-                buffer[2] = np.concatenate((buffer[2], labels))
+    def _batch_row_ranges(
+        self,
+    ) -> Iterator[Tuple[int, int, List[Tuple[int, int, int]]]]:
+        """
+        Walks the dataset in batch order across all ranks.
 
-        # Maintain a buffer that can contain up to batch_size rows. Fill buffer as
-        # much as possible on each iteration. Only return a new batch when batch_size
-        # rows are filled.
+        Yields:
+            (batch_idx, batch_size, row_ranges) where row_ranges is a list of
+            (file_idx, row_start, row_end) holding the rows of the batch.
+        """
+        # Fill each batch as much as possible from the current file, moving to the
+        # next file when needed. Only move to a new batch when batch_size rows are
+        # filled.
         file_idx = 0
         row_idx = 0
         batch_idx = 0
         buffer_row_count = 0
+        row_ranges: List[Tuple[int, int, int]] = []
         cur_batch_size = (
             self.batch_size if self.num_full_batches > 0 else self.last_batch_sizes[0]
         )
@@ -262,9 +423,8 @@ class MultiHotCriteoIterDataPipe(IterableDataset):
             < self.num_full_batches + (self.last_batch_sizes[0] > 0) * self.world_size
         ):
             if buffer_row_count == cur_batch_size or file_idx == len(self.dense_arrs):
-                if batch_idx % self.world_size == self.rank:
-                    yield self._np_arrays_to_batch(*none_throws(buffer))
-                    buffer = None
+                yield batch_idx, cur_batch_size, row_ranges
+                row_ranges = []
                 buffer_row_count = 0
                 batch_idx += 1
                 if (
@@ -279,32 +439,328 @@ class MultiHotCriteoIterDataPipe(IterableDataset):
                     cur_batch_size - buffer_row_count,
                     self.num_rows_per_file[file_idx] - row_idx,
                 )
+                row_ranges.append((file_idx, row_idx, row_idx + rows_to_get))
                 buffer_row_count += rows_to_get
-                slice_ = slice(row_idx, row_idx + rows_to_get)
-
-                if batch_idx % self.world_size == self.rank:
-                    dense_inputs = self.dense_arrs[file_idx][slice_, :]
-                    sparse_inputs = [
-                        feats[slice_, :] for feats in self.sparse_arrs[file_idx]
-                    ]
-                    target_labels = self.labels_arrs[file_idx][slice_, :]
-
-                    # if self.mmap_mode and self.hashes is not None:
-                    #     sparse_inputs = [
-                    #         feats % hash
-                    #         for (feats, hash) in zip(sparse_inputs, self.hashes)
-                    #     ]
-
-                    append_to_buffer(
-                        dense_inputs,
-                        sparse_inputs,
-                        target_labels,
-                    )
                 row_idx += rows_to_get
 
                 if row_idx >= self.num_rows_per_file[file_idx]:
                     file_idx += 1
                     row_idx = 0
 
+    def _get_prefetcher(self) -> MmapPrefetcher:
+        if self._prefetcher is None:
+            self._prefetcher = MmapPrefetcher(
+                [
+                    [dense, labels, *sparse]
+                    for dense, labels, sparse in zip(
+                        self.dense_arrs, self.labels_arrs, self.sparse_arrs
+                    )
+                ],
+                self.prefetch_batches,
+                self.prefetch_threads,
+            )
+        return self._prefetcher
+
+    def prefetch_stats(self) -> Optional[Dict[str, float]]:
+        """Read-ahead counters accumulated over all iterations, if prefetching is on."""
+        return None if self._prefetcher is None else self._prefetcher.stats()
+
+    def set_epoch(self, epoch: int) -> None:
+        """Sets the epoch used to seed shuffle_batches."""
+        self.epoch = epoch
+
+    def set_start_batch(self, num_batches: int) -> None:
+        """
+        Makes the next iterator skip the first num_batches batches of this rank
+        without reading them, to resume training in the middle of an epoch.
+        """
+        self._start_batch = num_batches
+
+    def position(self, num_batches: int) -> Dict[str, int]:
+        """File and row index of the first row of this rank's num_batches-th batch."""
+        rank_batches = (
+            row_ranges
+            for batch_idx, _, row_ranges in self._batch_row_ranges()
+            if batch_idx % self.world_size == self.rank
+        )
+        row_ranges = next(itertools.islice(rank_batches, num_batches, None), None)
+        if not row_ranges:
+            return {"file_idx": len(self.dense_arrs), "row_idx": 0}
+        return {"file_idx": row_ranges[0][0], "row_idx": row_ranges[0][1]}
+
+    def __iter__(self) -> Iterator[Batch]:
+        # Consumed eagerly, so that only the iterator created right after
+        # set_start_batch skips batches.
+        start_batch, self._start_batch = self._start_batch, 0
+        return self._iter_batches(start_batch)
+
+    def _rank_batches(
+        self, start_batch: int
+    ) -> Iterator[Tuple[Tuple[int, int], List[Tuple[int, int, int]]]]:
+        """Yields ((batch_idx, batch_size), row_ranges) of the rank from start_batch."""
+        rank_batches = itertools.islice(
+            (
+                ((batch_idx, batch_size), row_ranges)
+                for batch_idx, batch_size, row_ranges in self._batch_row_ranges()
+                if batch_idx % self.world_size == self.rank
+            ),
+            start_batch,
+            None,
+        )
+        if self.mmap_mode and self.prefetch_batches > 0:
+            # Page faults of upcoming batches are taken by the reader threads.
+            rank_batches = self._get_prefetcher().prefetch(rank_batches)
+        return rank_batches
+
+    def _read_rows(
+        self,
+        row_ranges: List[Tuple[int, int, int]],
+        dense: np.ndarray,
+        sparse: List[np.ndarray],
+        labels: np.ndarray,
+        buffer_row_count: int = 0,
+    ) -> int:
+        """
+        Copies the rows of row_ranges into the buffers from row buffer_row_count on
+        and returns the row count of the buffers afterwards.
+        """
+        for file_idx, row_start, row_end in row_ranges:
+            slice_ = slice(row_start, row_end)
+            buffer_slice = slice(
+                buffer_row_count, buffer_row_count + row_end - row_start
+            )
+            buffer_row_count += row_end - row_start
+
+            # if self.mmap_mode and self.hashes is not None:
+            #     sparse_inputs = [
+            #         feats % hash
+            #         for (feats, hash) in zip(sparse_inputs, self.hashes)
+            #     ]
+
+            dense[buffer_slice] = self.dense_arrs[file_idx][slice_, :]
+            self._copy_sparse_rows(file_idx, slice_, sparse, buffer_slice)
+            labels[buffer_slice] = self.labels_arrs[file_idx][slice_, :].reshape(-1)
+        return buffer_row_count
+
+    def _iter_batches(self, start_batch: int) -> Iterator[Batch]:
+        if self.shuffle_window_batches > 0:
+            yield from self._iter_windowed_batches(start_batch)
+            return
+
+        # Each batch is assembled in the next buffer of a ring, so batches still held
+        # by the consumer are not overwritten.
+        batch_buffers = [
+            self._new_batch_buffer() for _ in range(self.num_batch_buffers)
+        ]
+        for buffer_idx, ((batch_idx, batch_size), row_ranges) in zip(
+            itertools.cycle(range(len(batch_buffers))), self._rank_batches(start_batch)
+        ):
+            dense, sparse, labels, values = batch_buffers[buffer_idx].views(batch_size)
+            buffer_row_count = self._read_rows(row_ranges, dense, sparse, labels)
+            if buffer_row_count < batch_size:
+                # Ran out of files before the batch was full.
+                dense = dense[:buffer_row_count]
+                sparse = [feats[:buffer_row_count] for feats in sparse]
+                labels = labels[:buffer_row_count]
+                values = None
+            yield self._np_arrays_to_batch(dense, sparse, labels, values, batch_idx)
+
+    def _iter_windowed_batches(self, start_batch: int) -> Iterator[Batch]:
+        """
+        Reads the rows of shuffle_window_batches consecutive batches of this rank
+        into a window buffer, permutes them and gathers them into batches of the
+        original sizes. Resuming at start_batch rebuilds its window and skips the
+        batches before it, so resumed runs see the same batches.
+        """
+        window_batches = self.shuffle_window_batches
+        window_idx = start_batch // window_batches
+        skip = start_batch - window_idx * window_batches
+        rank_batches = self._rank_batches(window_idx * window_batches)
+        window = self._new_batch_buffer(window_batches)
+        batch_buffers = [
+            self._new_batch_buffer() for _ in range(self.num_batch_buffers)
+        ]
+        buffer_indices = itertools.cycle(range(len(batch_buffers)))
+        while True:
+            batches = list(itertools.islice(rank_batches, window_batches))
+            if not batches:
+                return
+            window_dense, window_sparse, window_labels, _ = window.views(
+                sum(batch_size for (_, batch_size), _ in batches)
+            )
+            num_rows = 0
+            batch_rows = []
+            for _, row_ranges in batches:
+                start = num_rows
+                num_rows = self._read_rows(
+                    row_ranges, window_dense, window_sparse, window_labels, num_rows
+                )
+                batch_rows.append(num_rows - start)
+            permutation = np.random.default_rng(
+                (self.shuffle_seed, self.epoch, self.rank, window_idx)
+            ).permutation(num_rows)
+
+            start = 0
+            for ((batch_idx, batch_size), _), num_batch_rows in zip(
+                batches, batch_rows
+            ):
+                rows = permutation[start : start + num_batch_rows]
+                start += num_batch_rows
+                if skip > 0:
+                    skip -= 1
+                    continue
+                dense, sparse, labels, values = batch_buffers[
+                    next(buffer_indices)
+                ].views(batch_size)
+                if num_batch_rows < batch_size:
+                    # Ran out of files before the batch was full.
+                    dense = dense[:num_batch_rows]
+                    sparse = [feats[:num_batch_rows] for feats in sparse]
+                    labels = labels[:num_batch_rows]
+                    values = None
+                np.take(window_dense, rows, axis=0, out=dense, mode="clip")
+                for feats, window_feats in zip(sparse, window_sparse):
+                    np.take(window_feats, rows, axis=0, out=feats, mode="clip")
+                np.take(window_labels, rows, axis=0, out=labels, mode="clip")
+                yield self._np_arrays_to_batch(
+                    dense, sparse, labels, values, batch_idx
+                )
+            window_idx += 1
+
     def __len__(self) -> int:
         return self.num_full_batches // self.world_size + (self.last_batch_sizes[0] > 0)
+
+
+# Multi-hot lookup tables by (multi-hot sizes, hashes, distribution type), shared
+# by the train, val and test datapipes of a process.
+_MULTI_HOT_TABLES: Dict[Tuple, List[np.ndarray]] = {}
+
+
+def _get_multi_hot_tables(
+    multi_hot_sizes: List[int],
+    hashes: List[int],
+    batch_size: int,
+    dist_type: str,
+) -> List[np.ndarray]:
+    key = (tuple(multi_hot_sizes), tuple(hashes), dist_type)
+    if key not in _MULTI_HOT_TABLES:
+        multihot = Multihot(
+            multi_hot_sizes,
+            hashes,
+            batch_size,
+            collect_freqs_stats=False,
+            dist_type=dist_type,
+        )
+        _MULTI_HOT_TABLES[key] = [
+            multi_hot_table.numpy() for multi_hot_table in multihot.multi_hot_tables_l
+        ]
+    return _MULTI_HOT_TABLES[key]
+
+
+class OnTheFlyMultiHotCriteoIterDataPipe(MultiHotCriteoIterDataPipe):
+    """
+    Datapipe that reads the 1-hot binary Criteo days (the output of
+    process_Criteo_1TB_Click_Logs_dataset.sh) and expands them to multi-hot while
+    batching, with the same deterministic lookup tables as
+    materialize_synthetic_multihot_dataset.py. It yields the same batches as
+    MultiHotCriteoIterDataPipe over the materialized dataset without storing it.
+
+    The lookup of each feature is a vectorized gather from the 1-hot rows of the
+    batch directly into the batch buffer, and the 26 features are gathered by a
+    thread pool (np.take releases the GIL).
+
+    Args:
+        stage (str): "train", "val", or "test".
+        dense_paths (List[str]): List of path strings to dense npy files.
+        sparse_paths (List[str]): List of path strings to 1-hot sparse npy files.
+        labels_paths (List[str]): List of path strings to labels npy files.
+        batch_size (int): batch size.
+        rank (int): rank.
+        world_size (int): world size.
+        multi_hot_sizes (List[int]): multi-hot size of each sparse feature.
+        hashes (List[int]): number of embeddings of each sparse feature. 1-hot ids
+            are taken modulo these before the lookup.
+        multi_hot_distribution_type (str): "uniform" or "pareto".
+        num_gather_threads (int): number of threads gathering the features.
+        kwargs: other MultiHotCriteoIterDataPipe arguments.
+    """
+
+    def __init__(
+        self,
+        stage: str,
+        dense_paths: List[str],
+        sparse_paths: List[str],
+        labels_paths: List[str],
+        batch_size: int,
+        rank: int,
+        world_size: int,
+        multi_hot_sizes: List[int],
+        hashes: List[int],
+        multi_hot_distribution_type: str = "uniform",
+        num_gather_threads: int = 8,
+        **kwargs,
+    ) -> None:
+        assert len(multi_hot_sizes) == CAT_FEATURE_COUNT
+        self._configured_multi_hot_sizes = multi_hot_sizes
+        self.multi_hot_tables: List[np.ndarray] = _get_multi_hot_tables(
+            multi_hot_sizes, hashes, batch_size, multi_hot_distribution_type
+        )
+        self.num_gather_threads = num_gather_threads
+        self._gather_pool: Optional[ThreadPoolExecutor] = None
+        super().__init__(
+            stage,
+            dense_paths,
+            sparse_paths,
+            labels_paths,
+            batch_size,
+            rank,
+            world_size,
+            hashes=hashes,
+            **kwargs,
+        )
+
+    def _load_sparse_arrs(
+        self, sparse_path: str, mmap_mode: Optional[str]
+    ) -> List[np.ndarray]:
+        # A single [rows, CAT_FEATURE_COUNT] array of 1-hot ids per file.
+        return [np.load(sparse_path, mmap_mode=mmap_mode)]
+
+    def _get_multi_hot_sizes(self) -> List[int]:
+        return self._configured_multi_hot_sizes
+
+    def _get_sparse_dtype(self) -> np.dtype:
+        return self.multi_hot_tables[0].dtype
+
+    def _gather_feature(
+        self, feat_id_num: int, one_hot: np.ndarray, out: np.ndarray
+    ) -> None:
+        # Same as nn.functional.embedding(sparse % hash, multi_hot_table) in
+        # materialize_synthetic_multihot_dataset.py. Ids are in range after the
+        # modulo, "clip" avoids np.take buffering out.
+        ids = one_hot[:, feat_id_num] % self.hashes[feat_id_num, 0]
+        np.take(self.multi_hot_tables[feat_id_num], ids, axis=0, out=out, mode="clip")
+
+    def _copy_sparse_rows(
+        self,
+        file_idx: int,
+        slice_: slice,
+        sparse_buffers: List[np.ndarray],
+        buffer_slice: slice,
+    ) -> None:
+        one_hot = np.asarray(self.sparse_arrs[file_idx][0][slice_, :])
+        if self.num_gather_threads <= 1:
+            for feat_id_num, feats_buffer in enumerate(sparse_buffers):
+                self._gather_feature(feat_id_num, one_hot, feats_buffer[buffer_slice])
+            return
+        if self._gather_pool is None:
+            self._gather_pool = ThreadPoolExecutor(
+                self.num_gather_threads, thread_name_prefix="multi_hot_gather"
+            )
+        futures = [
+            self._gather_pool.submit(
+                self._gather_feature, feat_id_num, one_hot, feats_buffer[buffer_slice]
+            )
+            for feat_id_num, feats_buffer in enumerate(sparse_buffers)
+        ]
+        for future in futures:
+            future.result()
@@ -5,18 +5,19 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import copy
 import itertools
 import os
 import sys
+import time
 from dataclasses import dataclass, field
 from enum import Enum
 from pprint import pprint
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 import mlperf_logging.mllog as mllog
 import mlperf_logging.mllog.constants as mllog_constants
 import torch
-import torchmetrics as metrics
 from pyre_extensions import none_throws
 from torch import distributed as dist
 from torch.utils.data import DataLoader
@@ -41,10 +42,37 @@ from tqdm import tqdm
 
 # OSS import
 try:
+    # pyre-ignore[21]
+    # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm:auroc
+    from auroc import BinnedAUROC, DEFAULT_AUROC_NUM_BINS, ExactAUROC
+
+    # pyre-ignore[21]
+    # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm:checkpoint
+    from checkpoint import Checkpointer
+
     # pyre-ignore[21]
     # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm/data:dlrm_dataloader
     from data.dlrm_dataloader import get_dataloader
 
+    # pyre-ignore[21]
+    # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm:embedding_frequency
+    from embedding_frequency import (
+        EmbeddingFrequencyProfiler,
+        load_parameter_constraints,
+        save_plan_hints,
+    )
+
+    # pyre-ignore[21]
+    # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm:embedding_quantization
+    from embedding_quantization import (
+        embedding_weights,
+        fake_quantize_local_shards,
+        gather_table,
+        parse_quantization_bits,
+        QuantizedEmbeddingBagCollection,
+        restore_local_shards,
+    )
+
     # pyre-ignore[21]
     # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm:lr_scheduler
     from lr_scheduler import LRPolicyScheduler
@@ -61,7 +89,22 @@ except ImportError:
 
 # internal import
 try:
+    from .auroc import BinnedAUROC, DEFAULT_AUROC_NUM_BINS, ExactAUROC  # noqa F811
+    from .checkpoint import Checkpointer  # noqa F811
     from .data.dlrm_dataloader import get_dataloader  # noqa F811
+    from .embedding_frequency import (  # noqa F811
+        EmbeddingFrequencyProfiler,
+        load_parameter_constraints,
+        save_plan_hints,
+    )
+    from .embedding_quantization import (  # noqa F811
+        embedding_weights,
+        fake_quantize_local_shards,
+        gather_table,
+        parse_quantization_bits,
+        QuantizedEmbeddingBagCollection,
+        restore_local_shards,
+    )
     from .lr_scheduler import LRPolicyScheduler  # noqa F811
     from .mlperf_logging_utils import submission_info  # noqa F811
     from .multi_hot import Multihot, RestartableMap  # noqa F811
@@ -215,6 +258,20 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
         " preloading the dataset when preloading takes too long or when there is "
         " insufficient memory available to load the full dataset.",
     )
+    parser.add_argument(
+        "--mmap_prefetch_batches",
+        type=int,
+        default=0,
+        help="With --mmap_mode and --synthetic_multi_hot_criteo_path, number of"
+        " upcoming batches per rank whose rows are read into the page cache by"
+        " background threads. 0 disables read-ahead.",
+    )
+    parser.add_argument(
+        "--mmap_prefetch_threads",
+        type=int,
+        default=4,
+        help="Number of read-ahead threads per dataloader used by --mmap_prefetch_batches.",
+    )
     parser.add_argument(
         "--in_memory_binary_criteo_path",
         type=str,
@@ -245,6 +302,15 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
         action="store_true",
         help="Shuffle the training set in memory. This will override mmap_mode",
     )
+    parser.add_argument(
+        "--shuffle_window_batches",
+        type=int,
+        default=0,
+        help="With --synthetic_multi_hot_criteo_path or --multi_hot_in_dataloader,"
+        " shuffle the training samples of each rank within windows of this many"
+        " consecutive batches held in memory, seeded by --seed, the epoch and the"
+        " rank. 0 disables windowed shuffling.",
+    )
     parser.add_argument(
         "--validation_freq_within_epoch",
         type=int,
@@ -257,6 +323,20 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
         default=None,
         help="Validation AUROC threshold to stop training once reached.",
     )
+    parser.add_argument(
+        "--auroc_num_bins",
+        type=int,
+        default=DEFAULT_AUROC_NUM_BINS,
+        help="Number of histogram bins of the streaming AUROC used for evaluation."
+        " Memory is O(auroc_num_bins) per rank and the AUROC error is at most half the"
+        " fraction of positive/negative pairs sharing a bin.",
+    )
+    parser.add_argument(
+        "--exact_auroc",
+        action="store_true",
+        help="Compute the exact AUROC with a distributed sample sort instead of the"
+        " binned streaming AUROC. Keeps every prediction until the end of evaluation.",
+    )
     parser.add_argument(
         "--evaluate_on_epoch_end",
         action="store_true",
@@ -300,6 +380,22 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
         default=None,
         help="Multi-hot distribution options.",
     )
+    parser.add_argument(
+        "--multi_hot_in_dataloader",
+        dest="multi_hot_in_dataloader",
+        action="store_true",
+        help="With --in_memory_binary_criteo_path and --multi_hot_sizes, expand 1-hot"
+        " to multi-hot while batching in the dataloader, with the same lookup tables as"
+        " materialize_synthetic_multihot_dataset.py, instead of on the batches. Yields"
+        " the batches of --synthetic_multi_hot_criteo_path without materializing it.",
+    )
+    parser.add_argument(
+        "--multi_hot_gather_threads",
+        type=int,
+        default=8,
+        help="Number of threads per dataloader expanding the sparse features with"
+        " --multi_hot_in_dataloader.",
+    )
     parser.add_argument(
         "--lr_warmup_steps",
         type=int,
@@ -325,6 +421,88 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
         action="store_true",
         help="Enable TensorFloat-32 mode for matrix multiplications on A100 (or newer) GPUs.",
     )
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default=None,
+        help="Directory for sharded training checkpoints. If it holds a complete"
+        " checkpoint, training resumes from it exactly.",
+    )
+    parser.add_argument(
+        "--checkpoint_freq",
+        type=int,
+        default=None,
+        help="Number of training steps between checkpoints. A checkpoint is also"
+        " written at the end of every epoch when --checkpoint_dir is set.",
+    )
+    parser.add_argument(
+        "--checkpoint_keep",
+        type=int,
+        default=2,
+        help="Number of most recent checkpoints kept in --checkpoint_dir.",
+    )
+    parser.add_argument(
+        "--embedding_frequency_output",
+        type=str,
+        default=None,
+        help="If set, profile embedding row access frequencies during training and"
+        " write table placement hints as JSON to this path at the end of training.",
+    )
+    parser.add_argument(
+        "--frequency_sketch_width",
+        type=int,
+        default=1 << 20,
+        help="Counters per hash function of the count-min sketches used to profile"
+        " tables larger than 4 * frequency_sketch_width rows.",
+    )
+    parser.add_argument(
+        "--frequency_sketch_sample_every",
+        type=int,
+        default=10,
+        help="Profile one training batch out of frequency_sketch_sample_every.",
+    )
+    parser.add_argument(
+        "--plan_hints_hbm_budget_gb",
+        type=float,
+        default=32.0,
+        help="HBM in GB, summed over all devices, that the placement hints may use"
+        " for embedding tables and caches.",
+    )
+    parser.add_argument(
+        "--plan_hints_target_hit_rate",
+        type=float,
+        default=0.95,
+        help="Fraction of accesses the caches recommended by the placement hints"
+        " should serve.",
+    )
+    parser.add_argument(
+        "--embedding_plan_hints",
+        type=str,
+        default=None,
+        help="Path to placement hints written by --embedding_frequency_output, used"
+        " as constraints of the embedding sharding planner.",
+    )
+    parser.add_argument(
+        "--quantize_embeddings",
+        type=str,
+        default=None,
+        help="After training, evaluate the validation set with the embedding tables"
+        " quantized row-wise. Either int8, int4 or a comma separated precision per"
+        " table out of fp32, int8 and int4.",
+    )
+    parser.add_argument(
+        "--quantized_eval_per_table",
+        action="store_true",
+        help="With --quantize_embeddings, also evaluate with each table quantized"
+        " alone to report the AUROC delta of every table.",
+    )
+    parser.add_argument(
+        "--quantized_cpu_eval_batches",
+        type=int,
+        default=0,
+        help="With --quantize_embeddings, number of validation batches of rank 0"
+        " evaluated on CPU with the quantized tables. 0 disables CPU evaluation.",
+    )
     parser.add_argument(
         "--print_sharding_plan",
         action="store_true",
@@ -338,6 +516,38 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
     return parser.parse_args(argv)
 
 
+def _get_datapipe(dataloader):
+    """Returns the dataset under a DataLoader, possibly wrapped in RestartableMaps."""
+    while isinstance(dataloader, RestartableMap):
+        dataloader = dataloader.source
+    return getattr(dataloader, "dataset", None)
+
+
+def _save_checkpoint(
+    checkpointer: Checkpointer,
+    train_pipeline: TrainPipelineSparseDist,
+    lr_scheduler,
+    train_dataloader: DataLoader,
+    epoch: int,
+    batches_trained: int,
+) -> None:
+    """
+    Saves the training state after batches_trained batches of epoch. The batches the
+    pipeline has already loaded but not trained are loaded again on resume.
+    """
+    train_state = {"epoch": epoch, "batches_trained": batches_trained}
+    datapipe = _get_datapipe(train_dataloader)
+    if hasattr(datapipe, "position"):
+        train_state["position"] = datapipe.position(batches_trained)
+    checkpointer.save(
+        epoch * len(train_dataloader) + batches_trained,
+        train_pipeline._model,
+        train_pipeline._optimizer,
+        lr_scheduler,
+        train_state,
+    )
+
+
 def _evaluate(
     limit_batches: Optional[int],
     eval_pipeline: TrainPipelineSparseDist,
@@ -346,6 +556,8 @@ def _evaluate(
     epoch_num: float,
     log_eval_samples: bool,
     print_progress: bool,
+    auroc_num_bins: Optional[int] = DEFAULT_AUROC_NUM_BINS,
+    log_mllog: bool = True,
 ) -> float:
     """
     Evaluates model. Computes and prints AUROC. Helper function for train_val_test.
@@ -358,6 +570,8 @@ def _evaluate(
         epoch_num (float): Iterations passed as epoch fraction (for logging purposes).
         log_eval_samples (bool): Whether to print mllog with the number of samples.
         print_progress (bool): Whether to print tqdm progress bar.
+        auroc_num_bins (Optional[int]): Number of bins of the streaming AUROC. None computes the exact AUROC.
+        log_mllog (bool): Whether to log the evaluation to the MLPerf log.
 
     Returns:
         float: auroc result
@@ -370,6 +584,7 @@ def _evaluate(
             total=len(eval_dataloader),
             disable=not print_progress,
         )
+    if is_rank_zero and log_mllog:
         mllogger.start(
             key=mllog_constants.EVAL_START,
             metadata={mllog_constants.EPOCH_NUM: epoch_num},
@@ -389,7 +604,10 @@ def _evaluate(
     )
     iterator = itertools.chain(iterator, two_filler_batches)
 
-    auroc = metrics.AUROC(compute_on_step=False, task='binary').to(device)
+    if auroc_num_bins is None:
+        auroc = ExactAUROC(device)
+    else:
+        auroc = BinnedAUROC(auroc_num_bins, device)
 
     with torch.no_grad():
         while True:
@@ -403,14 +621,14 @@ def _evaluate(
                 # Dataset traversal complete
                 break
 
+    # compute() combines the results of all ranks, so num_samples is global afterwards.
     auroc_result = auroc.compute().item()
-    num_samples = torch.tensor(sum(map(len, auroc.target)), device=device)
-    dist.reduce(num_samples, 0, op=dist.ReduceOp.SUM)
-    num_samples = num_samples.item()
+    num_samples = auroc.num_samples
 
     if is_rank_zero:
         print(f"AUROC over {stage} set: {auroc_result}.")
         print(f"Number of {stage} samples: {num_samples}")
+    if is_rank_zero and log_mllog:
         mllogger.event(
             key=mllog_constants.EVAL_ACCURACY,
             value=auroc_result,
@@ -442,6 +660,10 @@ def _train(
     limit_train_batches: Optional[int],
     limit_val_batches: Optional[int],
     print_progress: bool,
+    auroc_num_bins: Optional[int] = DEFAULT_AUROC_NUM_BINS,
+    start_batch: int = 0,
+    checkpointer: Optional[Checkpointer] = None,
+    checkpoint_freq: Optional[int] = None,
 ) -> bool:
     """
     Trains model for 1 epoch. Helper function for train_val_test.
@@ -459,6 +681,10 @@ def _train(
         limit_train_batches (Optional[int]): Limits the training set to the first `limit_train_batches` batches.
         limit_val_batches (Optional[int]): Limits the validation set to the first `limit_val_batches` batches.
         print_progress (bool): Whether to print tqdm progress bar.
+        auroc_num_bins (Optional[int]): Number of bins of the streaming AUROC. None computes the exact AUROC.
+        start_batch (int): Number of batches of the epoch already trained before resuming.
+        checkpointer (Optional[Checkpointer]): Writes checkpoints if given.
+        checkpoint_freq (Optional[int]): The number of training steps between checkpoints.
 
     Returns:
         bool: Whether the validation_auroc threshold is reached.
@@ -468,7 +694,21 @@ def _train(
     # Set train_pipeline._connected to False to cause the pipeline to refill with new batches as if it were newly created and empty.
     train_pipeline._connected = False
 
-    iterator = itertools.islice(iter(train_dataloader), limit_train_batches)
+    datapipe = _get_datapipe(train_dataloader)
+    if hasattr(datapipe, "set_epoch"):
+        datapipe.set_epoch(epoch)
+    if start_batch > 0 and hasattr(datapipe, "set_start_batch"):
+        # Skips the trained batches without reading them.
+        datapipe.set_start_batch(start_batch)
+        iterator = iter(train_dataloader)
+    else:
+        iterator = itertools.islice(iter(train_dataloader), start_batch, None)
+    iterator = itertools.islice(
+        iterator,
+        None
+        if limit_train_batches is None
+        else max(limit_train_batches - start_batch, 0),
+    )
     # Two filler batches are appended to the end of the iterator to keep the pipeline active while the
     # last two remaining batches are still in progress awaiting results.
     two_filler_batches = itertools.islice(
@@ -482,13 +722,14 @@ def _train(
             iter(int, 1),
             desc=f"Epoch {epoch}",
             total=len(train_dataloader),
+            initial=start_batch,
             disable=not print_progress,
         )
 
-    it = 1
+    it = start_batch + 1
     is_success = False
     is_first_eval = True
-    for it in itertools.count(1):
+    for it in itertools.count(start_batch + 1):
         try:
             if is_rank_zero and print_lr:
                 for i, g in enumerate(train_pipeline._optimizer.param_groups):
@@ -497,6 +738,19 @@ def _train(
             lr_scheduler.step()
             if is_rank_zero:
                 pbar.update(1)
+            if (
+                checkpointer is not None
+                and checkpoint_freq
+                and it % checkpoint_freq == 0
+            ):
+                _save_checkpoint(
+                    checkpointer,
+                    train_pipeline,
+                    lr_scheduler,
+                    train_dataloader,
+                    epoch,
+                    it,
+                )
             if validation_freq and it % validation_freq == 0:
                 epoch_num = epoch + it / len(train_dataloader)
                 auroc_result = _evaluate(
@@ -507,6 +761,7 @@ def _train(
                     epoch_num,
                     is_first_eval and epoch == 0,
                     print_progress,
+                    auroc_num_bins,
                 )
                 is_first_eval = False
                 if validation_auroc is not None and auroc_result >= validation_auroc:
@@ -528,6 +783,11 @@ def _train(
 
     if is_rank_zero:
         print("Total number of iterations:", it - 1)
+        prefetch_stats = getattr(
+            _get_datapipe(train_dataloader), "prefetch_stats", None
+        )
+        if prefetch_stats is not None and prefetch_stats() is not None:
+            print("Training set read-ahead:", prefetch_stats())
 
     return is_success
 
@@ -570,10 +830,23 @@ def train_val_test(
     test_pipeline = TrainPipelineSparseDist(model, optimizer, device)
 
     is_rank_zero = dist.get_rank() == 0
+    auroc_num_bins = None if args.exact_auroc else args.auroc_num_bins
+
+    start_epoch = 0
+    start_batch = 0
+    checkpointer = None
+    if args.checkpoint_dir is not None:
+        checkpointer = Checkpointer(args.checkpoint_dir, args.checkpoint_keep)
+        train_state = checkpointer.load(model, optimizer, lr_scheduler)
+        if train_state is not None:
+            start_epoch = train_state["epoch"]
+            start_batch = train_state["batches_trained"]
+            if is_rank_zero:
+                print(f"Resuming from checkpoint at {train_state}")
 
-    epoch = 0
+    epoch = start_epoch
     is_success = False
-    for epoch in range(args.epochs):
+    for epoch in range(start_epoch, args.epochs):
         if is_rank_zero:
             mllogger.start(
                 key=mllog_constants.EPOCH_START,
@@ -592,7 +865,20 @@ def train_val_test(
             args.limit_train_batches,
             args.limit_val_batches,
             args.print_progress,
+            auroc_num_bins,
+            start_batch if epoch == start_epoch else 0,
+            checkpointer,
+            args.checkpoint_freq,
         )
+        if checkpointer is not None and not is_success:
+            _save_checkpoint(
+                checkpointer,
+                train_pipeline,
+                lr_scheduler,
+                train_dataloader,
+                epoch + 1,
+                0,
+            )
         if args.evaluate_on_epoch_end:
             val_auroc = _evaluate(
                 args.limit_val_batches,
@@ -602,6 +888,7 @@ def train_val_test(
                 epoch + 1,
                 False,
                 args.print_progress,
+                auroc_num_bins,
             )
             results.val_aurocs.append(val_auroc)
         if is_rank_zero:
@@ -612,6 +899,8 @@ def train_val_test(
         if is_success:
             break
 
+    if checkpointer is not None:
+        checkpointer.wait()
     dist.barrier()
     if is_rank_zero and not is_success:
         # Run status "aborted" is reported in the case AUROC threshold is not met
@@ -632,12 +921,143 @@ def train_val_test(
             epoch + 1,
             False,
             args.print_progress,
+            auroc_num_bins,
         )
         results.test_auroc = test_auroc
 
     return results
 
 
+def _evaluate_on_cpu(
+    serving_model: torch.nn.Module,
+    eval_dataloader: DataLoader,
+    limit_batches: int,
+    auroc_num_bins: int,
+) -> float:
+    """Evaluates serving_model on CPU over this rank's first limit_batches batches."""
+    serving_model.eval()
+    auroc = BinnedAUROC(auroc_num_bins, sync_ranks=False)
+    start = time.perf_counter()
+    with torch.no_grad():
+        for batch in itertools.islice(iter(eval_dataloader), limit_batches):
+            _loss, (_, logits, labels) = serving_model(batch)
+            auroc(torch.sigmoid(logits), labels)
+    elapsed = time.perf_counter() - start
+    auroc_result = auroc.compute().item()
+    print(
+        f"AUROC over val set on CPU: {auroc_result} ({auroc.num_samples} samples,"
+        f" {auroc.num_samples / max(elapsed, 1e-9):.0f} samples/s)."
+    )
+    return auroc_result
+
+
+def evaluate_quantized_embeddings(
+    args: argparse.Namespace,
+    model: torch.nn.Module,
+    optimizer: torch.optim.Optimizer,
+    device: torch.device,
+    val_dataloader: DataLoader,
+    eb_configs: List[EmbeddingBagConfig],
+    serving_model: Optional[torch.nn.Module] = None,
+) -> Dict[str, float]:
+    """
+    Evaluates the trained model on the validation set with its embedding tables
+    quantized row-wise as given by --quantize_embeddings.
+
+    The distributed evaluations quantize and dequantize the local shards in place
+    and restore them afterwards: first each quantized table alone with
+    --quantized_eval_per_table, then all of them together. With
+    --quantized_cpu_eval_batches, the tables are also gathered one at a time to
+    rank 0 and stored quantized in a CPU copy of the model (serving_model, an
+    unsharded DLRMTrain) which evaluates rank 0's validation batches.
+
+    Returns:
+        Dict[str, float]: AUROC of "fp32", of each table quantized alone (by table
+            name), of "all" tables quantized and, on rank 0, of "cpu".
+    """
+    is_rank_zero = dist.get_rank() == 0
+    auroc_num_bins = None if args.exact_auroc else args.auroc_num_bins
+    bits = parse_quantization_bits(
+        args.quantize_embeddings, [config.name for config in eb_configs]
+    )
+    quantized_tables = [name for name, table_bits in bits.items() if table_bits < 32]
+    weights = embedding_weights(model)
+    pipeline = TrainPipelineSparseDist(model, optimizer, device)
+
+    def evaluate(description: str) -> float:
+        return _evaluate(
+            args.limit_val_batches,
+            pipeline,
+            val_dataloader,
+            f"val ({description})",
+            args.epochs,
+            False,
+            args.print_progress,
+            auroc_num_bins,
+            log_mllog=False,
+        )
+
+    results = {"fp32": evaluate("fp32")}
+    if args.quantized_eval_per_table:
+        for name in quantized_tables:
+            backups = fake_quantize_local_shards(weights[name], bits[name])
+            results[name] = evaluate(f"{name} int{bits[name]}")
+            restore_local_shards(weights[name], backups)
+    all_backups = {
+        name: fake_quantize_local_shards(weights[name], bits[name])
+        for name in quantized_tables
+    }
+    results["all"] = evaluate("all tables quantized")
+    for name, backups in all_backups.items():
+        restore_local_shards(weights[name], backups)
+
+    if args.quantized_cpu_eval_batches > 0:
+        serving_ebc = QuantizedEmbeddingBagCollection(eb_configs, bits)
+        for config in eb_configs:
+            weight = gather_table(weights[config.name], device)
+            if is_rank_zero:
+                serving_ebc.load_weight(config.name, weight)
+            del weight
+        if is_rank_zero:
+            serving_model = none_throws(serving_model)
+            serving_model.model.sparse_arch.embedding_bag_collection = serving_ebc
+            serving_model.load_state_dict(
+                {
+                    key: value.detach().cpu()
+                    for key, value in model.state_dict().items()
+                    if ".embedding_bags." not in key
+                }
+            )
+            results["cpu"] = _evaluate_on_cpu(
+                serving_model.to("cpu"),
+                val_dataloader,
+                args.quantized_cpu_eval_batches,
+                args.auroc_num_bins,
+            )
+            nbytes = serving_ebc.table_nbytes()
+            fp32_nbytes = sum(
+                config.num_embeddings * config.embedding_dim * 4
+                for config in eb_configs
+            )
+            print(
+                f"Quantized embedding tables use {sum(nbytes.values()) / 2**30:.2f}"
+                f" GiB instead of {fp32_nbytes / 2**30:.2f} GiB in fp32."
+            )
+        dist.barrier()
+
+    if is_rank_zero:
+        print("AUROC deltas of quantized embeddings vs fp32:")
+        for name, auroc_result in results.items():
+            if name == "fp32":
+                continue
+            suffix = f" int{bits[name]}" if name in bits else ""
+            print(
+                f"  {name}{suffix}: {auroc_result:.6f}"
+                f" ({auroc_result - results['fp32']:+.6f})"
+            )
+    return results
+
+
 def main(argv: List[str]) -> None:
     """
     Trains, validates, and tests a Deep Learning Recommendation Model (DLRM)
@@ -687,6 +1107,14 @@ def main(argv: List[str]) -> None:
         args.multi_hot_distribution_type is None
         or args.synthetic_multi_hot_criteo_path is None
     ), "--multi_hot_distribution_type is used to convert 1-hot to multi-hot. It's inapplicable with --synthetic_multi_hot_criteo_path."
+    if args.multi_hot_in_dataloader:
+        assert (
+            args.in_memory_binary_criteo_path is not None
+            and args.multi_hot_sizes is not None
+        ), "--multi_hot_in_dataloader requires --in_memory_binary_criteo_path and --multi_hot_sizes."
+        assert (
+            not args.collect_multi_hot_freqs_stats
+        ), "--collect_multi_hot_freqs_stats is not supported with --multi_hot_in_dataloader."
 
     rank = int(os.environ["LOCAL_RANK"])
     if torch.cuda.is_available():
@@ -783,6 +1211,12 @@ def main(argv: List[str]) -> None:
         )
 
     train_model = DLRMTrain(dlrm_model)
+    # Unsharded copy of the dense layers for --quantized_cpu_eval_batches.
+    serving_model = (
+        copy.deepcopy(train_model)
+        if args.quantize_embeddings is not None and args.quantized_cpu_eval_batches > 0
+        else None
+    )
     embedding_optimizer = torch.optim.Adagrad if args.adagrad else torch.optim.SGD
     # This will apply the Adagrad optimizer in the backward pass for the embeddings (sparse_arch). This means that
     # the optimizer update will be applied in the backward pass, in this case through a fused op.
@@ -809,6 +1243,9 @@ def main(argv: List[str]) -> None:
         # If experience OOM, increase the percentage. see
         # https://pytorch.org/torchrec/torchrec.distributed.planner.html#torchrec.distributed.planner.storage_reservations.HeuristicalStorageReservation
         storage_reservation=HeuristicalStorageReservation(percentage=0.05),
+        constraints=load_parameter_constraints(args.embedding_plan_hints)
+        if args.embedding_plan_hints is not None
+        else None,
     )
     plan = planner.collective_plan(
         train_model, get_default_sharders(), dist.GroupMember.WORLD
@@ -907,7 +1344,7 @@ def main(argv: List[str]) -> None:
             value=dist.get_world_size() * len(train_dataloader) * args.batch_size,
         )
 
-    if args.multi_hot_sizes is not None:
+    if args.multi_hot_sizes is not None and not args.multi_hot_in_dataloader:
         multihot = Multihot(
             args.multi_hot_sizes,
             args.num_embeddings_per_feature,
@@ -921,6 +1358,18 @@ def main(argv: List[str]) -> None:
         )
         val_dataloader = RestartableMap(multihot.convert_to_multi_hot, val_dataloader)
         test_dataloader = RestartableMap(multihot.convert_to_multi_hot, test_dataloader)
+    if args.embedding_frequency_output is not None:
+        frequency_profiler = EmbeddingFrequencyProfiler(
+            DEFAULT_CAT_NAMES,
+            args.num_embeddings_per_feature
+            if args.num_embeddings is None
+            else [args.num_embeddings] * len(DEFAULT_CAT_NAMES),
+            width=args.frequency_sketch_width,
+            sample_every=args.frequency_sketch_sample_every,
+        )
+        train_dataloader = RestartableMap(
+            frequency_profiler.observe, train_dataloader
+        )
     train_val_test(
         args,
         model,
@@ -931,8 +1380,31 @@ def main(argv: List[str]) -> None:
         test_dataloader,
         lr_scheduler,
     )
+    if args.quantize_embeddings is not None:
+        evaluate_quantized_embeddings(
+            args,
+            model,
+            optimizer,
+            device,
+            val_dataloader,
+            eb_configs,
+            serving_model,
+        )
     if args.collect_multi_hot_freqs_stats:
         multihot.save_freqs_stats()
+    if args.embedding_frequency_output is not None:
+        frequency_profiler.all_reduce(device)
+        if is_rank_zero:
+            hints = frequency_profiler.plan_hints(
+                args.embedding_dim,
+                int(args.plan_hints_hbm_budget_gb * 2**30),
+                args.plan_hints_target_hit_rate,
+            )
+            save_plan_hints(hints, args.embedding_frequency_output)
+            print(
+                "Embedding placement hints written to",
+                args.embedding_frequency_output,
+            )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+from typing import Dict, List, Optional
+
+import torch
+from torch import distributed as dist
+from torchrec.datasets.utils import Batch
+from torchrec.distributed.planner.types import ParameterConstraints
+
+# Hashes of the count-min sketch are (a * id + b) mod _PRIME mod width. Ids are below
+# 2**32 and a below 2**31, so the products fit in int64.
+_PRIME = (1 << 31) - 1
+COVERAGE_FRACTIONS = [0.5, 0.8, 0.9, 0.95, 0.99]
+# Number of ids queried at once when estimating the counts of a whole table.
+_QUERY_CHUNK = 1 << 22
+
+
+class CountMinSketch:
+    """
+    Count-min sketch of id frequencies. Estimates never undercount and overcount by
+    at most total / width * e with probability 1 - exp(-depth). Sketches built with
+    the same width, depth and seed can be summed, e.g. across ranks.
+
+    Args:
+        width (int): number of counters per hash function.
+        depth (int): number of hash functions.
+        seed (int): seed of the hash functions.
+    """
+
+    def __init__(self, width: int, depth: int, seed: int = 0) -> None:
+        generator = torch.Generator().manual_seed(seed)
+        self.width = width
+        self.depth = depth
+        self.a = torch.randint(1, _PRIME, (depth, 1), generator=generator)
+        self.b = torch.randint(0, _PRIME, (depth, 1), generator=generator)
+        self.counts = torch.zeros(depth, width, dtype=torch.int64)
+
+    def _buckets(self, ids: torch.Tensor) -> torch.Tensor:
+        # [depth, num_ids]
+        return (self.a * ids.view(1, -1) + self.b) % _PRIME % self.width
+
+    def update(self, ids: torch.Tensor) -> None:
+        buckets = self._buckets(ids)
+        # Flat indices of the [depth, width] counters.
+        buckets += torch.arange(self.depth).view(-1, 1) * self.width
+        self.counts.view(-1).index_add_(
+            0, buckets.view(-1), torch.ones(buckets.numel(), dtype=torch.int64)
+        )
+
+    def query(self, ids: torch.Tensor) -> torch.Tensor:
+        return torch.gather(self.counts, 1, self._buckets(ids)).min(dim=0).values
+
+
+class EmbeddingFrequencyProfiler:
+    """
+    Streams embedding row access counts of every sparse feature from training
+    batches. Tables with at most width * depth rows are counted exactly, larger ones
+    with a CountMinSketch, so memory stays bounded for 40M-row tables. Only one batch
+    in sample_every is counted to keep the overhead off the training step.
+
+    Args:
+        keys (List[str]): sparse feature names.
+        num_embeddings_per_feature (List[int]): number of rows of each table.
+        width (int): counters per hash function of the sketches.
+        depth (int): hash functions of the sketches.
+        sample_every (int): count one batch out of sample_every.
+        seed (int): seed of the sketch hash functions, the same on all ranks.
+
+    Example::
+
+        profiler = EmbeddingFrequencyProfiler(DEFAULT_CAT_NAMES, num_embeddings)
+        train_dataloader = RestartableMap(profiler.observe, train_dataloader)
+        ...
+        profiler.all_reduce(device)
+        save_plan_hints(profiler.plan_hints(embedding_dim, hbm_budget_bytes), path)
+    """
+
+    def __init__(
+        self,
+        keys: List[str],
+        num_embeddings_per_feature: List[int],
+        width: int = 1 << 20,
+        depth: int = 4,
+        sample_every: int = 1,
+        seed: int = 0,
+    ) -> None:
+        self.keys = keys
+        self.num_embeddings_per_feature = num_embeddings_per_feature
+        self.sample_every = sample_every
+        self.exact: Dict[str, torch.Tensor] = {}
+        self.sketches: Dict[str, CountMinSketch] = {}
+        for key, num_embeddings in zip(keys, num_embeddings_per_feature):
+            if num_embeddings <= width * depth:
+                self.exact[key] = torch.zeros(num_embeddings, dtype=torch.int64)
+            else:
+                self.sketches[key] = CountMinSketch(width, depth, seed)
+        # Per feature: [number of ids, number of samples] in counted batches.
+        self.totals = torch.zeros(len(keys), 2, dtype=torch.int64)
+        self.num_batches = 0
+
+    def observe(self, batch: Batch) -> Batch:
+        """Counts the ids of batch if it is sampled and returns it unchanged."""
+        self.num_batches += 1
+        if (self.num_batches - 1) % self.sample_every != 0:
+            return batch
+        kjt = batch.sparse_features
+        values = kjt.values().to(device="cpu", dtype=torch.int64)
+        offset_per_key = kjt.offset_per_key()
+        for i, key in enumerate(self.keys):
+            ids = values[offset_per_key[i] : offset_per_key[i + 1]]
+            if key in self.exact:
+                self.exact[key].index_add_(
+                    0, ids, torch.ones(ids.numel(), dtype=torch.int64)
+                )
+            else:
+                self.sketches[key].update(ids)
+            self.totals[i, 0] += ids.numel()
+        self.totals[:, 1] += kjt.stride()
+        return batch
+
+    def all_reduce(self, device: torch.device) -> None:
+        """Sums the counters of all ranks. All ranks must call it."""
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        tensors = (
+            [self.totals]
+            + list(self.exact.values())
+            + [sketch.counts for sketch in self.sketches.values()]
+        )
+        for tensor in tensors:
+            reduced = tensor.to(device)
+            dist.all_reduce(reduced, op=dist.ReduceOp.SUM)
+            tensor.copy_(reduced.cpu())
+
+    def estimated_counts(self, key: str) -> torch.Tensor:
+        """Access count of every row of the table of key."""
+        if key in self.exact:
+            return self.exact[key]
+        sketch = self.sketches[key]
+        num_embeddings = self.num_embeddings_per_feature[self.keys.index(key)]
+        return torch.cat(
+            [
+                sketch.query(
+                    torch.arange(start, min(start + _QUERY_CHUNK, num_embeddings))
+                )
+                for start in range(0, num_embeddings, _QUERY_CHUNK)
+            ]
+        )
+
+    def coverage(self, key: str, fractions: List[float]) -> List[int]:
+        """Number of hottest rows of the table of key receiving each fraction of accesses."""
+        counts = torch.sort(self.estimated_counts(key), descending=True).values
+        cumulative = torch.cumsum(counts, dim=0).double()
+        total = cumulative[-1].item()
+        if total == 0:
+            return [0 for _ in fractions]
+        targets = torch.tensor(fractions, dtype=torch.float64) * total
+        rows = torch.searchsorted(cumulative, targets) + 1
+        return rows.clamp(max=len(counts)).tolist()
+
+    def plan_hints(
+        self,
+        embedding_dim: int,
+        hbm_budget_bytes: int,
+        target_hit_rate: float = 0.95,
+        bytes_per_element: int = 4,
+    ) -> Dict[str, Dict]:
+        """
+        Turns the measured skew into placement hints for each table.
+
+        Tables are placed in HBM ("fused") smallest first while they fit in
+        hbm_budget_bytes. Each remaining table gets a UVM cache sized to the rows
+        receiving target_hit_rate of its accesses ("fused_uvm_caching") if that fits
+        in the remaining budget, and is otherwise left in UVM ("fused_uvm").
+
+        Returns:
+            Dict[str, Dict]: hints keyed by feature name, see load_parameter_constraints.
+        """
+        hints = {}
+        for i, key in enumerate(self.keys):
+            num_ids, num_samples = self.totals[i].tolist()
+            hot_rows = self.coverage(key, COVERAGE_FRACTIONS + [target_hit_rate])
+            hints[key] = {
+                "num_embeddings": self.num_embeddings_per_feature[i],
+                "observed_ids": num_ids,
+                "pooling_factor": num_ids / max(num_samples, 1),
+                "exact_counts": key in self.exact,
+                "hot_rows": dict(
+                    zip(
+                        map(str, COVERAGE_FRACTIONS),
+                        hot_rows[: len(COVERAGE_FRACTIONS)],
+                    )
+                ),
+                "target_hot_rows": hot_rows[-1],
+            }
+
+        remaining = hbm_budget_bytes
+        row_bytes = embedding_dim * bytes_per_element
+        by_size = sorted(self.keys, key=lambda k: hints[k]["num_embeddings"])
+        caching = []
+        for key in by_size:
+            table_bytes = hints[key]["num_embeddings"] * row_bytes
+            if table_bytes <= remaining:
+                hints[key]["compute_kernel"] = "fused"
+                remaining -= table_bytes
+            else:
+                caching.append(key)
+        # Tables with the most concentrated accesses get their caches first.
+        caching.sort(
+            key=lambda k: hints[k]["target_hot_rows"] / hints[k]["num_embeddings"]
+        )
+        for key in caching:
+            hint = hints[key]
+            cache_bytes = hint["target_hot_rows"] * row_bytes
+            if 0 < cache_bytes <= remaining:
+                hint["compute_kernel"] = "fused_uvm_caching"
+                hint["caching_ratio"] = hint["target_hot_rows"] / hint["num_embeddings"]
+                remaining -= cache_bytes
+            else:
+                hint["compute_kernel"] = "fused_uvm"
+        return hints
+
+
+def save_plan_hints(hints: Dict[str, Dict], path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(hints, f, indent=2)
+
+
+def load_parameter_constraints(
+    path: str, table_name_prefix: str = "t_"
+) -> Dict[str, ParameterConstraints]:
+    """
+    Reads plan hints written by save_plan_hints as EmbeddingShardingPlanner
+    constraints, keyed by table name (table_name_prefix + feature name).
+    """
+    with open(path) as f:
+        hints = json.load(f)
+    constraints = {}
+    for key, hint in hints.items():
+        caching_ratio: Optional[float] = hint.get("caching_ratio")
+        constraints[table_name_prefix + key] = ParameterConstraints(
+            compute_kernels=[hint["compute_kernel"]],
+            caching_ratio=caching_ratio,
+            pooling_factors=[max(hint["pooling_factor"], 1.0)],
+        )
+    return constraints
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
+from torch import distributed as dist, nn
+from torch.distributed._shard.sharded_tensor import ShardedTensor
+from torchrec.modules.embedding_configs import EmbeddingBagConfig
+from torchrec.sparse.jagged_tensor import KeyedJaggedTensor, KeyedTensor
+
+# Bits per element of each precision accepted by parse_quantization_bits.
+PRECISIONS = {"fp32": 32, "int8": 8, "int4": 4}
+# Rows (de)quantized or transferred at once, bounding temporary memory.
+DEFAULT_CHUNK_ROWS = 1 << 18
+
+
+def parse_quantization_bits(spec: str, table_names: List[str]) -> Dict[str, int]:
+    """
+    Parses "int8", "int4" or a comma separated precision per table, e.g.
+    "fp32,int8,int4,...", into bits per table name.
+    """
+    precisions = spec.split(",")
+    if len(precisions) == 1:
+        precisions = precisions * len(table_names)
+    if len(precisions) != len(table_names):
+        raise ValueError(
+            f"Expected 1 or {len(table_names)} precisions, got {len(precisions)}."
+        )
+    for precision in precisions:
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"Unknown precision {precision}, expected one of {list(PRECISIONS)}."
+            )
+    return {
+        name: PRECISIONS[precision] for name, precision in zip(table_names, precisions)
+    }
+
+
+def quantize_rowwise(
+    weight: torch.Tensor, bits: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Row-wise asymmetric quantization, as in the fused row-wise formats of FBGEMM.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: uint8 [rows, dim * bits / 8] codes, with
+            two 4-bit codes per byte for bits=4, and float16 [rows, 2] scale and bias.
+    """
+    assert bits in (4, 8), f"bits must be 4 or 8, got {bits}"
+    weight = weight.float()
+    levels = (1 << bits) - 1
+    lo = weight.min(dim=1).values
+    hi = weight.max(dim=1).values
+    scale = ((hi - lo) / levels).half()
+    bias = lo.half()
+    # Rows with a single value, or a scale below float16 precision.
+    scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+    codes = torch.round((weight - bias.float()[:, None]) / scale.float()[:, None])
+    codes = codes.clamp_(0, levels).to(torch.uint8)
+    if bits == 4:
+        assert weight.shape[1] % 2 == 0, "4-bit quantization needs an even dim"
+        codes = codes[:, 0::2] | (codes[:, 1::2] << 4)
+    return codes, torch.stack([scale, bias], dim=1)
+
+
+def dequantize_rowwise(
+    codes: torch.Tensor, scale_bias: torch.Tensor, bits: int
+) -> torch.Tensor:
+    """Inverse of quantize_rowwise, returns float32 rows."""
+    if bits == 4:
+        codes = torch.stack([codes & 0xF, codes >> 4], dim=-1).view(codes.shape[0], -1)
+    scale_bias = scale_bias.float()
+    return codes.float() * scale_bias[:, 0:1] + scale_bias[:, 1:2]
+
+
+def fake_quantize_(
+    weight: torch.Tensor, bits: int, chunk_rows: int = DEFAULT_CHUNK_ROWS
+) -> None:
+    """Replaces weight in place by its quantized and dequantized values."""
+    for chunk in weight.detach().split(chunk_rows):
+        chunk.copy_(dequantize_rowwise(*quantize_rowwise(chunk, bits), bits))
+
+
+def embedding_weights(
+    model: nn.Module,
+) -> Dict[str, Union[ShardedTensor, torch.Tensor]]:
+    """
+    Embedding table weights of a DistributedModelParallel model by table name:
+    ShardedTensors, or replicated tensors for data parallel tables.
+    """
+    return {
+        key.split(".")[-2]: value
+        for key, value in model.state_dict().items()
+        if ".embedding_bags." in key and key.endswith(".weight")
+    }
+
+
+def _local_tensors(weight: Union[ShardedTensor, torch.Tensor]) -> List[torch.Tensor]:
+    if isinstance(weight, ShardedTensor):
+        return [shard.tensor for shard in weight.local_shards()]
+    return [weight]
+
+
+def fake_quantize_local_shards(
+    weight: Union[ShardedTensor, torch.Tensor], bits: int
+) -> List[torch.Tensor]:
+    """
+    Fake quantizes the local shards of weight in place and returns CPU copies of
+    their original values for restore_local_shards. Column-wise shards are
+    quantized separately, which is slightly finer than quantizing whole rows.
+    """
+    backups = []
+    for tensor in _local_tensors(weight):
+        backups.append(tensor.detach().cpu())
+        fake_quantize_(tensor, bits)
+    return backups
+
+
+def restore_local_shards(
+    weight: Union[ShardedTensor, torch.Tensor], backups: List[torch.Tensor]
+) -> None:
+    for tensor, backup in zip(_local_tensors(weight), backups):
+        tensor.detach().copy_(backup)
+
+
+def gather_table(
+    weight: Union[ShardedTensor, torch.Tensor],
+    device: torch.device,
+    dst: int = 0,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+) -> Optional[torch.Tensor]:
+    """
+    Assembles the full table of weight on the CPU of rank dst, which gets it as the
+    return value. Shards are sent in chunks of chunk_rows rows through device, so
+    only the destination holds the whole table. All ranks must call it.
+    """
+    rank = dist.get_rank()
+    if not isinstance(weight, ShardedTensor):
+        return weight.detach().cpu() if rank == dst else None
+    metadata = weight.metadata()
+    dtype = metadata.tensor_properties.dtype
+    out = torch.empty(tuple(metadata.size), dtype=dtype) if rank == dst else None
+    local_shards = {
+        tuple(shard.metadata.shard_offsets): shard.tensor
+        for shard in weight.local_shards()
+    }
+    # All ranks go through the shards in the same order, which pairs sends and recvs.
+    for shard_metadata in metadata.shards_metadata:
+        owner = shard_metadata.placement.rank()
+        if owner != rank and rank != dst:
+            continue
+        row_offset, col_offset = shard_metadata.shard_offsets
+        num_rows, num_cols = shard_metadata.shard_sizes
+        for start in range(0, num_rows, chunk_rows):
+            end = min(start + chunk_rows, num_rows)
+            if owner == rank:
+                chunk = local_shards[tuple(shard_metadata.shard_offsets)][start:end]
+                if rank != dst:
+                    dist.send(chunk.detach().contiguous().to(device), dst)
+                    continue
+            else:
+                chunk = torch.empty(end - start, num_cols, dtype=dtype, device=device)
+                dist.recv(chunk, owner)
+            out[
+                row_offset + start : row_offset + end,
+                col_offset : col_offset + num_cols,
+            ] = chunk.detach().cpu()
+    return out
+
+
+class QuantizedEmbeddingBagCollection(nn.Module):
+    """
+    Sum pooled EmbeddingBagCollection for CPU inference whose tables are stored
+    row-wise quantized to 8 or 4 bits, or kept in float32 (32 bits). Only the looked
+    up rows are dequantized.
+
+    Args:
+        tables (List[EmbeddingBagConfig]): table configs, as for EmbeddingBagCollection.
+        bits (Dict[str, int]): bits per element of each table, 4, 8 or 32.
+
+    Example::
+
+        ebc = QuantizedEmbeddingBagCollection(eb_configs, bits)
+        for name, weight in weights.items():
+            ebc.load_weight(name, weight)
+        dlrm.sparse_arch.embedding_bag_collection = ebc
+    """
+
+    def __init__(
+        self,
+        tables: List[EmbeddingBagConfig],
+        bits: Dict[str, int],
+    ) -> None:
+        super().__init__()
+        self._configs = tables
+        self._bits = bits
+        self._tables: Dict[str, Tuple[torch.Tensor, ...]] = {}
+        self._feature_names: List[str] = [
+            name for config in tables for name in config.feature_names
+        ]
+        self._length_per_key: List[int] = [
+            config.embedding_dim for config in tables for _ in config.feature_names
+        ]
+
+    def load_weight(self, name: str, weight: torch.Tensor) -> None:
+        """Quantizes the float weight of table name, chunk by chunk."""
+        weight = weight.detach()
+        if self._bits[name] == 32:
+            self._tables[name] = (weight.float(),)
+            return
+        quantized = [
+            quantize_rowwise(chunk, self._bits[name])
+            for chunk in weight.split(DEFAULT_CHUNK_ROWS)
+        ]
+        self._tables[name] = (
+            torch.cat([codes for codes, _ in quantized]),
+            torch.cat([scale_bias for _, scale_bias in quantized]),
+        )
+
+    def table_nbytes(self) -> Dict[str, int]:
+        """Bytes used by each table, including scales and biases."""
+        return {
+            name: sum(t.numel() * t.element_size() for t in tensors)
+            for name, tensors in self._tables.items()
+        }
+
+    def _lookup(self, name: str, ids: torch.Tensor) -> torch.Tensor:
+        tensors = self._tables[name]
+        if len(tensors) == 1:
+            return tensors[0][ids]
+        codes, scale_bias = tensors
+        return dequantize_rowwise(codes[ids], scale_bias[ids], self._bits[name])
+
+    def forward(self, features: KeyedJaggedTensor) -> KeyedTensor:
+        feature_dict = features.to_dict()
+        pooled = []
+        for config in self._configs:
+            for feature_name in config.feature_names:
+                jagged = feature_dict[feature_name]
+                ids = jagged.values().long()
+                rows = self._lookup(config.name, ids)
+                pooled.append(
+                    nn.functional.embedding_bag(
+                        torch.arange(ids.numel()),
+                        rows,
+                        jagged.offsets().long(),
+                        mode="sum",
+                        include_last_offset=True,
+                    )
+                )
+        return KeyedTensor(
+            keys=self._feature_names,
+            length_per_key=self._length_per_key,
+            values=torch.cat(pooled, dim=1),
+        )
@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import itertools
+import json
+import os
+import pathlib
+import resource
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterable, Iterator, List
+
+import numpy as np
+import torch
+from torch import distributed as dist
+from torch.utils.data import DataLoader
+from torchrec import EmbeddingBagCollection
+from torchrec.datasets.criteo import (
+    CAT_FEATURE_COUNT,
+    DEFAULT_CAT_NAMES,
+    DEFAULT_INT_NAMES,
+    INT_FEATURE_COUNT,
+    InMemoryBinaryCriteoIterDataPipe,
+)
+from torchrec.datasets.random import RandomRecDataset
+from torchrec.distributed import TrainPipelineSparseDist
+from torchrec.distributed.model_parallel import DistributedModelParallel
+from torchrec.models.dlrm import DLRM, DLRMTrain
+from torchrec.modules.embedding_configs import EmbeddingBagConfig
+from torchrec.optim.apply_optimizer_in_backward import apply_optimizer_in_backward
+from torchrec.optim.keyed import CombinedOptimizer, KeyedOptimizerWrapper
+from torchrec.optim.optimizers import in_backward_optimizer_filter
+
+p = pathlib.Path(__file__).absolute().parents[1].resolve()
+sys.path.append(os.fspath(p))
+
+# OSS import
+try:
+    # pyre-ignore[21]
+    # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm:auroc
+    from auroc import BinnedAUROC
+
+    # pyre-ignore[21]
+    # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm/data:multi_hot_criteo
+    from data.multi_hot_criteo import MultiHotCriteoIterDataPipe
+
+    # pyre-ignore[21]
+    # @manual=//ai_codesign/benchmarks/dlrm/torchrec_dlrm:multi_hot
+    from multi_hot import Multihot
+except ImportError:
+    pass
+
+# internal import
+try:
+    from .auroc import BinnedAUROC  # noqa F811
+    from .data.multi_hot_criteo import MultiHotCriteoIterDataPipe  # noqa F811
+    from .multi_hot import Multihot  # noqa F811
+except ImportError:
+    pass
+
+STAGES = [
+    "random_loader",
+    "in_memory_binary_loader",
+    "multi_hot_loader",
+    "multi_hot_loader_mmap",
+    "multi_hot_conversion",
+    "train_pipeline",
+    "evaluation",
+]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of DLRM data loading and training in"
+        " isolation on CPU with synthetic data."
+    )
+    parser.add_argument(
+        "--stages",
+        type=str,
+        default=",".join(STAGES),
+        help=f"Comma separated stages to run, among {','.join(STAGES)}.",
+    )
+    parser.add_argument(
+        "--num_rows",
+        type=int,
+        default=200_000,
+        help="Number of rows of the synthetic Criteo day files.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=2048,
+        help="Batch size of every stage.",
+    )
+    parser.add_argument(
+        "--num_batches",
+        type=int,
+        default=50,
+        help="Number of timed batches per stage.",
+    )
+    parser.add_argument(
+        "--warmup_batches",
+        type=int,
+        default=5,
+        help="Number of untimed batches per stage.",
+    )
+    parser.add_argument(
+        "--num_embeddings",
+        type=int,
+        default=100_000,
+        help="Number of rows of every embedding table.",
+    )
+    parser.add_argument(
+        "--multi_hot_sizes",
+        type=str,
+        default="3,2,1,2,6,1,1,1,1,7,3,8,1,6,9,5,1,1,1,12,100,27,10,3,1,1",
+        help="Comma separated multi-hot size per sparse feature.",
+    )
+    parser.add_argument(
+        "--embedding_dim",
+        type=int,
+        default=64,
+        help="Size of each embedding.",
+    )
+    parser.add_argument(
+        "--dense_arch_layer_sizes",
+        type=str,
+        default="512,256,64",
+        help="Comma separated layer sizes for dense arch.",
+    )
+    parser.add_argument(
+        "--over_arch_layer_sizes",
+        type=str,
+        default="512,512,256,1",
+        help="Comma separated layer sizes for over arch.",
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        default=None,
+        help="Directory for the synthetic dataset files. Defaults to a temporary"
+        " directory removed at exit.",
+    )
+    parser.add_argument(
+        "--output_json",
+        type=str,
+        default=None,
+        help="Path of the JSON results, for regression tracking.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed of the synthetic data and model.",
+    )
+    args = parser.parse_args()
+    for name in [
+        "stages",
+        "multi_hot_sizes",
+        "dense_arch_layer_sizes",
+        "over_arch_layer_sizes",
+    ]:
+        val = getattr(args, name).split(",")
+        setattr(args, name, val if name == "stages" else list(map(int, val)))
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages {sorted(unknown)}, expected some of {STAGES}.")
+    return args
+
+
+def _rss_mb() -> float:
+    """Current resident set size, falling back to the peak if /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def _cycle(make_iterable: Callable[[], Iterable]) -> Iterator:
+    """Iterates make_iterable() forever, restarting it when exhausted."""
+    while True:
+        empty = True
+        for item in make_iterable():
+            empty = False
+            yield item
+        if empty:
+            raise ValueError("Stage produced no batches, increase --num_rows.")
+
+
+def measure(
+    name: str,
+    step: Callable[[], int],
+    num_batches: int,
+    warmup_batches: int,
+    rss_before_setup: float,
+) -> Dict[str, float]:
+    """
+    Times step(), which processes one batch and returns its number of samples.
+    """
+    for _ in range(warmup_batches):
+        step()
+    latencies = []
+    num_samples = 0
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        batch_start = time.perf_counter()
+        num_samples += step()
+        latencies.append(time.perf_counter() - batch_start)
+    elapsed = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000
+    result = {
+        "samples_per_second": num_samples / elapsed,
+        "batches": num_batches,
+        "samples": num_samples,
+        "p50_batch_latency_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_batch_latency_ms": float(np.percentile(latencies_ms, 99)),
+        "rss_delta_mb": _rss_mb() - rss_before_setup,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+    }
+    print(
+        f"{name:>24}: {result['samples_per_second']:>12.0f} samples/s,"
+        f" p50 {result['p50_batch_latency_ms']:8.2f} ms,"
+        f" p99 {result['p99_batch_latency_ms']:8.2f} ms,"
+        f" rss +{result['rss_delta_mb']:.0f} MB"
+    )
+    return result
+
+
+def write_synthetic_day(args: argparse.Namespace, data_dir: str) -> Dict[str, str]:
+    """
+    Writes one day of 1-hot Criteo npy files and its materialized multi-hot
+    counterpart in the layout of materialize_synthetic_multihot_dataset.py.
+    """
+    rng = np.random.default_rng(args.seed)
+    paths = {
+        "dense": os.path.join(data_dir, "day_0_dense.npy"),
+        "sparse": os.path.join(data_dir, "day_0_sparse.npy"),
+        "labels": os.path.join(data_dir, "day_0_labels.npy"),
+        "sparse_multi_hot": os.path.join(data_dir, "day_0_sparse_multi_hot.npz"),
+    }
+    np.save(
+        paths["dense"],
+        rng.random((args.num_rows, INT_FEATURE_COUNT), dtype=np.float32),
+    )
+    np.save(
+        paths["sparse"],
+        rng.integers(
+            0, args.num_embeddings, (args.num_rows, CAT_FEATURE_COUNT), dtype=np.int32
+        ),
+    )
+    np.save(
+        paths["labels"],
+        rng.integers(0, 2, (args.num_rows, 1), dtype=np.int32),
+    )
+    # Read by MultiHotCriteoIterDataPipe in place of the missing npz file.
+    multi_hot_dir = paths["sparse_multi_hot"][: -len(".npz")]
+    os.makedirs(multi_hot_dir, exist_ok=True)
+    for j, multi_hot_size in enumerate(args.multi_hot_sizes):
+        np.save(
+            os.path.join(multi_hot_dir, f"{j}.npy"),
+            rng.integers(
+                0,
+                args.num_embeddings,
+                (args.num_rows, multi_hot_size),
+                dtype=np.int32,
+            ),
+        )
+    return paths
+
+
+def _binary_datapipe(
+    args: argparse.Namespace,
+    datapipe_cls: type,
+    paths: Dict[str, str],
+    sparse_key: str,
+    mmap_mode: bool,
+) -> DataLoader:
+    # Same options as _get_in_memory_dataloader in data/dlrm_dataloader.py.
+    return DataLoader(
+        datapipe_cls(
+            "train",
+            [paths["dense"]],
+            [paths[sparse_key]],
+            [paths["labels"]],
+            batch_size=args.batch_size,
+            rank=0,
+            world_size=1,
+            drop_last=True,
+            shuffle_batches=False,
+            shuffle_training_set=False,
+            shuffle_training_set_random_seed=args.seed,
+            mmap_mode=mmap_mode,
+            hashes=[args.num_embeddings] * CAT_FEATURE_COUNT,
+        ),
+        batch_size=None,
+        collate_fn=lambda x: x,
+    )
+
+
+def _random_dataloader(args: argparse.Namespace, ids_per_feature: int) -> DataLoader:
+    return DataLoader(
+        RandomRecDataset(
+            keys=DEFAULT_CAT_NAMES,
+            batch_size=args.batch_size,
+            hash_size=args.num_embeddings,
+            ids_per_feature=ids_per_feature,
+            num_dense=len(DEFAULT_INT_NAMES),
+            manual_seed=args.seed,
+        ),
+        batch_size=None,
+        batch_sampler=None,
+        num_workers=0,
+    )
+
+
+def build_train_pipeline(args: argparse.Namespace) -> TrainPipelineSparseDist:
+    device = torch.device("cpu")
+    torch.manual_seed(args.seed)
+    eb_configs = [
+        EmbeddingBagConfig(
+            name=f"t_{feature_name}",
+            embedding_dim=args.embedding_dim,
+            num_embeddings=args.num_embeddings,
+            feature_names=[feature_name],
+        )
+        for feature_name in DEFAULT_CAT_NAMES
+    ]
+    train_model = DLRMTrain(
+        DLRM(
+            embedding_bag_collection=EmbeddingBagCollection(
+                tables=eb_configs, device=torch.device("meta")
+            ),
+            dense_in_features=len(DEFAULT_INT_NAMES),
+            dense_arch_layer_sizes=args.dense_arch_layer_sizes,
+            over_arch_layer_sizes=args.over_arch_layer_sizes,
+            dense_device=device,
+        )
+    )
+    apply_optimizer_in_backward(
+        torch.optim.SGD, train_model.model.sparse_arch.parameters(), {"lr": 0.01}
+    )
+    model = DistributedModelParallel(module=train_model, device=device)
+    dense_optimizer = KeyedOptimizerWrapper(
+        dict(in_backward_optimizer_filter(model.named_parameters())),
+        lambda params: torch.optim.SGD(params, lr=0.01),
+    )
+    optimizer = CombinedOptimizer([model.fused_optimizer, dense_optimizer])
+    return TrainPipelineSparseDist(model, optimizer, device)
+
+
+def run_stage(
+    stage: str, args: argparse.Namespace, paths: Dict[str, str]
+) -> Dict[str, float]:
+    rss_before_setup = _rss_mb()
+    if stage == "random_loader":
+        batches = _cycle(lambda: _random_dataloader(args, 1))
+
+        def step() -> int:
+            return len(next(batches).labels)
+
+    elif stage == "in_memory_binary_loader":
+        loader = _binary_datapipe(
+            args, InMemoryBinaryCriteoIterDataPipe, paths, "sparse", False
+        )
+        batches = _cycle(lambda: loader)
+
+        def step() -> int:
+            return len(next(batches).labels)
+
+    elif stage in ["multi_hot_loader", "multi_hot_loader_mmap"]:
+        loader = _binary_datapipe(
+            args,
+            MultiHotCriteoIterDataPipe,
+            paths,
+            "sparse_multi_hot",
+            stage == "multi_hot_loader_mmap",
+        )
+        batches = _cycle(lambda: loader)
+
+        def step() -> int:
+            return len(next(batches).labels)
+
+    elif stage == "multi_hot_conversion":
+        multihot = Multihot(
+            args.multi_hot_sizes,
+            [args.num_embeddings] * CAT_FEATURE_COUNT,
+            args.batch_size,
+            collect_freqs_stats=False,
+            dist_type="uniform",
+        )
+        # Batches are generated up front so only the conversion is timed.
+        one_hot_batches = list(
+            itertools.islice(
+                _cycle(lambda: _random_dataloader(args, 1)),
+                args.num_batches + args.warmup_batches,
+            )
+        )
+        batches = iter(one_hot_batches)
+
+        def step() -> int:
+            return len(multihot.convert_to_multi_hot(next(batches)).labels)
+
+    elif stage in ["train_pipeline", "evaluation"]:
+        pipeline = build_train_pipeline(args)
+        batches = _cycle(lambda: _random_dataloader(args, 1))
+        if stage == "train_pipeline":
+            pipeline._model.train()
+
+            def step() -> int:
+                pipeline.progress(batches)
+                return args.batch_size
+
+        else:
+            pipeline._model.eval()
+            auroc = BinnedAUROC()
+
+            def step() -> int:
+                with torch.no_grad():
+                    _loss, logits, labels = pipeline.progress(batches)
+                    auroc(torch.sigmoid(logits), labels)
+                return len(labels)
+
+    return measure(
+        stage, step, args.num_batches, args.warmup_batches, rss_before_setup
+    )
+
+
+def main() -> None:
+    """
+    Runs each stage of DLRM training in isolation on CPU and reports samples/s,
+    p50/p99 batch latency and memory:
+
+        python benchmark_pipeline_stages.py \
+            --num_rows 500000 \
+            --batch_size 4096 \
+            --stages in_memory_binary_loader,multi_hot_loader_mmap,train_pipeline \
+            --output_json results.json
+    """
+    args = parse_args()
+    os.environ.setdefault("LOCAL_WORLD_SIZE", "1")
+    os.environ.setdefault("LOCAL_RANK", "0")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not dist.is_initialized():
+            dist.init_process_group(
+                backend="gloo",
+                init_method=f"file://{os.path.join(tmp_dir, 'pg')}",
+                rank=0,
+                world_size=1,
+            )
+        data_dir = args.data_dir if args.data_dir is not None else tmp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        print(f"Writing {args.num_rows} synthetic rows to {data_dir}")
+        paths = write_synthetic_day(args, data_dir)
+
+        results: Dict[str, Dict[str, float]] = {}
+        for stage in args.stages:
+            results[stage] = run_stage(stage, args, paths)
+
+    if args.output_json is not None:
+        config = {
+            k: v for k, v in vars(args).items() if k not in ["output_json", "data_dir"]
+        }
+        with open(args.output_json, "w") as f:
+            json.dump(
+                {
+                    "config": config,
+                    "torch_version": torch.__version__,
+                    "num_threads": torch.get_num_threads(),
+                    "stages": results,
+                },
+                f,
+                indent=2,
+            )
+        print(f"Results written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
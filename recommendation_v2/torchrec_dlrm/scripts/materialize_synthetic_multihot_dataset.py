@@ -5,10 +5,14 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import json
+import multiprocessing
 import os
 import pathlib
 import shutil
 import sys
+import time
+from typing import Dict, List, Optional, Set, Tuple
 
 import numpy as np
 import torch
@@ -32,6 +36,13 @@ try:
 except ImportError:
     pass
 
+PROGRESS_FILE = "progress.json"
+
+# One-hot to multi-hot lookup tables and hashes, set before the worker pool is forked
+# so that workers share them copy-on-write instead of rebuilding or pickling them.
+_MULTI_HOT_TABLES: List[np.ndarray] = []
+_HASHES: List[int] = []
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -76,9 +87,138 @@ def parse_args() -> argparse.Namespace:
         default="uniform",
         help="Multi-hot distribution options.",
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=["npy", "npz"],
+        default="npz",
+        help="npz writes the original day_{i}_sparse_multi_hot.npz files one day at a"
+        " time, which md5sums_MLPerf_v2_synthetic_multi_hot_sparse_dataset.txt verifies."
+        " npy writes day_{i}_sparse_multi_hot/{feature}.npy memmaps in parallel, chunk"
+        " by chunk, and can resume after an interruption.",
+    )
+    parser.add_argument(
+        "--chunk_rows",
+        type=int,
+        default=1_000_000,
+        help="Number of rows materialized per task with --output_format npy.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes per rank with --output_format npy.",
+    )
     return parser.parse_args()
 
 
+def _chunk_worker(task: Tuple[int, str, str, int, int]) -> Tuple[int, int, int]:
+    """
+    Materializes rows [row_start, row_end) of one day into its per-feature npy
+    memmaps. Returns (day, row_start, row_end) once the rows are flushed to disk.
+    """
+    day, input_file_path, output_dir, row_start, row_end = task
+    sparse_data = np.load(input_file_path, mmap_mode="r")
+    one_hot = np.asarray(sparse_data[row_start:row_end])
+    for j, (multi_hot_table, hash) in enumerate(zip(_MULTI_HOT_TABLES, _HASHES)):
+        ids = one_hot[:, j].astype(np.int64) % hash
+        output = np.load(os.path.join(output_dir, f"{j}.npy"), mmap_mode="r+")
+        # ids are already hashed into range, "clip" avoids np.take buffering out.
+        np.take(
+            multi_hot_table, ids, axis=0, out=output[row_start:row_end], mode="clip"
+        )
+        output.flush()
+        del output
+    return day, row_start, row_end
+
+
+def _read_progress(output_dir: str, config: Dict) -> Optional[Set[int]]:
+    """Returns the completed chunk starts of a day, or None if it must start over."""
+    path = os.path.join(output_dir, PROGRESS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        progress = json.load(f)
+    if progress["config"] != config:
+        print(f"{path} was written with a different configuration, starting over.")
+        return None
+    return set(progress["done"])
+
+
+def _write_progress(output_dir: str, config: Dict, done: Set[int]) -> None:
+    path = os.path.join(output_dir, PROGRESS_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"config": config, "done": sorted(done)}, f)
+    os.replace(path + ".tmp", path)
+
+
+def _prepare_day(
+    args: argparse.Namespace, day: int
+) -> Tuple[str, str, Dict, Set[int], int]:
+    """
+    Creates (or reopens, when resuming) the output memmaps of a day.
+    Returns (input path, output dir, config, completed chunk starts, num rows).
+    """
+    input_file_path = os.path.join(
+        args.in_memory_binary_criteo_path, f"day_{day}_sparse.npy"
+    )
+    output_dir = os.path.join(args.output_path, f"day_{day}_sparse_multi_hot")
+    num_rows = np.load(input_file_path, mmap_mode="r").shape[0]
+    config = {
+        "num_rows": num_rows,
+        "chunk_rows": args.chunk_rows,
+        "multi_hot_sizes": args.multi_hot_sizes,
+        "num_embeddings_per_feature": args.num_embeddings_per_feature,
+        "multi_hot_distribution_type": args.multi_hot_distribution_type,
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    done = _read_progress(output_dir, config)
+    if done is None:
+        done = set()
+        # Files are created sparse; workers fill them in place.
+        for j, multi_hot_size in enumerate(args.multi_hot_sizes):
+            np.lib.format.open_memmap(
+                os.path.join(output_dir, f"{j}.npy"),
+                mode="w+",
+                dtype=np.int32,
+                shape=(num_rows, multi_hot_size),
+            )
+        _write_progress(output_dir, config, done)
+    return input_file_path, output_dir, config, done, num_rows
+
+
+def _materialize_npy(args: argparse.Namespace, days: List[int]) -> None:
+    tasks = []
+    days_state = {}
+    total_rows = 0
+    for day in days:
+        input_file_path, output_dir, config, done, num_rows = _prepare_day(args, day)
+        days_state[day] = (output_dir, config, done)
+        for row_start in range(0, num_rows, args.chunk_rows):
+            if row_start not in done:
+                row_end = min(row_start + args.chunk_rows, num_rows)
+                tasks.append((day, input_file_path, output_dir, row_start, row_end))
+                total_rows += row_end - row_start
+        print(
+            f"day {day}: {num_rows} rows, {len(done)} chunks already materialized"
+            f" in {output_dir}"
+        )
+
+    rows_done = 0
+    start_time = time.time()
+    with multiprocessing.get_context("fork").Pool(args.num_workers) as pool:
+        for day, row_start, row_end in pool.imap_unordered(_chunk_worker, tasks):
+            output_dir, config, done = days_state[day]
+            done.add(row_start)
+            _write_progress(output_dir, config, done)
+            rows_done += row_end - row_start
+            elapsed = time.time() - start_time
+            print(
+                f"day {day} rows [{row_start}, {row_end}) done."
+                f" {rows_done}/{total_rows} rows, {rows_done / elapsed:.0f} rows/s"
+            )
+
+
 def main() -> None:
     """
     This script generates and saves the MLPerf v2 multi-hot dataset (4 TB in size).
@@ -92,7 +232,15 @@ def main() -> None:
             --multi_hot_sizes 3,2,1,2,6,1,1,1,1,7,3,8,1,6,9,5,1,1,1,12,100,27,10,3,1,1 \
             --multi_hot_distribution_type uniform
 
-    This script takes about 2 hours to run (can be parallelized if needed).
+    The default --output_format npz materializes whole days at once into npz files
+    and takes about 2 hours to run. Its output can be verified with
+    md5sums_MLPerf_v2_synthetic_multi_hot_sparse_dataset.txt.
+
+    With --output_format npy, each rank splits its days into chunks of --chunk_rows
+    rows that a pool of --num_workers processes writes directly into
+    day_{i}_sparse_multi_hot/{feature}.npy. Completed chunks are recorded in
+    progress.json of each day, so rerunning the same command resumes an interrupted
+    run. MultiHotCriteoIterDataPipe reads either layout.
     """
     args = parse_args()
     for name, val in vars(args).items():
@@ -120,25 +268,34 @@ def main() -> None:
     )
 
     os.makedirs(args.output_path, exist_ok=True)
+    days = list(range(rank, DAYS, world_size))
 
-    for i in range(rank, DAYS, world_size):
-        input_file_path = os.path.join(
-            args.in_memory_binary_criteo_path, f"day_{i}_sparse.npy"
-        )
-        print(f"Materializing {input_file_path}")
-        sparse_data = np.load(input_file_path, mmap_mode="r")
-        multi_hot_ids_dict = {}
-        for j, (multi_hot_table, hash) in enumerate(
-            zip(multihot.multi_hot_tables_l, args.num_embeddings_per_feature)
-        ):
-            sparse_tensor = torch.from_numpy(sparse_data[:, j] % hash)
-            multi_hot_ids_dict[str(j)] = nn.functional.embedding(
-                sparse_tensor, multi_hot_table
-            ).numpy()
-        output_file_path = os.path.join(
-            args.output_path, f"day_{i}_sparse_multi_hot.npz"
-        )
-        np.savez(output_file_path, **multi_hot_ids_dict)
+    if args.output_format == "npy":
+        _MULTI_HOT_TABLES[:] = [
+            multi_hot_table.numpy() for multi_hot_table in multihot.multi_hot_tables_l
+        ]
+        _HASHES[:] = args.num_embeddings_per_feature
+        _materialize_npy(args, days)
+
+    for i in days:
+        if args.output_format == "npz":
+            input_file_path = os.path.join(
+                args.in_memory_binary_criteo_path, f"day_{i}_sparse.npy"
+            )
+            print(f"Materializing {input_file_path}")
+            sparse_data = np.load(input_file_path, mmap_mode="r")
+            multi_hot_ids_dict = {}
+            for j, (multi_hot_table, hash) in enumerate(
+                zip(multihot.multi_hot_tables_l, args.num_embeddings_per_feature)
+            ):
+                sparse_tensor = torch.from_numpy(sparse_data[:, j] % hash)
+                multi_hot_ids_dict[str(j)] = nn.functional.embedding(
+                    sparse_tensor, multi_hot_table
+                ).numpy()
+            output_file_path = os.path.join(
+                args.output_path, f"day_{i}_sparse_multi_hot.npz"
+            )
+            np.savez(output_file_path, **multi_hot_ids_dict)
         if args.copy_labels_and_dense:
             for part in ["labels", "dense"]:
                 source_path = os.path.join(
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+import unittest
+import uuid
+
+import torch
+from torch import distributed as dist
+from torch.distributed.launcher.api import elastic_launch, LaunchConfig
+from torchmetrics.functional import auroc as reference_auroc
+from torchrec import test_utils
+
+from ..auroc import BinnedAUROC, ExactAUROC
+
+
+def _make_scores(num_samples: int, seed: int = 0):
+    generator = torch.Generator().manual_seed(seed)
+    labels = (torch.rand(num_samples, generator=generator) < 0.1).float()
+    # Skewed, CTR-like scores that overlap between classes.
+    logits = torch.randn(num_samples, generator=generator) - 2.5 + 1.5 * labels
+    return torch.sigmoid(logits), labels
+
+
+class AUROCTest(unittest.TestCase):
+    def _reference(self, preds: torch.Tensor, labels: torch.Tensor) -> float:
+        return reference_auroc(preds, labels.long(), task="binary").item()
+
+    def test_exact_matches_reference(self) -> None:
+        preds, labels = _make_scores(100_000)
+        # Round to force ties between positives and negatives.
+        preds = torch.round(preds * 1000) / 1000
+        auroc = ExactAUROC()
+        for p, l in zip(preds.split(4096), labels.split(4096)):
+            auroc(p, l)
+        self.assertAlmostEqual(
+            auroc.compute().item(), self._reference(preds, labels), places=5
+        )
+        self.assertEqual(auroc.num_samples, preds.numel())
+
+    def test_binned_error_is_bounded(self) -> None:
+        preds, labels = _make_scores(200_000)
+        exact = self._reference(preds, labels)
+        for num_bins in (256, 4096, 1 << 20):
+            auroc = BinnedAUROC(num_bins)
+            for p, l in zip(preds.split(4096), labels.split(4096)):
+                auroc(p, l)
+            result = auroc.compute().item()
+            bound = auroc.error_bound()
+            self.assertLessEqual(abs(result - exact), bound + 1e-7)
+            self.assertEqual(auroc.num_samples, preds.numel())
+        # The default precision is indistinguishable from the exact AUROC.
+        self.assertLess(abs(result - exact), 1e-5)
+
+    def test_binned_single_class(self) -> None:
+        auroc = BinnedAUROC(16)
+        auroc(torch.rand(10), torch.zeros(10))
+        self.assertEqual(auroc.compute().item(), 0.0)
+
+    @classmethod
+    def _run_distributed(cls) -> None:
+        dist.init_process_group(backend="gloo")
+        rank = dist.get_rank()
+        preds, labels = _make_scores(50_000)
+        preds = torch.round(preds * 1000) / 1000
+        # Uneven shards to exercise the sample sort exchange.
+        bounds = [0, 10_000, 50_000]
+        local_preds = preds[bounds[rank] : bounds[rank + 1]]
+        local_labels = labels[bounds[rank] : bounds[rank + 1]]
+        exact = reference_auroc(preds, labels.long(), task="binary").item()
+
+        exact_auroc = ExactAUROC()
+        exact_auroc(local_preds, local_labels)
+        binned_auroc = BinnedAUROC(1 << 16)
+        binned_auroc(local_preds, local_labels)
+
+        assert abs(exact_auroc.compute().item() - exact) < 1e-5
+        assert exact_auroc.num_samples == preds.numel()
+        binned = binned_auroc.compute().item()
+        assert abs(binned - exact) <= binned_auroc.error_bound() + 1e-7
+        assert binned_auroc.num_samples == preds.numel()
+        dist.destroy_process_group()
+
+    @test_utils.skip_if_asan
+    def test_distributed(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lc = LaunchConfig(
+                min_nodes=1,
+                max_nodes=1,
+                nproc_per_node=2,
+                run_id=str(uuid.uuid4()),
+                rdzv_backend="c10d",
+                rdzv_endpoint=os.path.join(tmpdir, "rdzv"),
+                rdzv_configs={"store_type": "file"},
+                start_method="spawn",
+                monitor_interval=1,
+                max_restarts=0,
+            )
+
+            elastic_launch(config=lc, entrypoint=self._run_distributed)()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+import torch
+from torchrec import EmbeddingBagCollection
+from torchrec.modules.embedding_configs import EmbeddingBagConfig
+from torchrec.sparse.jagged_tensor import KeyedJaggedTensor
+
+from ..embedding_quantization import (
+    dequantize_rowwise,
+    parse_quantization_bits,
+    QuantizedEmbeddingBagCollection,
+    quantize_rowwise,
+)
+
+
+class EmbeddingQuantizationTest(unittest.TestCase):
+    def test_rowwise_error_is_half_a_step(self) -> None:
+        weight = torch.randn(1000, 16)
+        for bits in (4, 8):
+            codes, scale_bias = quantize_rowwise(weight, bits)
+            self.assertEqual(codes.dtype, torch.uint8)
+            self.assertEqual(codes.shape, (1000, 16 * bits // 8))
+            error = (dequantize_rowwise(codes, scale_bias, bits) - weight).abs()
+            # Half a quantization step, plus float16 rounding of scale and bias.
+            bound = 0.5 * scale_bias[:, 0:1].float() + 1e-2 * weight.abs().max()
+            self.assertTrue(torch.all(error <= bound))
+
+    def test_constant_rows(self) -> None:
+        weight = torch.full((4, 8), 0.25)
+        codes, scale_bias = quantize_rowwise(weight, 4)
+        self.assertTrue(torch.equal(dequantize_rowwise(codes, scale_bias, 4), weight))
+
+    def test_parse_quantization_bits(self) -> None:
+        self.assertEqual(parse_quantization_bits("int4", ["a", "b"]), {"a": 4, "b": 4})
+        self.assertEqual(
+            parse_quantization_bits("fp32,int8", ["a", "b"]), {"a": 32, "b": 8}
+        )
+        with self.assertRaises(ValueError):
+            parse_quantization_bits("int2", ["a"])
+
+    def test_matches_embedding_bag_collection(self) -> None:
+        tables = [
+            EmbeddingBagConfig(
+                name=f"t_{i}",
+                embedding_dim=8,
+                num_embeddings=50,
+                feature_names=[f"f{i}"],
+            )
+            for i in range(3)
+        ]
+        ebc = EmbeddingBagCollection(tables=tables)
+        features = KeyedJaggedTensor.from_lengths_sync(
+            keys=["f0", "f1", "f2"],
+            values=torch.randint(0, 50, (18,)),
+            lengths=torch.tensor([1, 2, 3, 3, 0, 3, 2, 2, 2]),
+        )
+        weights = {
+            name.split(".")[-2]: weight for name, weight in ebc.state_dict().items()
+        }
+        expected = ebc(features)
+
+        for bits, tolerance in ((32, 1e-6), (8, 1e-2), (4, 2e-1)):
+            quantized = QuantizedEmbeddingBagCollection(
+                tables, {name: bits for name in weights}
+            )
+            for name, weight in weights.items():
+                quantized.load_weight(name, weight)
+            actual = quantized(features)
+            self.assertEqual(actual.keys(), expected.keys())
+            self.assertTrue(
+                torch.allclose(actual.values(), expected.values(), atol=tolerance)
+            )
+        self.assertEqual(
+            quantized.table_nbytes(), {name: 50 * 4 + 50 * 2 * 2 for name in weights}
+        )
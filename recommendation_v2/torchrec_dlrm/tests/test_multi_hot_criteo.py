@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from torch import nn
+from torchrec.datasets.criteo import CAT_FEATURE_COUNT, INT_FEATURE_COUNT
+
+from ..data.multi_hot_criteo import (
+    MultiHotCriteoIterDataPipe,
+    OnTheFlyMultiHotCriteoIterDataPipe,
+)
+from ..multi_hot import Multihot
+
+NUM_ROWS = 1001
+MULTI_HOT_SIZES = [j % 4 + 1 for j in range(CAT_FEATURE_COUNT)]
+HASHES = [50 + 7 * j for j in range(CAT_FEATURE_COUNT)]
+
+
+def _write_days(tmpdir: str) -> None:
+    """Writes a 1-hot day and its multi-hot materialization as the script does."""
+    rng = np.random.default_rng(0)
+    prefix = os.path.join(tmpdir, "day_0")
+    np.save(
+        prefix + "_dense.npy",
+        rng.random((NUM_ROWS, INT_FEATURE_COUNT), dtype=np.float32),
+    )
+    np.save(
+        prefix + "_labels.npy",
+        rng.integers(0, 2, (NUM_ROWS, 1)).astype(np.int32),
+    )
+    sparse = rng.integers(0, 1000, (NUM_ROWS, CAT_FEATURE_COUNT)).astype(np.int32)
+    np.save(prefix + "_sparse.npy", sparse)
+
+    multihot = Multihot(MULTI_HOT_SIZES, HASHES, 1, False, "pareto")
+    multi_hot_ids_dict = {}
+    for j, (multi_hot_table, hash) in enumerate(
+        zip(multihot.multi_hot_tables_l, HASHES)
+    ):
+        sparse_tensor = torch.from_numpy(sparse[:, j] % hash)
+        multi_hot_ids_dict[str(j)] = nn.functional.embedding(
+            sparse_tensor, multi_hot_table
+        ).numpy()
+    np.savez(prefix + "_sparse_multi_hot.npz", **multi_hot_ids_dict)
+
+
+class OnTheFlyMultiHotTest(unittest.TestCase):
+
+    def _assert_same_batches(self, materialized, on_the_fly) -> None:
+        num_batches = 0
+        for expected, actual in zip(materialized, on_the_fly):
+            self.assertTrue(
+                torch.equal(expected.dense_features, actual.dense_features)
+            )
+            self.assertTrue(torch.equal(expected.labels, actual.labels))
+            expected_kjt = expected.sparse_features
+            actual_kjt = actual.sparse_features
+            self.assertEqual(expected_kjt.keys(), actual_kjt.keys())
+            for get in ("values", "lengths", "offsets"):
+                self.assertTrue(
+                    torch.equal(
+                        getattr(expected_kjt, get)(), getattr(actual_kjt, get)()
+                    )
+                )
+            num_batches += 1
+        self.assertGreater(num_batches, 0)
+
+    def test_matches_materialized_dataset(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _write_days(tmpdir)
+            prefix = os.path.join(tmpdir, "day_0")
+            for stage in ("train", "val"):
+                for rank in range(2):
+                    kwargs = {
+                        "batch_size": 33,
+                        "rank": rank,
+                        "world_size": 2,
+                        "shuffle_batches": True,
+                        "mmap_mode": True,
+                        "hashes": HASHES,
+                    }
+                    materialized = MultiHotCriteoIterDataPipe(
+                        stage,
+                        [prefix + "_dense.npy"],
+                        [prefix + "_sparse_multi_hot.npz"],
+                        [prefix + "_labels.npy"],
+                        **kwargs,
+                    )
+                    on_the_fly = OnTheFlyMultiHotCriteoIterDataPipe(
+                        stage,
+                        [prefix + "_dense.npy"],
+                        [prefix + "_sparse.npy"],
+                        [prefix + "_labels.npy"],
+                        multi_hot_sizes=MULTI_HOT_SIZES,
+                        multi_hot_distribution_type="pareto",
+                        num_gather_threads=4,
+                        **kwargs,
+                    )
+                    self.assertEqual(len(materialized), len(on_the_fly))
+                    self._assert_same_batches(materialized, on_the_fly)
+
+
+class WindowedShuffleTest(unittest.TestCase):
+    def _datapipe(
+        self, prefix: str, rank: int, **kwargs
+    ) -> MultiHotCriteoIterDataPipe:
+        return MultiHotCriteoIterDataPipe(
+            "train",
+            [prefix + "_dense.npy"],
+            [prefix + "_sparse_multi_hot.npz"],
+            [prefix + "_labels.npy"],
+            batch_size=33,
+            rank=rank,
+            world_size=2,
+            mmap_mode=True,
+            hashes=HASHES,
+            **kwargs,
+        )
+
+    def test_windows_permute_rows(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            _write_days(tmpdir)
+            prefix = os.path.join(tmpdir, "day_0")
+            for rank in range(2):
+                # Batches share buffers with the datapipe, so they are copied.
+                sequential = [
+                    b.dense_features.clone() for b in self._datapipe(prefix, rank)
+                ]
+                windowed = self._datapipe(prefix, rank, shuffle_window_batches=4)
+                batches = [b.dense_features.clone() for b in windowed]
+                self.assertEqual(list(map(len, batches)), list(map(len, sequential)))
+                for start in range(0, len(batches), 4):
+                    expected = torch.cat(sequential[start : start + 4])
+                    actual = torch.cat(batches[start : start + 4])
+                    self.assertFalse(torch.equal(expected, actual))
+                    self.assertTrue(
+                        torch.equal(
+                            expected[expected[:, 0].argsort()],
+                            actual[actual[:, 0].argsort()],
+                        )
+                    )
+
+                # Deterministic per epoch, different across epochs.
+                again = [b.dense_features.clone() for b in windowed]
+                self.assertTrue(all(map(torch.equal, again, batches)))
+                windowed.set_epoch(1)
+                next_epoch = [b.dense_features.clone() for b in windowed]
+                self.assertFalse(all(map(torch.equal, next_epoch, batches)))
+
+                # Resuming mid-window yields the remaining batches of the epoch.
+                windowed.set_epoch(0)
+                windowed.set_start_batch(6)
+                resumed = [b.dense_features.clone() for b in windowed]
+                self.assertEqual(len(resumed), len(batches) - 6)
+                self.assertTrue(all(map(torch.equal, resumed, batches[6:])))